@@ -0,0 +1,303 @@
+"""
+知識庫答案語音預合成
+知識庫命中時答案文字即時返回，但客戶端仍需逐段請求 /api/tts/stream。
+這裡按客戶端（app.js UltraFastTTSPlayer）的切段及清理規則，預先把每條已啟用答案的每一段
+以每個語音合成並固定在 TTS 緩存中，令第一次朗讀即命中緩存；問答更改或刪除時移除舊段落的音頻。
+其他固定回應（例如預取的天氣預報）可用 schedule_text() 以字串為擁有者加入
+"""
+import asyncio
+import logging
+import re
+import time
+from collections import defaultdict
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+# 與 UltraFastTTSPlayer 一致
+MIN_CHARS_FOR_TTS = 8
+MAX_CHARS_PER_CHUNK = 50
+# 客戶端朗讀時固定使用的語速及音調
+CLIENT_RATE = 160
+CLIENT_PITCH = 100
+
+_END_MARKS = set('。！？.!?')
+_COMMAND_BLOCK_RE = re.compile(r'\[指令分類\][\s\S]*?(?:\[/指令分類\]|\Z)')
+_LINK_RE = re.compile(r'\[.*?\]\(.*?\)')
+_DIGITS = set('0123456789')
+_EMOJI_RE = re.compile('[\U0001F600-\U0001F64F\U0001F300-\U0001F5FF\U0001F680-\U0001F6FF'
+                       '\u2600-\u26FF\u2700-\u27BF\U0001F900-\U0001F9FF\U0001FA00-\U0001FAFF]')
+
+
+def _first_sentence_end(text: str) -> int:
+    """第一個句末標點的位置；數字之間的小數點不算"""
+    for i, ch in enumerate(text):
+        if ch in _END_MARKS:
+            if ch == '.' and 0 < i < len(text) - 1 and text[i - 1] in _DIGITS and text[i + 1] in _DIGITS:
+                continue
+            return i
+    return -1
+
+
+def split_like_client(text: str) -> List[str]:
+    """
+    整段答案一次送入 UltraFastTTSPlayer.addText() 再 flush() 時得到的段落：
+    逐句切出；剩餘文字達 50 字時在第 50 字前最後一個全形逗號（或第 50 字）切一次；
+    最後剩下不少於 8 字的部分作為最後一段
+    """
+    chunks = []
+    buffer = text
+    while buffer:
+        end = _first_sentence_end(buffer)
+        if end != -1:
+            chunks.append(buffer[:end + 1])
+            buffer = buffer[end + 1:]
+            continue
+        if len(buffer) >= MAX_CHARS_PER_CHUNK:
+            comma = buffer.rfind('，', 0, MAX_CHARS_PER_CHUNK + 1)
+            cut = comma + 1 if comma > MIN_CHARS_FOR_TTS else MAX_CHARS_PER_CHUNK
+            chunks.append(buffer[:cut])
+            buffer = buffer[cut:]
+        break
+    if len(buffer) >= MIN_CHARS_FOR_TTS:
+        chunks.append(buffer)
+    return chunks
+
+
+def clean_like_client(text: str, preprocess: Callable[[str], str] = lambda t: t) -> str:
+    """UltraFastTTSPlayer._cleanTextForTTS：移除指令區塊、Markdown 符號及表情，再做粵語讀法預處理"""
+    cleaned = _COMMAND_BLOCK_RE.sub('', text).replace('[/指令分類]', '').replace('[指令分類]', '')
+    cleaned = re.sub(r'\*+|#+|`+', '', cleaned)
+    cleaned = _LINK_RE.sub('', cleaned)
+    cleaned = re.sub(r'[_~]', '', cleaned)
+    cleaned = _EMOJI_RE.sub('', cleaned)
+    cleaned = re.sub(r'[/\\()\[\]{}]', ' ', cleaned).strip()
+    return preprocess(cleaned)
+
+
+def client_tts_texts(answer: str, preprocess: Callable[[str], str] = lambda t: t) -> List[str]:
+    """客戶端朗讀該答案時會逐段請求的文字（即 TTS 緩存鍵中的 text）"""
+    texts = []
+    for chunk in split_like_client(answer):
+        text = clean_like_client(chunk, preprocess)
+        if len(text) >= 2 and text not in texts:
+            texts.append(text)
+    return texts
+
+
+class AnswerAudioPreSynthesizer:
+    """
+    背景預合成工作：schedule(qa_id) 把問答排入佇列，單一工作協程按 id 讀取答案，
+    與上次的段落比較後移除過期音頻、補合成缺少的音頻（有並發上限及記憶體預算）；
+    schedule_text(name, text) 以同一佇列處理不在知識庫中的固定回應
+    """
+
+    def __init__(self, knowledge_base, cache, synthesize: Callable[[str, str, int, int], Awaitable[bytes]],
+                 voices: Iterable[str], preprocess: Callable[[str], str] = lambda t: t,
+                 concurrency: int = 2, max_mb: float = 200):
+        self.knowledge_base = knowledge_base
+        self.cache = cache
+        self.synthesize = synthesize
+        self.voices = list(voices)
+        self.preprocess = preprocess
+        self.concurrency = concurrency
+        self.max_bytes = max_mb * 1024 * 1024
+
+        # 每個擁有者（問答 id 或固定回應名稱）已成功固定在緩存中的 (文字, 語音)，
+        # 以及每個鍵被哪些擁有者使用（不同答案可共用段落）；部分段落未能合成的擁有者記在 _incomplete
+        self._keys_by_qa: Dict[Union[int, str], Set[Tuple[str, str]]] = {}
+        self._owners: Dict[Tuple[str, str], Set[Union[int, str]]] = defaultdict(set)
+        self._incomplete: Set[Union[int, str]] = set()
+        self._texts: Dict[str, Optional[str]] = {}  # 固定回應目前的文字
+        self._pending: Dict[Union[int, str], None] = {}  # 保持排隊次序並去重
+        self._full_sync = False  # 由工作協程分頁排入全部問答
+        self._wakeup = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._task: Optional[asyncio.Task] = None
+        self._clips_in_progress = 0
+        self.stats = defaultdict(int)
+        self.last_error: Optional[str] = None
+        self.last_completed: Optional[float] = None
+
+    # ===== 排程 =====
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def schedule(self, qa_id: int):
+        """問答新增、更新、啟用/停用或刪除後調用"""
+        self._pending[qa_id] = None
+        self._wakeup.set()
+
+    def schedule_text(self, name: str, text: Optional[str]):
+        """設定固定回應的文字（None 表示移除其音頻）"""
+        self._texts[name] = text
+        self._pending[name] = None
+        self._wakeup.set()
+
+    def has_audio(self, name: Union[int, str]) -> bool:
+        """所有段落的音頻都已在緩存中"""
+        return name in self._keys_by_qa and name not in self._incomplete
+
+    def schedule_all(self):
+        """要求工作協程排入全部問答（分頁讀取在背景進行，調用方不必等待），用於啟動及批量匯入後"""
+        self._full_sync = True
+        self._wakeup.set()
+
+    async def sync_all(self):
+        """排入所有問答及目前持有音頻的問答（後者已刪除時會被清理）；由工作協程在 schedule_all 後調用"""
+        after_id = 0
+        while True:
+            page = await self.knowledge_base.run_async(self.knowledge_base.list_page, after_id, 500, ["id"])
+            if not page:
+                break
+            for qa in page:
+                self.schedule(qa["id"])
+            after_id = page[-1]["id"]
+        for qa_id in list(self._keys_by_qa):
+            if isinstance(qa_id, int):
+                self.schedule(qa_id)
+
+    async def _run(self):
+        while True:
+            if self._full_sync:
+                self._full_sync = False
+                try:
+                    await self.sync_all()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.stats["errors"] += 1
+                    self.last_error = f"sync_all: {e}"
+                    logger.warning(f"知識庫答案預合成排程失敗: {e}")
+                continue
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            qa_id = next(iter(self._pending))
+            del self._pending[qa_id]
+            try:
+                await self._process(qa_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.stats["errors"] += 1
+                self.last_error = f"qa {qa_id}: {e}"
+                logger.warning(f"知識庫答案預合成失敗 (qa {qa_id}): {e}")
+
+    async def _current_text(self, qa_id: Union[int, str]) -> Optional[str]:
+        if isinstance(qa_id, str):
+            return self._texts.get(qa_id)
+        page = await self.knowledge_base.run_async(self.knowledge_base.list_page, qa_id - 1, 1,
+                                                   ["id", "answer", "enabled"])
+        qa = page[0] if page and page[0]["id"] == qa_id else None
+        return qa["answer"] if qa is not None and qa["enabled"] else None
+
+    async def _process(self, qa_id: Union[int, str]):
+        answer = await self._current_text(qa_id)
+        wanted = set()
+        if answer:
+            wanted = {(text, voice) for text in client_tts_texts(answer, self.preprocess)
+                      for voice in self.voices}
+
+        previous = self._keys_by_qa.get(qa_id, set())
+        # 舊段落：沒有其他問答使用時從緩存移除
+        for key in previous - wanted:
+            self._release(qa_id, key)
+            await self._remove_if_unowned(key)
+
+        # 只記錄確實已在緩存中的段落；未能合成（超出預算或失敗）的段落下次排程時再試
+        ready = previous & wanted
+        missing = []
+        for key in sorted(wanted - ready):
+            if await self.cache.pin(key[0], key[1], CLIENT_RATE, CLIENT_PITCH):
+                self.stats["already_cached"] += 1
+                ready.add(key)
+            else:
+                missing.append(key)
+        if missing:
+            self._clips_in_progress = len(missing)
+            results = await asyncio.gather(*(self._synthesize_clip(text, voice) for text, voice in missing))
+            self._clips_in_progress = 0
+            ready.update(key for key, ok in zip(missing, results) if ok)
+
+        for key in ready:
+            self._owners[key].add(qa_id)
+        if ready:
+            self._keys_by_qa[qa_id] = ready
+        else:
+            self._keys_by_qa.pop(qa_id, None)
+        if ready == wanted:
+            self._incomplete.discard(qa_id)
+        else:
+            self._incomplete.add(qa_id)
+        self.stats["answers_processed"] += 1
+        self.last_completed = time.time()
+
+    def _release(self, qa_id: Union[int, str], key: Tuple[str, str]):
+        owners = self._owners.get(key)
+        if owners is not None:
+            owners.discard(qa_id)
+
+    async def _remove_if_unowned(self, key: Tuple[str, str]):
+        if key in self._owners and not self._owners[key]:
+            del self._owners[key]
+            await self.cache.remove(key[0], key[1], CLIENT_RATE, CLIENT_PITCH)
+            self.stats["removed"] += 1
+
+    async def _synthesize_clip(self, text: str, voice: str) -> bool:
+        """返回音頻是否已寫入緩存"""
+        async with self._semaphore:
+            try:
+                if self.cache.pinned_bytes() >= self.max_bytes:
+                    self.stats["over_budget"] += 1
+                    return False
+                audio = await self.synthesize(text, voice, CLIENT_RATE, CLIENT_PITCH)
+                if not audio:
+                    raise RuntimeError("no audio generated")
+                await self.cache.put(text, voice, CLIENT_RATE, CLIENT_PITCH, audio, pinned=True)
+                self.stats["synthesized"] += 1
+                return True
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.stats["failed"] += 1
+                self.last_error = f"{voice}: {e}"
+                logger.warning(f"預合成語音失敗 ({voice}, {text[:20]}...): {e}")
+                return False
+            finally:
+                self._clips_in_progress = max(0, self._clips_in_progress - 1)
+
+    def get_stats(self) -> dict:
+        return {
+            "running": self._task is not None and not self._task.done(),
+            "backlog_answers": len(self._pending),
+            "full_sync_pending": self._full_sync,
+            "clips_in_progress": self._clips_in_progress,
+            "answers_with_audio": len(self._keys_by_qa.keys() - self._incomplete),
+            "answers_incomplete": len(self._incomplete),
+            "pinned_clips": len(self._owners),
+            "pinned_mb": round(self.cache.pinned_bytes() / 1024 / 1024, 2),
+            "budget_mb": round(self.max_bytes / 1024 / 1024, 2),
+            "voices": self.voices,
+            "concurrency": self.concurrency,
+            "synthesized": self.stats["synthesized"],
+            "already_cached": self.stats["already_cached"],
+            "failed": self.stats["failed"],
+            "over_budget": self.stats["over_budget"],
+            "removed": self.stats["removed"],
+            "answers_processed": self.stats["answers_processed"],
+            "errors": self.stats["errors"],
+            "last_error": self.last_error,
+            "last_completed": self.last_completed,
+        }
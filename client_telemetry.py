@@ -0,0 +1,215 @@
+"""
+客戶端遙測批量匯入
+前端把事件（首段音頻延遲、句間空隙、錯誤、告警等）累積後一次送出：JSON 陣列、{"events": [...]} 或 NDJSON。
+同一批次的延遲按指標先聚合成 QuantileSketch，再合併進與伺服器端相同的 WindowedSketch；
+每個客戶端（session_id，缺少時用 IP）另保留一份自身的分佈，按 LRU 保留固定數量，記憶體有上限
+"""
+import json
+import math
+import re
+import time
+from collections import OrderedDict, defaultdict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from latency_stats import QuantileSketch, WindowedSketch
+
+_VALID_SESSION = re.compile(r"^[A-Za-z0-9._:-]{1,64}$")
+
+
+class TelemetryFormatError(ValueError):
+    """請求內容無法解析為事件"""
+
+
+def parse_batch(body: bytes) -> Tuple[Dict, List[Dict]]:
+    """返回 (批次資料, 事件)；批次資料可含 session_id 及 sent_at（客戶端送出時間，毫秒）"""
+    text = body.decode("utf-8", errors="replace").strip()
+    if not text:
+        return {}, []
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        data = None
+    if isinstance(data, list):
+        return {}, data
+    if isinstance(data, dict):
+        if isinstance(data.get("events"), list):
+            return {k: v for k, v in data.items() if k != "events"}, data["events"]
+        return {}, [data]
+    # NDJSON：每行一個事件，沒有 type 的行視為批次資料
+    meta, events = {}, []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except json.JSONDecodeError:
+            raise TelemetryFormatError("body must be a JSON array, an object or NDJSON")
+        if not isinstance(item, dict):
+            raise TelemetryFormatError("NDJSON lines must be objects")
+        if "type" in item:
+            events.append(item)
+        else:
+            meta.update(item)
+    return meta, events
+
+
+class _ClientStats:
+    __slots__ = ("first_seen", "last_seen", "batches", "counts", "sketches", "clock_offset_ms")
+
+    def __init__(self, now: float):
+        self.first_seen = now
+        self.last_seen = now
+        self.batches = 0
+        self.counts: Dict[str, int] = defaultdict(int)
+        self.sketches: Dict[str, QuantileSketch] = {}
+        self.clock_offset_ms: Optional[float] = None
+
+
+class ClientTelemetryAggregator:
+    """
+    latency：事件類型 -> 共用的 WindowedSketch（事件帶 value，單位毫秒）；
+    counted：只計數的事件類型（例如 error、tts_alert）；其他類型拒收
+    """
+
+    def __init__(self, latency: Dict[str, WindowedSketch], counted: Iterable[str] = (),
+                 max_clients: int = 1000, max_events: int = 500, max_age: float = 240,
+                 max_value_ms: float = 600000,
+                 on_value: Optional[Callable[[str, float], None]] = None):
+        self.latency = latency
+        self.counted = frozenset(counted)
+        self.max_clients = max_clients
+        self.max_events = max_events
+        # 事件時間只能落在細時間片環（5 分鐘）覆蓋的範圍內，否則會覆寫已重用的時間片
+        self.max_age = max_age
+        self.max_value_ms = max_value_ms
+        self.on_value = on_value
+        self._clients: "OrderedDict[str, _ClientStats]" = OrderedDict()
+        self.counts: Dict[str, int] = defaultdict(int)
+        self.stats = defaultdict(int)
+
+    @property
+    def client_count(self) -> int:
+        return len(self._clients)
+
+    def _client(self, key: str, now: float) -> _ClientStats:
+        client = self._clients.get(key)
+        if client is None:
+            client = self._clients[key] = _ClientStats(now)
+            if len(self._clients) > self.max_clients:
+                self._clients.popitem(last=False)
+                self.stats["clients_evicted"] += 1
+        else:
+            self._clients.move_to_end(key)
+        client.last_seen = now
+        return client
+
+    @staticmethod
+    def client_key(session_id, fallback: str) -> str:
+        if isinstance(session_id, str) and _VALID_SESSION.match(session_id):
+            return session_id
+        return f"ip:{fallback}"
+
+    def ingest(self, events: List[Dict], client_key: str, sent_at: Optional[float] = None,
+               now: Optional[float] = None) -> Dict:
+        """
+        匯入一批事件；ts / sent_at 為客戶端時間（毫秒），以 sent_at 與伺服器時間的差校正時鐘偏差。
+        返回 {"accepted", "rejected", "counts"}
+        """
+        now = time.time() if now is None else now
+        client = self._client(client_key, now)
+        client.batches += 1
+        self.stats["batches"] += 1
+
+        offset_ms = None
+        if isinstance(sent_at, (int, float)) and math.isfinite(sent_at):
+            offset_ms = now * 1000 - sent_at
+            client.clock_offset_ms = round(offset_ms, 1)
+
+        rejected = max(0, len(events) - self.max_events)
+        batch: Dict[str, QuantileSketch] = {}
+        newest: Dict[str, float] = {}
+        counts: Dict[str, int] = defaultdict(int)
+        for event in events[:self.max_events]:
+            kind = event.get("type") if isinstance(event, dict) else None
+            if kind in self.latency:
+                value = event.get("value")
+                if (not isinstance(value, (int, float)) or isinstance(value, bool) or not math.isfinite(value)
+                        or not 0 <= value <= self.max_value_ms):
+                    rejected += 1
+                    continue
+                sketch = batch.get(kind)
+                if sketch is None:
+                    shared = self.latency[kind]
+                    sketch = batch[kind] = QuantileSketch(shared.gamma, shared.min_value)
+                sketch.add(value)
+                newest[kind] = max(newest.get(kind, 0.0), self._event_time(event, offset_ms, now))
+                if self.on_value:
+                    self.on_value(kind, value)
+            elif kind not in self.counted:
+                rejected += 1
+                continue
+            counts[kind] += 1
+
+        # 整批計入最新事件所在的時間片（批次最多相隔一個刷新週期）
+        for kind, sketch in batch.items():
+            self.latency[kind].merge_sketch(sketch, newest[kind])
+            own = client.sketches.get(kind)
+            if own is None:
+                own = client.sketches[kind] = QuantileSketch(sketch.gamma, sketch.min_value)
+            own.merge(sketch)
+        for kind, count in counts.items():
+            client.counts[kind] += count
+            self.counts[kind] += count
+        accepted = sum(counts.values())
+        self.stats["events"] += accepted
+        self.stats["rejected"] += rejected
+        return {"accepted": accepted, "rejected": rejected, "counts": dict(counts)}
+
+    def _event_time(self, event: Dict, offset_ms: Optional[float], now: float) -> float:
+        ts = event.get("ts")
+        if not isinstance(ts, (int, float)) or not math.isfinite(ts):
+            return now
+        when = (ts + (offset_ms or 0.0)) / 1000
+        if when < now - self.max_age:
+            self.stats["late_events"] += 1
+            return now - self.max_age
+        return min(when, now)
+
+    def get_client(self, key: str) -> Optional[Dict]:
+        client = self._clients.get(key)
+        if client is None:
+            return None
+        return {
+            "client": key,
+            "first_seen": round(client.first_seen, 3),
+            "last_seen": round(client.last_seen, 3),
+            "batches": client.batches,
+            "clock_offset_ms": client.clock_offset_ms,
+            "counts": dict(client.counts),
+            **{kind: sketch.summary() for kind, sketch in client.sketches.items()},
+        }
+
+    def slowest_clients(self, kind: str, n: int = 5, min_samples: int = 5) -> List[Dict]:
+        """按某延遲指標的 p95 排列最慢的客戶端"""
+        ranked = []
+        for key, client in self._clients.items():
+            sketch = client.sketches.get(kind)
+            if sketch is not None and sketch.count >= min_samples:
+                ranked.append((sketch.quantile(0.95), key))
+        ranked.sort(reverse=True)
+        return [{"client": key, "p95": round(p95, 2)} for p95, key in ranked[:n]]
+
+    def get_stats(self, window: str = "1h") -> Dict:
+        return {
+            "clients": self.client_count,
+            "max_clients": self.max_clients,
+            "clients_evicted": self.stats["clients_evicted"],
+            "batches": self.stats["batches"],
+            "events": self.stats["events"],
+            "rejected": self.stats["rejected"],
+            "late_events": self.stats["late_events"],
+            "counts": dict(self.counts),
+            "latency": {kind: sketch.summary(window) for kind, sketch in self.latency.items()},
+            "slowest_clients": {kind: self.slowest_clients(kind) for kind in self.latency},
+        }
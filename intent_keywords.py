@@ -0,0 +1,91 @@
+"""
+意圖關鍵詞
+固定意圖（天氣、日期、按摩指令）的關鍵詞及 Aho-Corasick 自動機；不依賴知識庫，天氣服務等低層模組亦可直接匯入
+"""
+from collections import deque
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+# 天氣相關關鍵詞
+WEATHER_KEYWORDS = ["天氣", "溫度", "幾度", "熱唔熱", "凍唔凍", "落雨", "下雨", "晴天", "陰天"]
+# 日期詞
+TOMORROW_WORDS = ["明天", "聽日", "明日"]
+TODAY_WORDS = ["今天", "今日", "而家", "現在"]
+# 按摩指令：動作 + 部位同時出現才視為指令（交由 LLM 輸出 [指令分類]）
+MASSAGE_ACTIONS = ["按摩", "推拿", "揉捏", "敲打", "指壓", "推油"]
+MASSAGE_BODY_PARTS = ["肩膀", "背部", "腰部", "腿部", "頸部", "手臂"]
+
+
+class KeywordAutomaton:
+    """Aho-Corasick 自動機：一次線性掃描找出所有關鍵詞及其標籤"""
+
+    def __init__(self, keywords: Iterable[Tuple[str, str]] = ()):
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [set()]
+        for keyword, tag in keywords:
+            self.add(keyword, tag)
+        self.build()
+
+    def add(self, keyword: str, tag: str):
+        if not keyword:
+            return
+        state = 0
+        for ch in keyword:
+            nxt = self._goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(set())
+            state = nxt
+        self._output[state].add((tag, keyword))
+
+    def build(self):
+        """以 BFS 計算失敗指針並合併輸出"""
+        queue = deque(self._goto[0].values())
+        for state in queue:
+            self._fail[state] = 0
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0)
+                self._output[nxt] |= self._output[self._fail[nxt]]
+
+    def scan(self, text: str) -> Dict[str, Set[str]]:
+        """返回 {標籤: 命中的關鍵詞}"""
+        goto, fail, output = self._goto, self._fail, self._output
+        matches: Dict[str, Set[str]] = {}
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if output[state]:
+                for tag, keyword in output[state]:
+                    matches.setdefault(tag, set()).add(keyword)
+        return matches
+
+
+# 固定意圖（天氣、日期、按摩指令）的自動機只需編譯一次
+FIXED_AUTOMATON = KeywordAutomaton(
+    [(w, "weather") for w in WEATHER_KEYWORDS]
+    + [(w, "tomorrow") for w in TOMORROW_WORDS]
+    + [(w, "today") for w in TODAY_WORDS]
+    + [(w, "massage_action") for w in MASSAGE_ACTIONS]
+    + [(w, "massage_body_part") for w in MASSAGE_BODY_PARTS]
+)
+
+
+def weather_intent(question: str, matches: Optional[Dict[str, Set[str]]] = None) -> Optional[Dict]:
+    """從問題中提取天氣查詢意圖"""
+    if matches is None:
+        matches = FIXED_AUTOMATON.scan(question)
+    if "weather" not in matches:
+        return None
+    # 明天優先，其餘（包括今天）預設查詢今天
+    return {"type": "weather", "date": "tomorrow" if "tomorrow" in matches else "today"}
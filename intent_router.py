@@ -0,0 +1,146 @@
+"""
+意圖路由
+以預編譯的 Aho-Corasick 多模式匹配器一次掃描問題，判斷應交由天氣、知識庫還是 LLM 處理
+"""
+import asyncio
+import logging
+import re
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Set
+
+import synonyms_config
+from intent_keywords import FIXED_AUTOMATON, KeywordAutomaton, weather_intent
+from knowledge_base import MATCH_THRESHOLD, extract_semantic_keywords, normalize_question
+
+logger = logging.getLogger(__name__)
+
+# 前端會把用戶輸入包在系統提示詞中：「...用戶: <輸入>\n小護: 」
+_USER_TURN_RE = re.compile(r'用戶[:：]\s*(.*?)\s*(?:\n小護[:：]|$)', re.DOTALL)
+
+
+def extract_user_utterance(prompt: str) -> str:
+    """取出最後一輪用戶輸入；沒有對話格式時返回原文"""
+    turns = _USER_TURN_RE.findall(prompt)
+    return turns[-1] if turns else prompt
+
+
+@dataclass
+class Intent:
+    weather: Optional[Dict] = None
+    massage_command: bool = False
+    knowledge: bool = False  # find_answer 可能命中
+    matches: Dict[str, Set[str]] = field(default_factory=dict)
+
+    @property
+    def route(self) -> str:
+        """分派順序：天氣 → 按摩指令（交 LLM）→ 知識庫 → LLM"""
+        if self.weather:
+            return "weather"
+        if self.massage_command:
+            return "massage_command"
+        if self.knowledge:
+            return "knowledge"
+        return "llm"
+
+
+class IntentRouter:
+    """
+    在 LLM 之前分派問題
+
+    知識庫關鍵詞來自 knowledge_base.get_match_keywords()，knowledge_base.version 或同義詞表變化時才重新編譯。
+    在事件循環中，重新編譯交給背景線程（同一時間只有一個），完成前舊的自動機可能漏掉新問答，
+    故一律交由 find_answer（總是使用最新索引）判斷；沒有事件循環時（腳本、離線評估）直接重建
+    """
+
+    def __init__(self, knowledge_base=None):
+        self._knowledge_base = knowledge_base
+        self._kb_version = None
+        self._kb_keywords = set()
+        self._kb_automaton = KeywordAutomaton()
+        self._refresh_task: Optional[asyncio.Task] = None
+        self.rebuilds = 0
+
+    def _is_stale(self) -> bool:
+        kb = self._knowledge_base
+        if kb is None:
+            return False
+        synonyms_outdated = getattr(kb, "synonyms_outdated", None)
+        return kb.version != self._kb_version or bool(synonyms_outdated and synonyms_outdated())
+
+    def _build_knowledge(self):
+        """重建知識庫詞表及自動機（耗時，可在任何線程執行），返回 (version, 關鍵詞, 自動機)"""
+        kb = self._knowledge_base
+        if hasattr(kb, "sync_synonyms"):
+            kb.sync_synonyms()  # 同義詞更新會令知識庫重建索引並遞增 version
+        version = kb.version
+        keywords = kb.get_match_keywords()
+        # 用戶詞語展開後與關鍵詞有交集才可能命中：關鍵詞本身及與之重疊的同義詞組
+        vocabulary = set(keywords)
+        for group in synonyms_config.get_table().groups:
+            if not group.isdisjoint(keywords):
+                vocabulary.update(group)
+        return version, keywords, KeywordAutomaton((word, "knowledge") for word in vocabulary)
+
+    def _apply(self, built):
+        self._kb_version, self._kb_keywords, self._kb_automaton = built
+        self.rebuilds += 1
+
+    async def _refresh_in_background(self):
+        # 重建期間再有寫入時接著再建，直至追上；失敗時保留舊自動機，下次分類再試
+        try:
+            while self._is_stale():
+                self._apply(await asyncio.to_thread(self._build_knowledge))
+        except Exception as e:
+            logger.warning(f"意圖路由詞表重建失敗: {e}")
+
+    def refresh(self) -> Optional[asyncio.Task]:
+        """詞表過期時啟動（或沿用進行中的）背景重建；可 await 返回的任務等待完成（例如啟動時預熱）"""
+        if self._refresh_task is None or self._refresh_task.done():
+            if not self._is_stale():
+                return None
+            self._refresh_task = asyncio.get_running_loop().create_task(self._refresh_in_background())
+        return self._refresh_task
+
+    def _refresh_knowledge(self) -> bool:
+        """返回詞表是否仍在背景重建（落後於知識庫）"""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            if self._is_stale():
+                self._apply(self._build_knowledge())
+            return False
+        return self.refresh() is not None
+
+    def _may_match_knowledge(self, normalized: str, kb_matches: Dict[str, Set[str]]) -> bool:
+        """Jaccard 上界：交集不超過用戶關鍵詞與全庫關鍵詞的交集，低於閾值即不可能命中"""
+        if not kb_matches:
+            return False
+        user_keywords = extract_semantic_keywords(normalized)
+        if not user_keywords:
+            return False
+        return len(user_keywords & self._kb_keywords) >= MATCH_THRESHOLD * len(user_keywords)
+
+    def _may_match_fts(self, prompt: str) -> bool:
+        kb = self._knowledge_base
+        return kb is not None and getattr(kb, "fts_enabled", False) and kb.may_match_fts(prompt)
+
+    def classify(self, prompt: str) -> Intent:
+        matches = FIXED_AUTOMATON.scan(prompt)
+
+        # 系統提示詞本身提及按摩，指令只看用戶輸入
+        utterance = extract_user_utterance(prompt)
+        utterance_matches = matches if utterance is prompt else FIXED_AUTOMATON.scan(utterance)
+
+        # 知識庫以標準化後的問題匹配
+        rebuilding = self._refresh_knowledge()
+        normalized = normalize_question(prompt)
+        kb_matches = self._kb_automaton.scan(normalized)
+        matches.update(kb_matches)
+
+        return Intent(
+            weather=weather_intent(prompt, matches),
+            massage_command="massage_action" in utterance_matches and "massage_body_part" in utterance_matches,
+            knowledge=(rebuilding or self._may_match_knowledge(normalized, kb_matches)
+                       or self._may_match_fts(prompt)),
+            matches=matches
+        )
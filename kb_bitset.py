@@ -0,0 +1,114 @@
+"""
+知識庫向量化匹配
+把每條問題表示為概念詞表上的壓縮位集（uint64），以 AND / OR 的 popcount 一次過計算所有條目的 Jaccard 分數
+"""
+from typing import Dict, Iterable, List, Sequence, Set, Tuple
+
+import numpy as np
+
+import synonyms_config
+
+if hasattr(np, "bitwise_count"):
+    _popcount = np.bitwise_count
+else:
+    _POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def _popcount(bits: np.ndarray) -> np.ndarray:
+        as_bytes = bits.view(np.uint8).reshape(bits.shape + (8,))
+        return _POPCOUNT_TABLE[as_bytes].sum(axis=-1, dtype=np.uint8)
+
+# 批量評分時每批的問題數，限制 (批量 × 條目 × 位集字數) 的中間矩陣大小
+BATCH_CHUNK = 64
+
+
+class BitsetMatcher:
+    """
+    不可變的位集索引：詞表 = SYNONYM_GROUPS 中所有詞（同組相鄰）+ 已存問題中的其他詞
+
+    rows 為 (id, 關鍵詞集合) 列表，順序即同分時的優先次序；
+    同一 id 可有多行（別名問法），必須相鄰，該 id 的分數取其中最高者
+    """
+
+    def __init__(self, rows: Sequence[Tuple[int, Set[str]]]):
+        vocabulary: Dict[str, int] = {}
+        for group in synonyms_config.get_table().groups:  # 已排序
+            for word in sorted(group):
+                vocabulary.setdefault(word, len(vocabulary))
+        for _, keywords in rows:
+            for word in sorted(keywords):
+                vocabulary.setdefault(word, len(vocabulary))
+
+        self.vocabulary = vocabulary
+        row_ids = np.array([qa_id for qa_id, _ in rows], dtype=np.int64)
+        starts = np.flatnonzero(np.r_[True, row_ids[1:] != row_ids[:-1]]) if len(rows) else np.zeros(0, np.intp)
+        self.ids = row_ids[starts]
+        self._group_starts = starts if len(starts) < len(rows) else None
+        self.n_words = max(1, (len(vocabulary) + 63) // 64)
+        self.bits = np.zeros((len(rows), self.n_words), dtype=np.uint64)
+        row_index = [row for row, (_, keywords) in enumerate(rows) for _ in keywords]
+        positions = np.array([vocabulary[word] for _, keywords in rows for word in keywords], dtype=np.uint64)
+        if len(positions):
+            np.bitwise_or.at(self.bits, (np.array(row_index), (positions >> np.uint64(6)).astype(np.intp)),
+                             np.uint64(1) << (positions & np.uint64(63)))
+        self.sizes = _popcount(self.bits).sum(axis=1, dtype=np.int32)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _encode(self, keywords: Iterable[str]) -> Tuple[np.ndarray, int]:
+        """返回 (位集, 關鍵詞總數)；不在詞表中的詞只計入總數（不可能與任何條目相交）"""
+        bits = np.zeros(self.n_words, dtype=np.uint64)
+        size = 0
+        for word in keywords:
+            size += 1
+            position = self.vocabulary.get(word)
+            if position is not None:
+                bits[position >> 6] |= np.uint64(1) << np.uint64(position & 63)
+        return bits, size
+
+    def _scores(self, queries: np.ndarray, sizes: np.ndarray) -> np.ndarray:
+        """queries: (m, n_words)，返回 (m, 條目數) 的 Jaccard 分數"""
+        # 問題只有少量位元，只需計算問題非零的字
+        columns = np.flatnonzero(queries.any(axis=0))
+        intersection = _popcount(queries[:, None, columns] & self.bits[None, :, columns]).sum(axis=2, dtype=np.int32)
+        union = sizes[:, None] + self.sizes[None, :] - intersection
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scores = np.where(union > 0, intersection / union, 0.0)
+        if self._group_starts is not None:
+            scores = np.maximum.reduceat(scores, self._group_starts, axis=1)
+        return scores
+
+    def _top_k(self, scores: np.ndarray, top_k: int, min_score: float) -> List[Tuple[int, float]]:
+        k = min(top_k, len(scores))
+        if k <= 0:
+            return []
+        if k < len(scores):
+            candidates = np.argpartition(-scores, k - 1)[:k]
+            # argpartition 不保證同分邊界上取較早的條目，補上所有與第 k 名同分者
+            kth = scores[candidates].min()
+            candidates = np.union1d(candidates, np.flatnonzero(scores == kth))
+        else:
+            candidates = np.arange(len(scores))
+        # 分數降序，同分時按行序（與逐行掃描一致）
+        order = candidates[np.lexsort((candidates, -scores[candidates]))][:k]
+        return [(int(self.ids[row]), float(scores[row])) for row in order
+                if scores[row] > 0 and scores[row] >= min_score]
+
+    def top_k(self, keywords: Set[str], top_k: int = 5, min_score: float = 0.0) -> List[Tuple[int, float]]:
+        """返回 [(id, 分數)]，按分數由高至低"""
+        return self.batch_top_k([keywords], top_k, min_score)[0]
+
+    def batch_top_k(self, keyword_sets: Sequence[Set[str]], top_k: int = 5,
+                    min_score: float = 0.0) -> List[List[Tuple[int, float]]]:
+        """一次為多個問題評分"""
+        if not len(self) or not keyword_sets:
+            return [[] for _ in keyword_sets]
+        results = []
+        for start in range(0, len(keyword_sets), BATCH_CHUNK):
+            chunk = keyword_sets[start:start + BATCH_CHUNK]
+            encoded = [self._encode(keywords) for keywords in chunk]
+            queries = np.stack([bits for bits, _ in encoded])
+            sizes = np.array([size for _, size in encoded], dtype=np.int32)
+            scores = self._scores(queries, sizes)
+            results.extend(self._top_k(row_scores, top_k, min_score) for row_scores in scores)
+        return results
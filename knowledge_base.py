@@ -1,14 +1,222 @@
+import functools
+import json
+import logging
+import re
 import sqlite3
-from typing import List, Dict, Any, Optional
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from typing import List, Dict, Any, Hashable, Iterable, Optional, Set, Tuple
+
+import synonyms_config
+from kb_bitset import BitsetMatcher
+from segmenter import segmenter
+from sqlite_worker import SQLiteWorker
+
+logger = logging.getLogger(__name__)
+
+# 問題標準化：移除標點和語氣詞
+_PUNCTUATION_RE = re.compile(r'[？?！!。.,，、；;：:()（）\s]')
+_PARTICLE_RE = re.compile(r'(在|的|是|了|嗎|咩|呢|啊|呀|吧|咯|有|沒有)')
+# 2-4 字的中文詞
+_WORD_RE = re.compile(r'[\u4e00-\u9fff]{2,4}')
+_CJK_WORD_RE = re.compile(r'[\u4e00-\u9fff]{2,}')
+
+# find_answer 的最低 Jaccard 相似度
+MATCH_THRESHOLD = 0.4
+# 關鍵詞匹配失敗時，FTS5 trigram 召回的候選數及重排的最低分數
+FTS_CANDIDATES = 20
+FTS_MATCH_THRESHOLD = 0.5
+# find_answer 結果緩存（標準化問題 -> 答案或未命中）的最大條目數
+ANSWER_CACHE_SIZE = 2048
+# 單次 FTS 查詢最多使用的 trigram 數
+FTS_MAX_TRIGRAMS = 64
+# 批量匯入每批寫入的記錄數；匯出每頁行數
+IMPORT_CHUNK = 500
+EXPORT_PAGE = 500
+# 每次 IN 查詢的問法數（SQLite 參數數量有上限）
+LOOKUP_CHUNK = 400
+# 列表可選的欄位（fields 投影）
+LIST_FIELDS = ('id', 'question', 'questions', 'answer', 'enabled', 'category')
+DEFAULT_CATEGORY = '未分類'
+
+
+def normalize_question(q: str) -> str:
+    """標準化問題"""
+    q = _PUNCTUATION_RE.sub('', q)
+    q = _PARTICLE_RE.sub('', q)
+    return q.lower()
+
+
+def extract_words(text: str) -> List[str]:
+    """
+    提取中文詞：jieba 就緒時取詞典中的詞，其餘未識別的片段（被拆成單字）仍按 2-4 字正則切分；
+    未就緒時全部使用正則
+    """
+    tokenizer = segmenter.active()
+    if tokenizer is None:
+        return _WORD_RE.findall(text)
+    words, unknown = [], []
+    for token in tokenizer.cut(text, HMM=False):
+        if _CJK_WORD_RE.fullmatch(token):
+            if unknown:
+                words.extend(_WORD_RE.findall(''.join(unknown)))
+                unknown = []
+            words.append(token)
+        else:
+            unknown.append(token)
+    if unknown:
+        words.extend(_WORD_RE.findall(''.join(unknown)))
+    return words
+
+
+def extract_semantic_keywords(text: str) -> Set[str]:
+    """提取語義關鍵詞（含同義詞）"""
+    semantic_words = set()
+    for word in extract_words(text):
+        semantic_words.update(synonyms_config.get_word_synonyms(word))
+    return semantic_words
+
+
+def concept_counts(keywords: Set[str]) -> Dict[Hashable, int]:
+    """把關鍵詞歸入概念（所屬同義詞組；不在詞組中的詞自成一個概念），返回各概念的詞數"""
+    counts = defaultdict(int)
+    for word in keywords:
+        group = synonyms_config.get_word_synonyms(word)
+        counts[group if word in group and len(group) > 1 else word] += 1
+    return dict(counts)
+
+
+_canonical_cache = {"version": None, "pattern": None, "tokens": None}
+
+
+def canonicalize(text: str) -> str:
+    """把同義詞替換為所屬詞組的代表字元（私用區字元），令同義改寫得到相同的字元序列"""
+    table = synonyms_config.get_table()
+    cache = _canonical_cache
+    if cache["version"] != table.version:
+        tokens = {word: chr(0xE000 + group_id) for word, group_id in table.group_ids.items()}
+        words = sorted(tokens, key=len, reverse=True)  # 長詞優先
+        cache.update(version=table.version, tokens=tokens,
+                     pattern=re.compile('|'.join(map(re.escape, words))) if words else None)
+    if cache["pattern"] is None:
+        return text
+    return cache["pattern"].sub(lambda m: cache["tokens"][m.group(0)], text)
+
+
+def char_bigrams(text: str) -> Set[str]:
+    if len(text) < 2:
+        return {text} if text else set()
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+def fts_query(normalized: str) -> Optional[str]:
+    """以問題的 trigram 組成 FTS5 OR 查詢；不足三字時返回 None"""
+    trigrams = list(dict.fromkeys(normalized[i:i + 3] for i in range(len(normalized) - 2)))
+    if not trigrams:
+        return None
+    return ' OR '.join('"' + t.replace('"', '""') + '"' for t in trigrams[:FTS_MAX_TRIGRAMS])
+
+
+class IndexedQA:
+    """預先計算的問法條目（主問題或別名），同一問答的所有問法共用答案"""
+    __slots__ = ('qa_id', 'question', 'answer', 'enabled', 'keywords', 'concepts', 'bigrams')
+
+    def __init__(self, qa_id: int, question: str, answer: str, enabled: bool):
+        self.qa_id = qa_id
+        self.question = question
+        self.answer = answer
+        self.enabled = bool(enabled)
+        self.keywords = frozenset(extract_semantic_keywords(normalize_question(question)))
+        self.concepts = concept_counts(self.keywords)
+        self.bigrams = frozenset(char_bigrams(canonicalize(normalize_question(question))))
+
+
+def _dedupe_questions(questions: Iterable[str]) -> List[str]:
+    """去除空白及重複問法，保留次序"""
+    return list(dict.fromkeys(q.strip() for q in questions if q and q.strip()))
+
+
+def parse_import_record(line: str, line_no: int) -> Optional[Dict[str, Any]]:
+    """
+    解析一行 JSONL：{"questions": [...] 或 "question": "...", "answer": "...", "category": "...", "enabled": true}
+    空行返回 None；格式錯誤拋出 ValueError
+    """
+    if not line.strip():
+        return None
+    try:
+        data = json.loads(line)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Line {line_no}: invalid JSON ({e.msg})")
+    if not isinstance(data, dict):
+        raise ValueError(f"Line {line_no}: expected a JSON object")
+    questions = data.get("questions")
+    if questions is None:
+        questions = [data.get("question")]
+    if not isinstance(questions, list) or not all(isinstance(q, str) or q is None for q in questions):
+        raise ValueError(f"Line {line_no}: 'questions' must be a list of strings")
+    questions = _dedupe_questions(questions)
+    answer = data.get("answer")
+    if not questions or not isinstance(answer, str) or not answer.strip():
+        raise ValueError(f"Line {line_no}: a question and an answer are required")
+    return {
+        "questions": questions,
+        "answer": answer,
+        "category": str(data.get("category") or DEFAULT_CATEGORY),
+        "enabled": bool(data.get("enabled", True)),
+    }
+
+
+def _db_call(method):
+    """整個方法在 SQLite 專用線程上執行"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        return self._db.run(lambda _conn: method(self, *args, **kwargs))
+    return wrapper
+
 
 class KnowledgeBase:
     def __init__(self, db_path: str = 'knowledge_base.db'):
         self.db_path = db_path
+        self._db = SQLiteWorker(db_path)
+        # 每次寫入遞增，供下游索引/緩存判斷是否失效
+        self.version = 0
         self._create_table()
+        # 記憶體索引：(問答 id, 別名 id；主問題為 0) -> IndexedQA，同分時按鍵排序（與原先逐行掃描的先後次序一致）
+        self._index: Dict[Tuple[int, int], IndexedQA] = {}
+        self._keys_by_qa: Dict[int, List[Tuple[int, int]]] = {}
+        # 倒排索引：概念 -> 含該概念的已啟用問法
+        self._postings: Dict[Hashable, Set[Tuple[int, int]]] = defaultdict(set)
+        self._index_lock = threading.Lock()
+        # 向量化位集索引，按 version 延遲重建
+        self._bitset = None
+        self._bitset_version = None
+        # FTS 預先判斷用：已啟用問法的 bigram 引用計數及各 bigram 數的條目數，隨索引增量更新
+        self._bigram_counts: Dict[str, int] = {}
+        self._bigram_sizes: Dict[int, int] = {}
+        self._max_bigrams = 0
+        # 建立索引時的同義詞表版本；同義詞更新後關鍵詞展開及概念都要重算
+        self._synonyms_version = None
+        # find_answer 結果的 LRU 緩存（含未命中），version 變化時整個清空
+        self._answer_cache: "OrderedDict[str, Optional[str]]" = OrderedDict()
+        self._answer_cache_version = None
+        self._answer_cache_lock = threading.Lock()
+        self._answer_cache_hits = 0
+        self._answer_cache_misses = 0
+        self._load_index()
+
+    def _get_conn(self) -> sqlite3.Connection:
+        """長期連接；只可在 SQLite 專用線程上使用（見 _db_call）"""
+        return self._db._conn
 
-    def _get_conn(self):
-        return sqlite3.connect(self.db_path)
+    async def run_async(self, method, *args):
+        """在 SQLite 專用線程上執行方法，供異步端點使用"""
+        return await self._db.run_async(lambda _conn: method(*args))
 
+    def close(self):
+        self._db.close()
+
+    @_db_call
     def _create_table(self):
         with self._get_conn() as conn:
             cursor = conn.cursor()
@@ -17,126 +225,571 @@ class KnowledgeBase:
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     question TEXT NOT NULL UNIQUE,
                     answer TEXT NOT NULL,
-                    enabled BOOLEAN NOT NULL DEFAULT TRUE
+                    enabled BOOLEAN NOT NULL DEFAULT TRUE,
+                    category TEXT NOT NULL DEFAULT '未分類'
                 )
             ''')
+            columns = {row[1] for row in cursor.execute('PRAGMA table_info(qa_pairs)')}
+            if 'category' not in columns:
+                cursor.execute("ALTER TABLE qa_pairs ADD COLUMN category TEXT NOT NULL DEFAULT '未分類'")
+            # 同一答案的其他問法
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS qa_aliases (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    qa_id INTEGER NOT NULL REFERENCES qa_pairs(id) ON DELETE CASCADE,
+                    question TEXT NOT NULL UNIQUE
+                )
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_qa_aliases_qa_id ON qa_aliases(qa_id)')
             conn.commit()
+        self.fts_enabled = self._create_fts()
+
+    def _create_fts(self) -> bool:
+        """建立主問題及別名的 trigram FTS5 索引及同步觸發器；SQLite 不支援時返回 False"""
+        conn = self._get_conn()
+        try:
+            with conn:
+                for table, fts in (('qa_pairs', 'qa_fts'), ('qa_aliases', 'qa_alias_fts')):
+                    exists = conn.execute(
+                        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (fts,)).fetchone()
+                    conn.execute(f'''
+                        CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(
+                            question, content='{table}', content_rowid='id', tokenize='trigram'
+                        )
+                    ''')
+                    conn.execute(self._fts_insert_trigger(table, fts))
+                    conn.execute(f'''
+                        CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {table} BEGIN
+                            INSERT INTO {fts}({fts}, rowid, question) VALUES ('delete', old.id, old.question);
+                        END
+                    ''')
+                    conn.execute(f'''
+                        CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF question ON {table} BEGIN
+                            INSERT INTO {fts}({fts}, rowid, question) VALUES ('delete', old.id, old.question);
+                            INSERT INTO {fts}(rowid, question) VALUES (new.id, new.question);
+                        END
+                    ''')
+                    if not exists:
+                        # 舊資料庫：為已有問題建立索引
+                        conn.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+            return True
+        except sqlite3.OperationalError as e:
+            logger.warning(f"FTS5 trigram 不可用，停用全文召回: {e}")
+            return False
+
+    @staticmethod
+    def _fts_insert_trigger(table: str, fts: str) -> str:
+        return f'''
+            CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {table} BEGIN
+                INSERT INTO {fts}(rowid, question) VALUES (new.id, new.question);
+            END
+        '''
+
+    # ===== 記憶體索引 =====
+    @_db_call
+    def enable_segmenter(self) -> bool:
+        """jieba 載入後以新分詞重建索引，並在替換索引的同時啟用，避免查詢與索引使用不同分詞"""
+        tokenizer = segmenter.load()
+        if tokenizer is None:
+            return False
+        with segmenter.using(tokenizer):
+            self._load_index(on_swap=segmenter.activate)
+        self.version += 1
+        return True
+
+    def synonyms_outdated(self) -> bool:
+        """同義詞表已更新但索引尚未重建"""
+        return self._synonyms_version != synonyms_config.get_version()
+
+    def sync_synonyms(self) -> bool:
+        """同義詞表已更新時重建索引並遞增 version；返回是否重建"""
+        if self._synonyms_version == synonyms_config.get_version():
+            return False
+        return self._reload_synonyms()
+
+    @_db_call
+    def _reload_synonyms(self) -> bool:
+        if self._synonyms_version == synonyms_config.get_version():
+            return False  # 已由其他調用重建
+        segmenter.update_user_words()
+        self._load_index()
+        self.version += 1
+        return True
+
+    @_db_call
+    def _load_index(self, on_swap=None):
+        synonyms_version = synonyms_config.get_version()
+        conn = self._get_conn()
+        rows = conn.execute('SELECT id, question, answer, enabled FROM qa_pairs ORDER BY id').fetchall()
+        aliases = defaultdict(list)
+        for alias_id, qa_id, question in conn.execute('SELECT id, qa_id, question FROM qa_aliases ORDER BY id'):
+            aliases[qa_id].append((alias_id, question))
+        # 分詞等耗時計算在鎖外完成
+        prepared = [(qa_id, self._build_entries(qa_id, answer, enabled, [(0, question)] + aliases.get(qa_id, [])))
+                    for qa_id, question, answer, enabled in rows]
+        with self._index_lock:
+            self._index, self._keys_by_qa, self._postings = {}, {}, defaultdict(set)
+            self._bigram_counts, self._bigram_sizes, self._max_bigrams = {}, {}, 0
+            for qa_id, entries in prepared:
+                self._index_put_locked(qa_id, entries)
+            self._synonyms_version = synonyms_version
+            if on_swap:
+                on_swap()
 
-    def add_qa_pair(self, question: str, answer: str) -> Dict[str, Any]:
+    @staticmethod
+    def _build_entries(qa_id: int, answer: str, enabled: bool,
+                       phrasings: List[Tuple[int, str]]) -> List[Tuple[int, IndexedQA]]:
+        return [(alias_id, IndexedQA(qa_id, question, answer, enabled)) for alias_id, question in phrasings]
+
+    def _index_put_locked(self, qa_id: int, entries: List[Tuple[int, IndexedQA]]):
+        self._index_remove_locked(qa_id)
+        keys = []
+        for alias_id, entry in entries:
+            key = (qa_id, alias_id)
+            self._index[key] = entry
+            keys.append(key)
+            if entry.enabled:
+                for concept in entry.concepts:
+                    self._postings[concept].add(key)
+                self._count_bigrams_locked(entry, 1)
+        self._keys_by_qa[qa_id] = keys
+
+    def _index_remove_locked(self, qa_id: int):
+        for key in self._keys_by_qa.pop(qa_id, ()):
+            entry = self._index.pop(key, None)
+            if entry is None or not entry.enabled:
+                continue
+            for concept in entry.concepts:
+                posting = self._postings.get(concept)
+                if posting is not None:
+                    posting.discard(key)
+                    if not posting:
+                        del self._postings[concept]
+            self._count_bigrams_locked(entry, -1)
+
+    def _count_bigrams_locked(self, entry: IndexedQA, delta: int):
+        counts = self._bigram_counts
+        for bigram in entry.bigrams:
+            count = counts.get(bigram, 0) + delta
+            if count:
+                counts[bigram] = count
+            else:
+                del counts[bigram]
+        size = len(entry.bigrams)
+        remaining = self._bigram_sizes.get(size, 0) + delta
+        if remaining:
+            self._bigram_sizes[size] = remaining
+        else:
+            del self._bigram_sizes[size]
+        if delta > 0:
+            self._max_bigrams = max(self._max_bigrams, size)
+        elif size == self._max_bigrams and not remaining:
+            self._max_bigrams = max(self._bigram_sizes, default=0)
+
+    def _refresh_qa(self, qa_id: int) -> Optional[Dict[str, Any]]:
+        """從資料庫讀取一條問答並更新索引；已不存在時從索引移除"""
+        qa = self._fetch_qa(qa_id)
+        entries = None
+        if qa is not None:
+            phrasings = [(0, qa["question"])] + qa.pop("_aliases")
+            entries = self._build_entries(qa_id, qa["answer"], qa["enabled"], phrasings)
+        with self._index_lock:
+            if entries is None:
+                self._index_remove_locked(qa_id)
+            else:
+                self._index_put_locked(qa_id, entries)
+        self.version += 1
+        return qa
+
+    def _fetch_qa(self, qa_id: int) -> Optional[Dict[str, Any]]:
+        conn = self._get_conn()
+        cursor = conn.cursor()
+        cursor.row_factory = sqlite3.Row
+        row = cursor.execute('SELECT id, question, answer, enabled, category FROM qa_pairs WHERE id = ?',
+                             (qa_id,)).fetchone()
+        if row is None:
+            return None
+        aliases = conn.execute('SELECT id, question FROM qa_aliases WHERE qa_id = ? ORDER BY id', (qa_id,)).fetchall()
+        qa = dict(row)
+        qa["questions"] = [qa["question"]] + [question for _, question in aliases]
+        qa["_aliases"] = aliases
+        return qa
+
+    def _taken_questions(self, conn: sqlite3.Connection, questions: Iterable[str],
+                         exclude_id: Optional[int] = None) -> set:
+        """返回已是其他問答主問題或別名的問法（exclude_id 為正在更新的問答）"""
+        questions = list(questions)
+        taken = set()
+        for i in range(0, len(questions), LOOKUP_CHUNK):
+            part = questions[i:i + LOOKUP_CHUNK]
+            marks = ','.join('?' * len(part))
+            taken.update(row[0] for row in conn.execute(
+                f'SELECT question FROM qa_pairs WHERE question IN ({marks}) AND id IS NOT ? '
+                f'UNION SELECT question FROM qa_aliases WHERE question IN ({marks}) AND qa_id IS NOT ?',
+                part + [exclude_id] + part + [exclude_id]))
+        return taken
+
+    def _check_questions_free(self, conn: sqlite3.Connection, questions: List[str],
+                              exclude_id: Optional[int] = None):
+        taken = self._taken_questions(conn, questions, exclude_id)
+        for question in questions:
+            if question in taken:
+                raise ValueError(f"Question '{question}' already exists.")
+
+    # ===== 讀寫 =====
+    @_db_call
+    def add_qa_pair(self, question: str, answer: str, category: str = DEFAULT_CATEGORY,
+                    aliases: Iterable[str] = ()) -> Dict[str, Any]:
+        aliases = [q for q in _dedupe_questions(aliases) if q != question]
         with self._get_conn() as conn:
             cursor = conn.cursor()
+            # 主問題與別名共用同一命名空間：任何問法都不可與其他問答的主問題或別名重複
+            self._check_questions_free(conn, [question] + aliases)
             try:
-                cursor.execute('INSERT INTO qa_pairs (question, answer) VALUES (?, ?)', (question, answer))
-                conn.commit()
-                return {"id": cursor.lastrowid, "question": question, "answer": answer, "enabled": True}
+                cursor.execute('INSERT INTO qa_pairs (question, answer, category) VALUES (?, ?, ?)',
+                               (question, answer, category or DEFAULT_CATEGORY))
+                qa_id = cursor.lastrowid
+                cursor.executemany('INSERT INTO qa_aliases (qa_id, question) VALUES (?, ?)',
+                                   [(qa_id, alias) for alias in aliases])
             except sqlite3.IntegrityError:
                 raise ValueError(f"Question '{question}' already exists.")
+        return self._public(self._refresh_qa(qa_id))
 
+    @staticmethod
+    def _public(qa: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        if qa is not None:
+            qa.pop("_aliases", None)
+        return qa
+
+    @_db_call
     def get_all_qa_pairs(self) -> List[Dict[str, Any]]:
-        with self._get_conn() as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute('SELECT id, question, answer, enabled FROM qa_pairs')
-            rows = cursor.fetchall()
-            return [dict(row) for row in rows]
+        return self.export_page(0, -1)
+
+    def export_page(self, after_id: int = 0, limit: int = EXPORT_PAGE) -> List[Dict[str, Any]]:
+        """按 id 分頁讀取問答（含所有問法）；limit 為負數時讀取全部"""
+        return self.list_page(after_id, limit)
+
+    @_db_call
+    def list_page(self, after_id: int = 0, limit: int = EXPORT_PAGE, fields: Optional[Iterable[str]] = None,
+                  search: Optional[str] = None, category: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        keyset 分頁：返回 id > after_id 的前 limit 條（limit 為負數時全部）
+        fields 只取指定欄位（None 為全部，id 必定返回）；search 為問題、別名或答案包含的文字
+        """
+        fields = set(LIST_FIELDS if fields is None else fields) | {'id'}
+        unknown = fields - set(LIST_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+        columns = ['id'] + [c for c in ('question', 'answer', 'enabled', 'category') if c in fields]
+        if 'questions' in fields and 'question' not in columns:
+            columns.append('question')
+        where, params = ['q.id > ?'], [after_id]
+        if category is not None:
+            where.append('q.category = ?')
+            params.append(category)
+        if search:
+            where.append('(instr(q.question, ?) OR instr(q.answer, ?) OR EXISTS ('
+                         'SELECT 1 FROM qa_aliases a WHERE a.qa_id = q.id AND instr(a.question, ?)))')
+            params += [search] * 3
+
+        conn = self._get_conn()
+        cursor = conn.cursor()
+        cursor.row_factory = sqlite3.Row
+        rows = [dict(row) for row in cursor.execute(
+            f'SELECT {", ".join("q." + c for c in columns)} FROM qa_pairs q '
+            f'WHERE {" AND ".join(where)} ORDER BY q.id LIMIT ?', params + [limit])]
+        if not rows or 'questions' not in fields:
+            return rows
+        aliases = defaultdict(list)
+        for qa_id, question in conn.execute(
+                'SELECT qa_id, question FROM qa_aliases WHERE qa_id BETWEEN ? AND ? ORDER BY id',
+                (rows[0]["id"], rows[-1]["id"])):
+            aliases[qa_id].append(question)
+        for row in rows:
+            row["questions"] = [row["question"]] + aliases.get(row["id"], [])
+            if 'question' not in fields:
+                del row["question"]
+        return rows
+
+    @_db_call
+    def get_summary(self) -> Dict[str, Any]:
+        """總數、已啟用數及所有分類（以 SQL 聚合，不讀取問答內容）"""
+        conn = self._get_conn()
+        total, enabled = conn.execute('SELECT COUNT(*), COALESCE(SUM(enabled), 0) FROM qa_pairs').fetchone()
+        categories = [row[0] for row in conn.execute('SELECT DISTINCT category FROM qa_pairs ORDER BY category')]
+        return {"total": total, "enabled": enabled, "categories": categories}
+
+    @_db_call
+    def import_jsonl(self, lines: Iterable[str]) -> Dict[str, Any]:
+        """
+        在單一交易中批量匯入 JSONL（每行一條問答，見 parse_import_record）
+        主問題或任一別名已存在的記錄會被略過；任何一行格式錯誤則整批回滾
+        """
+        start = time.perf_counter()
+        stats = {"imported": 0, "skipped": 0, "aliases": 0}
+        seen = set()
+        conn = self._get_conn()
+
+        def flush(batch):
+            existing = self._taken_questions(conn, [q for record in batch for q in record["questions"]])
+            fresh = [record for record in batch if existing.isdisjoint(record["questions"])]
+            stats["skipped"] += len(batch) - len(fresh)
+            if not fresh:
+                return
+            conn.executemany('INSERT INTO qa_pairs (question, answer, category, enabled) VALUES (?, ?, ?, ?)',
+                             [(r["questions"][0], r["answer"], r["category"], r["enabled"]) for r in fresh])
+            primaries = [r["questions"][0] for r in fresh]
+            ids = dict(conn.execute(
+                f'SELECT question, id FROM qa_pairs WHERE question IN ({",".join("?" * len(primaries))})',
+                primaries).fetchall())
+            cursor = conn.executemany('INSERT OR IGNORE INTO qa_aliases (qa_id, question) VALUES (?, ?)',
+                                      [(ids[r["questions"][0]], alias)
+                                       for r in fresh for alias in r["questions"][1:]])
+            stats["aliases"] += max(cursor.rowcount, 0)
+            stats["imported"] += len(fresh)
+
+        fts_tables = (('qa_pairs', 'qa_fts'), ('qa_aliases', 'qa_alias_fts')) if self.fts_enabled else ()
+        try:
+            with conn:
+                # DDL 亦需在同一交易中，出錯時連同觸發器一併回滾
+                conn.execute('BEGIN')
+                # 逐行觸發 FTS 索引很慢：匯入期間移除插入觸發器，最後一次性為新行建立索引
+                first_ids = {}
+                for table, fts in fts_tables:
+                    first_ids[table] = conn.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}').fetchone()[0]
+                    conn.execute(f'DROP TRIGGER IF EXISTS {fts}_insert')
+                batch = []
+                for line_no, line in enumerate(lines, 1):
+                    record = parse_import_record(line, line_no)
+                    if record is None:
+                        continue
+                    # 同一檔案內重複的問法只保留第一次出現
+                    record["questions"] = [q for q in record["questions"] if q not in seen]
+                    if not record["questions"]:
+                        stats["skipped"] += 1
+                        continue
+                    seen.update(record["questions"])
+                    batch.append(record)
+                    if len(batch) >= IMPORT_CHUNK:
+                        flush(batch)
+                        batch = []
+                if batch:
+                    flush(batch)
+                for table, fts in fts_tables:
+                    conn.execute(f'INSERT INTO {fts}(rowid, question) SELECT id, question FROM {table} WHERE id > ?',
+                                 (first_ids[table],))
+                    conn.execute(self._fts_insert_trigger(table, fts))
+        finally:
+            if stats["imported"]:
+                self._load_index()
+                self.version += 1
+        stats["elapsed_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        logger.info(f"知識庫匯入完成: {stats}")
+        return stats
 
     def find_answer(self, question: str) -> Optional[str]:
-        """中文語義智能匹配"""
-        import re
-        from synonyms_config import get_word_synonyms  # 導入同義詞配置
-        
-        with self._get_conn() as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT question, answer FROM qa_pairs WHERE enabled = TRUE')
-            all_pairs = cursor.fetchall()
-            
-            if not all_pairs:
-                return None
-            
-            # 標準化問題
-            def normalize_question(q):
-                # 移除標點和語氣詞
-                q = re.sub(r'[？?！!。.,，、；;：:()（）\s]', '', q)
-                q = re.sub(r'(在|的|是|了|嗎|咩|呢|啊|呀|吧|咯|有|沒有)', '', q)
-                return q.lower()
-            
-            # 提取語義關鍵詞
-            def extract_semantic_keywords(text):
-                # 提取2-4字的中文詞
-                words = re.findall(r'[\u4e00-\u9fff]{2,4}', text)
-                semantic_words = set()
-                
-                for word in words:
-                    # 使用配置檔案中的同義詞
-                    synonyms = get_word_synonyms(word)
-                    semantic_words.update(synonyms)
-                
-                return semantic_words
-            
-            # 計算語義相似度
-            def semantic_similarity(q1, q2):
-                kw1 = extract_semantic_keywords(q1)
-                kw2 = extract_semantic_keywords(q2)
-                
-                if not kw1 or not kw2:
-                    return 0
-                
-                # 計算交集比例
-                intersection = len(kw1 & kw2)
-                union = len(kw1 | kw2)
-                
-                return intersection / union if union > 0 else 0
-            
-            user_q_norm = normalize_question(question)
-            best_match = None
-            best_score = 0
-            
-            for stored_question, answer in all_pairs:
-                stored_q_norm = normalize_question(stored_question)
-                score = semantic_similarity(user_q_norm, stored_q_norm)
-                
-                if score > best_score:
-                    best_score = score
-                    best_match = answer
-            
-            # 40% 相似度即匹配
-            return best_match if best_score >= 0.4 else None
+        """中文語義智能匹配：先按同義詞關鍵詞匹配，失敗時以 FTS5 trigram 召回候選再重排"""
+        self.sync_synonyms()
+        hit, answer = self._cached_answer(question)
+        if hit:
+            return answer
+        # 匹配只取決於標準化後的問題；記下開始時的 version，期間有寫入則不寫入緩存
+        version = self.version
+        answer = self._match_keywords(question)
+        if answer is None and self.fts_enabled and self.may_match_fts(question):
+            answer = self._db.run(lambda _conn: self._match_fts(question))
+        with self._answer_cache_lock:
+            if self._answer_cache_version == version:
+                self._answer_cache[normalize_question(question)] = answer
+                if len(self._answer_cache) > ANSWER_CACHE_SIZE:
+                    self._answer_cache.popitem(last=False)
+        return answer
 
+    def _cached_answer(self, question: str) -> Tuple[bool, Optional[str]]:
+        """返回 (是否命中, 答案)；沒有匹配的問題以 None 緩存，令交給 LLM 的問題也不必重新評分"""
+        key = normalize_question(question)
+        with self._answer_cache_lock:
+            if self._answer_cache_version != self.version:
+                self._answer_cache.clear()
+                self._answer_cache_version = self.version
+            elif key in self._answer_cache:
+                self._answer_cache.move_to_end(key)
+                self._answer_cache_hits += 1
+                return True, self._answer_cache[key]
+            self._answer_cache_misses += 1
+        return False, None
+
+    def get_cache_stats(self) -> Dict[str, Any]:
+        with self._answer_cache_lock:
+            lookups = self._answer_cache_hits + self._answer_cache_misses
+            return {
+                "size": len(self._answer_cache),
+                "max_size": ANSWER_CACHE_SIZE,
+                "negative": sum(1 for answer in self._answer_cache.values() if answer is None),
+                "hits": self._answer_cache_hits,
+                "misses": self._answer_cache_misses,
+                "hit_rate": round(self._answer_cache_hits / lookups, 4) if lookups else 0.0,
+                "version": self._answer_cache_version,
+            }
+
+    def _match_keywords(self, question: str) -> Optional[str]:
+        user_keywords = extract_semantic_keywords(normalize_question(question))
+        if not user_keywords:
+            return None
+        user_concepts = concept_counts(user_keywords)
+        user_size = len(user_keywords)
+
+        with self._index_lock:
+            # 只考慮與問題共享至少一個概念的條目；共享概念的詞數之和是交集大小的上界
+            shared = defaultdict(int)
+            for concept, count in user_concepts.items():
+                for key in self._postings.get(concept, ()):
+                    shared[key] += min(count, self._index[key].concepts[concept])
+
+            candidates = []
+            for key, bound in shared.items():
+                entry = self._index[key]
+                upper = bound / (user_size + len(entry.keywords) - bound)
+                if upper >= MATCH_THRESHOLD:
+                    candidates.append((-upper, key, entry))
+
+        # 按上界由高至低計算 Jaccard，上界低於當前最佳分數即可停止；同分時取鍵較小者（與逐行掃描一致）
+        candidates.sort(key=lambda c: (c[0], c[1]))
+        best_match = None
+        best_score = 0
+        best_key = None
+        for neg_upper, key, entry in candidates:
+            if -neg_upper < best_score:
+                break
+            intersection = len(user_keywords & entry.keywords)
+            score = intersection / (user_size + len(entry.keywords) - intersection)
+            if score > best_score or (score == best_score and best_key is not None and key < best_key):
+                best_score = score
+                best_match = entry.answer
+                best_key = key
+
+        # 40% 相似度即匹配
+        return best_match if best_score >= MATCH_THRESHOLD else None
+
+    def may_match_fts(self, question: str) -> bool:
+        """
+        FTS 重排可能命中的必要條件（bigram Jaccard 上界）：
+        問題的 bigram 數不超過最長已存問題的 1/FTS_MATCH_THRESHOLD 倍，且足夠比例出現在已存問題中
+        """
+        normalized = normalize_question(question)
+        if len(normalized) < 3:
+            return False
+        user_bigrams = char_bigrams(canonicalize(normalized))
+        limit = len(user_bigrams) * FTS_MATCH_THRESHOLD
+        # 引用計數隨寫入增量維護，這裡只按問題本身的 bigram 查表
+        counts = self._bigram_counts
+        return limit <= self._max_bigrams and sum(1 for b in user_bigrams if b in counts) >= limit
+
+    def _match_fts(self, question: str) -> Optional[str]:
+        """FTS5 召回前 FTS_CANDIDATES 個候選，以同義詞歸一後的 bigram Jaccard 重排"""
+        normalized = normalize_question(question)
+        query = fts_query(normalized)
+        if query is None:
+            return None
+        conn = self._get_conn()
+        rows = conn.execute(
+            '''SELECT q.id, 0 FROM qa_fts JOIN qa_pairs q ON q.id = qa_fts.rowid
+               WHERE qa_fts MATCH ? AND q.enabled ORDER BY bm25(qa_fts) LIMIT ?''',
+            (query, FTS_CANDIDATES)).fetchall()
+        rows += conn.execute(
+            '''SELECT a.qa_id, a.id FROM qa_alias_fts JOIN qa_aliases a ON a.id = qa_alias_fts.rowid
+               JOIN qa_pairs q ON q.id = a.qa_id
+               WHERE qa_alias_fts MATCH ? AND q.enabled ORDER BY bm25(qa_alias_fts) LIMIT ?''',
+            (query, FTS_CANDIDATES)).fetchall()
+
+        user_bigrams = char_bigrams(canonicalize(normalized))
+        best_match, best_key = None, None
+        for key in rows:
+            entry = self._index.get(tuple(key))
+            if entry is None or not entry.bigrams:
+                continue
+            score = len(user_bigrams & entry.bigrams) / len(user_bigrams | entry.bigrams)
+            if score >= FTS_MATCH_THRESHOLD and (best_key is None or (-score, tuple(key)) < best_key):
+                best_match, best_key = entry.answer, (-score, tuple(key))
+        return best_match
+
+    def _get_bitset(self) -> BitsetMatcher:
+        version = self.version
+        if self._bitset is None or self._bitset_version != version:
+            with self._index_lock:
+                rows = [(key[0], entry.keywords) for key, entry in sorted(self._index.items()) if entry.enabled]
+            self._bitset = BitsetMatcher(rows)
+            self._bitset_version = version
+        return self._bitset
+
+    def search(self, question: str, top_k: int = 5, min_score: float = MATCH_THRESHOLD) -> List[Dict[str, Any]]:
+        """返回分數最高的 top_k 條問答（含分數）"""
+        return self.search_batch([question], top_k, min_score)[0]
+
+    def search_batch(self, questions: List[str], top_k: int = 5,
+                     min_score: float = MATCH_THRESHOLD) -> List[List[Dict[str, Any]]]:
+        """一次為多個問題評分，用於離線評估及緩存預熱"""
+        self.sync_synonyms()
+        matcher = self._get_bitset()
+        keyword_sets = [extract_semantic_keywords(normalize_question(q)) for q in questions]
+        results = []
+        for matches in matcher.batch_top_k(keyword_sets, top_k, min_score):
+            rows = []
+            for qa_id, score in matches:
+                entry = self._index.get((qa_id, 0))
+                if entry is not None:
+                    rows.append({"id": qa_id, "question": entry.question, "answer": entry.answer,
+                                 "score": round(score, 4)})
+            results.append(rows)
+        return results
+
+    def get_match_keywords(self) -> Set[str]:
+        """所有已啟用問題的語義關鍵詞（含同義詞）之並集，供意圖路由預先判斷能否命中"""
+        self.sync_synonyms()
+        keywords = set()
+        with self._index_lock:
+            for entry in self._index.values():
+                if entry.enabled:
+                    keywords.update(entry.keywords)
+        return keywords
+
+    @_db_call
     def delete_qa_pair(self, qa_id: int) -> bool:
         with self._get_conn() as conn:
-            cursor = conn.cursor()
-            cursor.execute('DELETE FROM qa_pairs WHERE id = ?', (qa_id,))
-            conn.commit()
-            return cursor.rowcount > 0
+            conn.execute('DELETE FROM qa_aliases WHERE qa_id = ?', (qa_id,))
+            deleted = conn.execute('DELETE FROM qa_pairs WHERE id = ?', (qa_id,)).rowcount > 0
+        self._refresh_qa(qa_id)
+        return deleted
 
+    @_db_call
     def toggle_qa_pair(self, qa_id: int) -> Optional[Dict[str, Any]]:
         with self._get_conn() as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute('SELECT enabled FROM qa_pairs WHERE id = ?', (qa_id,))
-            row = cursor.fetchone()
-            if not row:
-                return None
-            
-            new_enabled_status = not row['enabled']
-            cursor.execute('UPDATE qa_pairs SET enabled = ? WHERE id = ?', (new_enabled_status, qa_id))
-            conn.commit()
-
-            cursor.execute('SELECT id, question, answer, enabled FROM qa_pairs WHERE id = ?', (qa_id,))
-            updated_row = cursor.fetchone()
-            return dict(updated_row) if updated_row else None
+            updated = conn.execute('UPDATE qa_pairs SET enabled = NOT enabled WHERE id = ?', (qa_id,)).rowcount
+        if not updated:
+            return None
+        return self._public(self._refresh_qa(qa_id))
 
-    def update_qa_pair(self, qa_id: int, question: str, answer: str) -> Optional[Dict[str, Any]]:
+    @_db_call
+    def update_qa_pair(self, qa_id: int, question: str, answer: str, category: Optional[str] = None,
+                       aliases: Optional[Iterable[str]] = None) -> Optional[Dict[str, Any]]:
+        """更新問答；category / aliases 為 None 時保留原值"""
+        if aliases is not None:
+            aliases = [alias for alias in _dedupe_questions(aliases) if alias != question]
         with self._get_conn() as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
+            self._check_questions_free(conn, [question] + (aliases or []), exclude_id=qa_id)
             try:
-                cursor.execute('UPDATE qa_pairs SET question = ?, answer = ? WHERE id = ?', (question, answer, qa_id))
-                conn.commit()
-                if cursor.rowcount == 0:
-                    return None
-                cursor.execute('SELECT id, question, answer, enabled FROM qa_pairs WHERE id = ?', (qa_id,))
-                updated_row = cursor.fetchone()
-                return dict(updated_row)
+                updated = conn.execute(
+                    'UPDATE qa_pairs SET question = ?, answer = ?, category = COALESCE(?, category) WHERE id = ?',
+                    (question, answer, category, qa_id)).rowcount
+                if updated and aliases is not None:
+                    conn.execute('DELETE FROM qa_aliases WHERE qa_id = ?', (qa_id,))
+                    conn.executemany('INSERT INTO qa_aliases (qa_id, question) VALUES (?, ?)',
+                                     [(qa_id, alias) for alias in aliases])
+                elif updated:
+                    # 保留原別名時，新的主問題若原是自身別名則移除該別名
+                    conn.execute('DELETE FROM qa_aliases WHERE qa_id = ? AND question = ?', (qa_id, question))
             except sqlite3.IntegrityError:
-                raise ValueError(f"Question '{question}' already exists.")
\ No newline at end of file
+                raise ValueError(f"Question '{question}' already exists.")
+        if not updated:
+            return None
+        return self._public(self._refresh_qa(qa_id))
@@ -0,0 +1,172 @@
+"""
+延遲統計
+QuantileSketch：對數分桶直方圖（相對誤差約 1%），記錄 O(1)、可直接相加合併；
+WindowedSketch：按時間片存放直方圖的固定大小環形緩衝，可查詢最近 1 分鐘 / 5 分鐘 / 1 小時的百分位
+"""
+import math
+import time
+from typing import Dict, Iterable, List, Optional
+
+# 查詢窗口（秒）
+WINDOWS = {"1m": 60, "5m": 300, "1h": 3600}
+
+
+class QuantileSketch:
+    """
+    稀疏對數分桶：值 v 落入第 floor(log(v) / log(gamma)) 桶，桶內以幾何中點代表，
+    百分位的相對誤差不超過 (gamma - 1) / 2；低於 min_value 的值（含 0 及負數）歸入零桶
+    """
+
+    __slots__ = ("gamma", "min_value", "_log_gamma", "buckets", "zeros", "count", "total", "min", "max")
+
+    def __init__(self, gamma: float = 1.02, min_value: float = 0.01):
+        self.gamma = gamma
+        self.min_value = min_value
+        self._log_gamma = math.log(gamma)
+        self.buckets: Dict[int, int] = {}
+        self.zeros = 0
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def bucket(self, value: float) -> Optional[int]:
+        """值所屬的桶（None 為零桶）"""
+        return None if value < self.min_value else math.floor(math.log(value) / self._log_gamma)
+
+    def add(self, value: float, count: int = 1, index: Optional[int] = -1):
+        """index 可傳入已計算的 bucket(value)，多個直方圖同時記錄時只需計算一次對數"""
+        if index == -1:
+            index = self.bucket(value)
+        if index is None:
+            self.zeros += count
+        else:
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += count
+        self.total += value * count
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other: "QuantileSketch"):
+        """把另一個（相同 gamma 的）直方圖加進來"""
+        buckets = self.buckets
+        for index, count in other.buckets.items():
+            buckets[index] = buckets.get(index, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def clear(self):
+        self.buckets.clear()
+        self.zeros = self.count = 0
+        self.total = 0.0
+        self.min, self.max = math.inf, -math.inf
+
+    def quantiles(self, qs: Iterable[float]) -> List[Optional[float]]:
+        """一次計算多個百分位（qs 須遞增），只需排序一次非空桶；第 q 百分位取排序後第 int(n * q) 個樣本"""
+        ranks = [min(int(self.count * q), self.count - 1) for q in qs]
+        if not self.count:
+            return [None] * len(ranks)
+        results = []
+        seen = self.zeros
+        while len(results) < len(ranks) and ranks[len(results)] < seen:
+            results.append(self.min)
+        for index in sorted(self.buckets):
+            if len(results) == len(ranks):
+                break
+            seen += self.buckets[index]
+            value = min(max(self.gamma ** (index + 0.5), self.min), self.max)
+            while len(results) < len(ranks) and ranks[len(results)] < seen:
+                results.append(value)
+        results.extend([self.max] * (len(ranks) - len(results)))
+        return results
+
+    def quantile(self, q: float) -> Optional[float]:
+        return self.quantiles([q])[0]
+
+    def summary(self) -> dict:
+        """與舊版 _summarize 相同的欄位"""
+        if not self.count:
+            return {"avg": None, "p50": None, "p95": None, "p99": None, "samples": 0}
+        p50, p95, p99 = self.quantiles((0.50, 0.95, 0.99))
+        return {
+            "avg": round(self.total / self.count, 2),
+            "p50": round(p50, 2),
+            "p95": round(p95, 2),
+            "p99": round(p99, 2),
+            "samples": self.count
+        }
+
+
+class _SlotRing:
+    """固定數量的時間片直方圖；寫入時若時間片已屬舊週期則就地清空重用"""
+
+    __slots__ = ("slot_seconds", "sketches", "epochs")
+
+    def __init__(self, slot_seconds: float, slots: int, gamma: float, min_value: float):
+        self.slot_seconds = slot_seconds
+        self.sketches = [QuantileSketch(gamma, min_value) for _ in range(slots)]
+        self.epochs = [-1] * slots
+
+    def slot(self, now: float) -> QuantileSketch:
+        """目前時間片的直方圖"""
+        epoch = int(now // self.slot_seconds)
+        i = epoch % len(self.epochs)
+        if self.epochs[i] != epoch:
+            self.sketches[i].clear()
+            self.epochs[i] = epoch
+        return self.sketches[i]
+
+    def merged(self, seconds: float, now: float, into: QuantileSketch) -> QuantileSketch:
+        current = int(now // self.slot_seconds)
+        oldest = current - max(1, math.ceil(seconds / self.slot_seconds)) + 1
+        for epoch, sketch in zip(self.epochs, self.sketches):
+            if oldest <= epoch <= current:
+                into.merge(sketch)
+        return into
+
+
+class WindowedSketch:
+    """
+    最近 1 分鐘 / 5 分鐘（10 秒時間片 × 30）及 1 小時（1 分鐘時間片 × 60）的延遲分佈，另保留啟動以來的總體分佈；
+    記憶體固定，與記錄數量無關
+    """
+
+    __slots__ = ("gamma", "min_value", "_fine", "_coarse", "lifetime")
+
+    def __init__(self, gamma: float = 1.02, min_value: float = 0.01):
+        self.gamma = gamma
+        self.min_value = min_value
+        self._fine = _SlotRing(10, 30, gamma, min_value)
+        self._coarse = _SlotRing(60, 60, gamma, min_value)
+        self.lifetime = QuantileSketch(gamma, min_value)
+
+    def add(self, value: float, now: Optional[float] = None, count: int = 1):
+        now = time.time() if now is None else now
+        index = self.lifetime.bucket(value)
+        self._fine.slot(now).add(value, count, index)
+        self._coarse.slot(now).add(value, count, index)
+        self.lifetime.add(value, count, index)
+
+    def merge_sketch(self, sketch: QuantileSketch, now: Optional[float] = None):
+        """把一批已聚合的樣本（例如客戶端上報）計入目前時間片"""
+        now = time.time() if now is None else now
+        self._fine.slot(now).merge(sketch)
+        self._coarse.slot(now).merge(sketch)
+        self.lifetime.merge(sketch)
+
+    def window(self, name: str = "5m", now: Optional[float] = None) -> QuantileSketch:
+        """合併指定窗口內的時間片（"all" 為啟動以來）"""
+        if name == "all":
+            return self.lifetime
+        seconds = WINDOWS[name]
+        now = time.time() if now is None else now
+        ring = self._fine if seconds <= self._fine.slot_seconds * len(self._fine.epochs) else self._coarse
+        return ring.merged(seconds, now, QuantileSketch(self.gamma, self.min_value))
+
+    def summary(self, name: str = "5m", now: Optional[float] = None) -> dict:
+        return self.window(name, now).summary()
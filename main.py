@@ -1,7 +1,8 @@
 # ===== LLM-CONTEXT-START: IMPORTS AND CONFIG =====
 # @LLM-CONTEXT: 基礎配置和導入 - LLM 需要了解的依賴和配置
 from fastapi import FastAPI, Request, HTTPException, WebSocket, WebSocketDisconnect
-from fastapi.responses import StreamingResponse, HTMLResponse
+from fastapi.responses import StreamingResponse, HTMLResponse, Response
+from starlette.background import BackgroundTask
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 import httpx
@@ -12,6 +13,7 @@ import time
 import edge_tts
 from gtts import gTTS  # Google TTS as fallback
 import asyncio
+import anyio
 import io
 from pydantic import BaseModel
 
@@ -23,6 +25,7 @@ except ImportError:
     AZURE_TTS_AVAILABLE = False
     logger.warning("Azure Speech SDK not installed - Azure TTS unavailable")
 import hashlib
+import codecs
 import ssl
 import hmac
 import base64
@@ -43,8 +46,19 @@ import random
 from aiohttp import ClientError
 
 # 新增导入
-from knowledge_base import KnowledgeBase
-from weather_service import WeatherService
+from knowledge_base import EXPORT_PAGE, LIST_FIELDS, KnowledgeBase
+from weather_service import WeatherPrefetcher, WeatherService
+from intent_router import IntentRouter
+from segmenter import segmenter
+from answer_audio import AnswerAudioPreSynthesizer
+from latency_stats import WINDOWS, WindowedSketch
+from prometheus_metrics import (CONTENT_TYPE as METRICS_CONTENT_TYPE, HTTPMetricsMiddleware, MetricsRegistry,
+                                monitor_event_loop_lag)
+from client_telemetry import ClientTelemetryAggregator, TelemetryFormatError, parse_batch
+import tracing
+from tracing import TRACE_HEADER, Tracer, TracingMiddleware
+from rate_limiter import LLMRateLimiter, RateLimitExceeded
+from model_router import AdaptiveModelRouter
 
 # ===== SSL FIX - TEMPORARY =====
 # Note: ssl and os are already imported above
@@ -102,6 +116,11 @@ logger.debug(f"DEEPSEEK_API_KEY: {'*' * len(DEEPSEEK_API_KEY) if DEEPSEEK_API_KE
 HTML_FILE = os.getenv('HTML_FILE', 'index.html')
 print(f"DEBUG: HTML_FILE = {HTML_FILE}")
 
+# 知識庫數據庫路徑（測試時指向臨時目錄）
+KNOWLEDGE_BASE_PATH = os.getenv('KNOWLEDGE_BASE_PATH', 'knowledge_base.db')
+# 匯入時整個檔案在同一交易中寫入，須先全部接收；以此限制請求大小
+KNOWLEDGE_IMPORT_MAX_MB = float(os.getenv('KNOWLEDGE_IMPORT_MAX_MB', '20'))
+
 # ===== LLM-CONTEXT-START: SYSTEM CONFIG =====
 # @LLM-CONTEXT: 系統配置
 PERFORMANCE_CONFIG = {
@@ -112,7 +131,82 @@ PERFORMANCE_CONFIG = {
     "PRELOAD_ENABLED": True,
     "CHUNK_SIZE": 2048,
     "FIRST_CHUNK_SIZE": 512,
-    "MONITORING_ENABLED": True
+    "MONITORING_ENABLED": True,
+    "LLM_QUEUE_TIMEOUT": 2.0  # 限流排隊最長等待（秒）
+}
+
+# 知識庫答案語音預合成（每個語音一份，固定在 TTS 緩存中）
+TTS_PRESYNTH_CONFIG = {
+    "ENABLED": True,
+    "CONCURRENCY": 2,  # 同時合成的段落數，避免與用戶請求爭用 Edge TTS
+    "MAX_MB": 200,  # 固定音頻的記憶體上限
+}
+
+# 聊天中天氣查詢的時限：沒有可用緩存時最多等待上游此時間，重試在背景進行
+WEATHER_CONFIG = {
+    "BUDGET_SECONDS": 1.5,
+    "ON_TIMEOUT": "placeholder",  # "placeholder" = 返回稍後再問的提示；"llm" = 交由知識庫 / LLM 處理
+    "PLACEHOLDER": "天氣資料暫時未能更新，請過一陣再問我一次。",
+    "PREFETCH_ENABLED": True,  # 定時預取預報並預先格式化、合成今明兩日的回應
+    "PREFETCH_INTERVAL": 900,  # 15分鐘，短於天氣緩存的30分鐘有效期
+}
+
+# 請求階段追蹤：抽樣寫入輪替的 JSONL 檔，用 scripts/trace_report.py 分析
+TRACING_CONFIG = {
+    "ENABLED": True,
+    "SAMPLE_RATE": 0.1,  # 一般請求的抽樣率
+    "SLOW_MS": 3000,  # 超過此總耗時的請求一律寫入
+    "PATH": os.getenv("TRACE_LOG_PATH", "logs/traces.jsonl"),
+    "MAX_MB": 20,  # 單檔上限，超過即輪替
+    "BACKUPS": 5,
+}
+
+# 客戶端遙測批量上報（/api/telemetry/batch）
+TELEMETRY_CONFIG = {
+    "MAX_BODY_KB": 256,
+    "MAX_EVENTS_PER_BATCH": 500,
+    "MAX_CLIENTS": 1000,  # 按 LRU 保留各客戶端的分佈
+    "MAX_EVENT_AGE": 240,  # 秒；更舊的事件計入此時間點（須小於 5 分鐘時間片環）
+    "COUNTED_EVENTS": ("error", "tts_error", "tts_alert", "media_source_fallback"),
+}
+
+# 院舍位置（地點名稱 -> 座標），全部定時預取；可用環境變量 WEATHER_LOCATIONS（JSON）新增或覆蓋。
+# 聊天請求以 location 指定地點名稱，或直接提供 latitude / longitude（不預取，但相近座標共用緩存）
+WEATHER_LOCATIONS = {
+    "default": {"name": "香港", "latitude": 22.3193, "longitude": 114.1694, "timezone": "Asia/Hong_Kong"},
+    **json.loads(os.getenv("WEATHER_LOCATIONS", "{}"))
+}
+
+# 各 LLM 供應商限流：每秒請求數、突發量、並發串流數、每分鐘 token 預算（None = 不限）
+LLM_RATE_LIMITS = {
+    "together": {"rps": 5, "burst": 10, "max_concurrency": 8, "tokens_per_minute": None},
+    "qwen": {"rps": 5, "burst": 10, "max_concurrency": 8, "tokens_per_minute": None},
+    "deepseek": {"rps": 3, "burst": 6, "max_concurrency": 6, "tokens_per_minute": None},
+    "gemini": {"rps": 3, "burst": 6, "max_concurrency": 6, "tokens_per_minute": None},
+}
+
+# 限流時的後備模型（按順序嘗試其他已配置的供應商）
+LLM_FAILOVER_MODELS = ["qwen-turbo", "together-qwen", "deepseek-chat", "gemini-2.5-flash"]
+
+# "auto" 模型：按近期首 token 延遲選擇最快的健康模型
+AUTO_MODEL = "auto"
+AUTO_ROUTING_CONFIG = {
+    "WINDOW_SECONDS": 300,  # 滾動時間窗
+    "EXPLORATION_RATE": 0.05,  # 分流去非最佳模型的比例
+    "MAX_ERROR_RATE": 0.5,  # 超過即視為不健康
+    "REQUIRE_CAPABILITIES": ["cantonese"]
+}
+
+# 自動路由候選模型及能力標記（cantonese = 粵語表現良好）
+AUTO_ROUTING_CANDIDATES = {
+    "qwen-turbo": ["cantonese"],
+    "qwen-plus": ["cantonese"],
+    "together-qwen": ["cantonese"],
+    "together-deepseek": ["cantonese"],
+    "together-llama-70b": [],
+    "together-mixtral": [],  # 粵語支援有限
+    "deepseek-chat": ["cantonese"],
+    "gemini-2.5-flash": ["cantonese"],
 }
 # ===== LLM-CONTEXT-END: SYSTEM CONFIG =====
 
@@ -142,6 +236,12 @@ MODEL_ALIASES = {
 
 # Model Configurations - Updated with Qwen models
 AVAILABLE_MODELS = {
+    "auto": {
+        "name": "自動選擇",
+        "provider": "auto",
+        "model_id": "auto",
+        "description": "按各模型近期首字延遲，自動選擇最快而健康嘅粵語模型"
+    },
     "qwen-turbo": {
         "name": "通義千問 Turbo",
         "provider": "qwen",
@@ -208,8 +308,9 @@ EDGE_TTS_VOICES = {
 # ===== LLM-SKIP-END: KNOWLEDGE BASE =====
 
 # 全局服务实例
-knowledge_base = KnowledgeBase()  # SQLite版本
+knowledge_base = KnowledgeBase(KNOWLEDGE_BASE_PATH)  # SQLite版本
 weather_service = WeatherService()  # 天气服务
+intent_router = IntentRouter(knowledge_base)  # 意圖路由
 
 # ===== TTS連接池管理 ===== - unchanged
 @dataclass
@@ -374,6 +475,14 @@ class IntelligentTTSCache:
         self.max_size = PERFORMANCE_CONFIG["CACHE_MAX_SIZE"]
         self.ttl = PERFORMANCE_CONFIG["CACHE_TTL"]
         self.lock = asyncio.Lock()
+        # 固定項（知識庫答案預合成）：不過期、不被 LRU 淘汰、不計入 max_size，由預合成工作自行移除
+        self.pinned = set()
+        self._pinned_bytes = 0
+        # 累計次數（/metrics 抓取時讀取）
+        self.hits = 0
+        self.misses = 0
+        self.hit_bytes = 0
+        self.evictions = 0
     
     def _generate_cache_key(self, text: str, voice: str, rate: int, pitch: int) -> str:
         """生成緩存鍵"""
@@ -386,7 +495,7 @@ class IntelligentTTSCache:
 
         async with self.lock:
             if cache_key in self.cache:
-                if time.time() - self.last_access[cache_key] > self.ttl:
+                if cache_key not in self.pinned and time.time() - self.last_access[cache_key] > self.ttl:
                     await self._remove(cache_key)
                     return None
 
@@ -399,13 +508,16 @@ class IntelligentTTSCache:
 
                 self.access_counts[cache_key] += 1
                 self.last_access[cache_key] = time.time()
+                self.hits += 1
+                self.hit_bytes += len(cached_data)
 
                 logger.debug(f"Cache hit: {cache_key[:8]}...")
                 return cached_data
 
+        self.misses += 1
         return None
     
-    async def put(self, text: str, voice: str, rate: int, pitch: int, audio_data: bytes):
+    async def put(self, text: str, voice: str, rate: int, pitch: int, audio_data: bytes, pinned: bool = False):
         """存入緩存"""
         # ✅ Validate audio data is not empty before caching
         if not audio_data or len(audio_data) == 0:
@@ -415,27 +527,56 @@ class IntelligentTTSCache:
         cache_key = self._generate_cache_key(text, voice, rate, pitch)
 
         async with self.lock:
-            if len(self.cache) >= self.max_size:
+            if cache_key not in self.cache and len(self.cache) - len(self.pinned) >= self.max_size:
                 await self._evict_lru()
 
+            if cache_key in self.pinned:
+                self._pinned_bytes -= self.cache_sizes.get(cache_key, 0)
             self.cache[cache_key] = audio_data
             self.cache_sizes[cache_key] = len(audio_data)
             self.access_counts[cache_key] = 1
             self.last_access[cache_key] = time.time()
+            if pinned or cache_key in self.pinned:
+                self.pinned.add(cache_key)
+                self._pinned_bytes += len(audio_data)
 
             logger.debug(f"Cache put: {cache_key[:8]}... ({len(audio_data)} bytes)")
     
+    async def pin(self, text: str, voice: str, rate: int, pitch: int) -> bool:
+        """已有音頻時把它固定並返回 True"""
+        cache_key = self._generate_cache_key(text, voice, rate, pitch)
+        async with self.lock:
+            if not self.cache.get(cache_key):
+                return False
+            if cache_key not in self.pinned:
+                self.pinned.add(cache_key)
+                self._pinned_bytes += self.cache_sizes.get(cache_key, 0)
+            return True
+
+    async def remove(self, text: str, voice: str, rate: int, pitch: int):
+        """移除指定音頻（含固定項）"""
+        async with self.lock:
+            await self._remove(self._generate_cache_key(text, voice, rate, pitch))
+
+    def pinned_bytes(self) -> int:
+        return self._pinned_bytes
+
     async def _evict_lru(self):
-        """淘汰最少使用的緩存項"""
-        if not self.cache:
+        """淘汰最少使用的緩存項（固定項除外）"""
+        candidates = [k for k in self.last_access if k not in self.pinned]
+        if not candidates:
             return
         
-        lru_key = min(self.last_access.keys(), key=lambda k: self.last_access[k])
+        lru_key = min(candidates, key=lambda k: self.last_access[k])
         await self._remove(lru_key)
+        self.evictions += 1
         logger.debug(f"Evicted LRU cache: {lru_key[:8]}...")
     
     async def _remove(self, cache_key: str):
         """移除緩存項"""
+        if cache_key in self.pinned:
+            self.pinned.discard(cache_key)
+            self._pinned_bytes -= self.cache_sizes.get(cache_key, 0)
         self.cache.pop(cache_key, None)
         self.access_counts.pop(cache_key, None)
         self.last_access.pop(cache_key, None)
@@ -446,36 +587,85 @@ class IntelligentTTSCache:
         total_size = sum(self.cache_sizes.values())
         return {
             "entries": len(self.cache),
+            "pinned_entries": len(self.pinned),
+            "pinned_size_mb": round(self._pinned_bytes / 1024 / 1024, 2),
             "total_size_mb": round(total_size / 1024 / 1024, 2),
             "hit_rate": sum(self.access_counts.values()) / max(len(self.cache), 1)
         }
 
 # ===== 性能監控系統 ===== - unchanged
 class PerformanceMonitor:
+    """延遲以時間片直方圖記錄（O(1)，記憶體固定），查詢時按窗口合併：1m / 5m / 1h / all"""
+
     def __init__(self):
         self.metrics = {
-            "first_chunk_latencies": [],
-            "chunk_gaps": [],
+            "first_chunk_latencies": WindowedSketch(),
+            "chunk_gaps": WindowedSketch(),
             "error_counts": defaultdict(int),
             "request_counts": defaultdict(int),
-            "cache_stats": {}
+            "cache_stats": {},
+            "llm_calls": defaultdict(lambda: defaultdict(WindowedSketch))  # "provider/model_id" -> 指標 -> 直方圖
         }
+        self.llm_counts = defaultdict(lambda: defaultdict(int))
+        self.cancellations = defaultdict(lambda: defaultdict(float))
         self.start_time = time.time()
     
     def record_first_chunk_latency(self, latency_ms: float):
         """記錄首幀延遲"""
-        self.metrics["first_chunk_latencies"].append(latency_ms)
-        
-        if len(self.metrics["first_chunk_latencies"]) > 1000:
-            self.metrics["first_chunk_latencies"] = self.metrics["first_chunk_latencies"][-1000:]
+        self.metrics["first_chunk_latencies"].add(latency_ms)
     
     def record_chunk_gap(self, gap_ms: float):
         """記錄句間間隔"""
-        self.metrics["chunk_gaps"].append(gap_ms)
-        
-        if len(self.metrics["chunk_gaps"]) > 1000:
-            self.metrics["chunk_gaps"] = self.metrics["chunk_gaps"][-1000:]
-    
+        self.metrics["chunk_gaps"].add(gap_ms)
+    
+    def record_llm_call(self, provider: str, model_id: str, connect_ms: Optional[float],
+                        first_token_ms: Optional[float], duration_ms: float,
+                        chars: int, deltas: int, bytes_received: int, ok: bool):
+        """記錄一次 LLM 串流的連接時間、首 token 時間及吞吐量"""
+        key = f"{provider}/{model_id}"
+        samples = self.metrics["llm_calls"][key]
+        counts = self.llm_counts[key]
+
+        counts["requests"] += 1
+        counts["bytes"] += bytes_received
+        counts["chars"] += chars
+        if not ok:
+            counts["errors"] += 1
+
+        now = time.time()
+        samples["duration_ms"].add(duration_ms, now)
+        if connect_ms is not None:
+            samples["connect_ms"].add(connect_ms, now)
+        if first_token_ms is not None:
+            samples["first_token_ms"].add(first_token_ms, now)
+            # 吞吐量只計首 token 之後的生成時間
+            generation_s = (duration_ms - first_token_ms) / 1000
+            if generation_s > 0:
+                samples["chars_per_second"].add(chars / generation_s, now)
+                samples["deltas_per_second"].add(deltas / generation_s, now)
+
+    def get_llm_stats(self, window: str = "1h") -> dict:
+        """按供應商及模型匯總 LLM 指標（次數為啟動以來，分佈為指定窗口）"""
+        stats = {}
+        for key, samples in self.metrics["llm_calls"].items():
+            counts = self.llm_counts[key]
+            summaries = {name: sketch.summary(window) for name, sketch in samples.items()}
+            stats[key] = {
+                "requests": counts["requests"],
+                "errors": counts["errors"],
+                "bytes": counts["bytes"],
+                "chars": counts["chars"],
+                **{name: summary for name, summary in summaries.items() if summary["samples"]}
+            }
+        return stats
+
+    def record_cancellation(self, kind: str, **savings: float):
+        """記錄因客戶端斷線而取消的上游工作及估算節省量"""
+        entry = self.cancellations[kind]
+        entry["count"] += 1
+        for name, amount in savings.items():
+            entry[name] += amount
+
     def record_error(self, error_type: str):
         """記錄錯誤"""
         self.metrics["error_counts"][error_type] += 1
@@ -484,33 +674,46 @@ class PerformanceMonitor:
         """記錄請求"""
         self.metrics["request_counts"][request_type] += 1
     
-    def get_stats(self) -> dict:
-        """獲取統計信息"""
-        first_chunk_latencies = self.metrics["first_chunk_latencies"]
-        chunk_gaps = self.metrics["chunk_gaps"]
-        
+    def get_stats(self, window: str = "1h") -> dict:
+        """獲取統計信息；window 為延遲分佈的時間窗口（1m / 5m / 1h / all）"""
         stats = {
             "uptime_seconds": int(time.time() - self.start_time),
             "total_requests": sum(self.metrics["request_counts"].values()),
             "total_errors": sum(self.metrics["error_counts"].values()),
             "error_rate": 0,
+            "window": window,
             "performance": {}
         }
         
         if stats["total_requests"] > 0:
             stats["error_rate"] = stats["total_errors"] / stats["total_requests"]
         
-        if first_chunk_latencies:
+        first_chunk = self.metrics["first_chunk_latencies"].summary(window)
+        if first_chunk["samples"]:
             stats["performance"]["first_chunk"] = {
-                "avg_ms": round(sum(first_chunk_latencies) / len(first_chunk_latencies), 2),
-                "p95_ms": round(sorted(first_chunk_latencies)[int(len(first_chunk_latencies) * 0.95)], 2),
-                "p99_ms": round(sorted(first_chunk_latencies)[int(len(first_chunk_latencies) * 0.99)], 2)
+                "avg_ms": first_chunk["avg"],
+                "p50_ms": first_chunk["p50"],
+                "p95_ms": first_chunk["p95"],
+                "p99_ms": first_chunk["p99"],
+                "samples": first_chunk["samples"]
             }
         
-        if chunk_gaps:
+        chunk_gaps = self.metrics["chunk_gaps"].summary(window)
+        if chunk_gaps["samples"]:
             stats["performance"]["chunk_gaps"] = {
-                "avg_ms": round(sum(chunk_gaps) / len(chunk_gaps), 2),
-                "p95_ms": round(sorted(chunk_gaps)[int(len(chunk_gaps) * 0.95)], 2)
+                "avg_ms": chunk_gaps["avg"],
+                "p95_ms": chunk_gaps["p95"],
+                "samples": chunk_gaps["samples"]
+            }
+
+        llm_stats = self.get_llm_stats(window)
+        if llm_stats:
+            stats["performance"]["llm"] = llm_stats
+
+        if self.cancellations:
+            stats["cancellations"] = {
+                kind: {name: round(value, 2) for name, value in entry.items()}
+                for kind, entry in self.cancellations.items()
             }
         
         return stats
@@ -560,6 +763,194 @@ def optimize_text_for_cantonese_tts(text: str) -> str:
 connection_pool = TTSConnectionPool()
 tts_cache = IntelligentTTSCache()
 performance_monitor = PerformanceMonitor()
+llm_rate_limiter = LLMRateLimiter(LLM_RATE_LIMITS, PERFORMANCE_CONFIG["LLM_QUEUE_TIMEOUT"])
+model_router = AdaptiveModelRouter(
+    window_seconds=AUTO_ROUTING_CONFIG["WINDOW_SECONDS"],
+    exploration_rate=AUTO_ROUTING_CONFIG["EXPLORATION_RATE"],
+    max_error_rate=AUTO_ROUTING_CONFIG["MAX_ERROR_RATE"]
+)
+
+
+async def _synthesize_audio(text: str, voice: str, rate: int, pitch: int) -> bytes:
+    """合成完整音頻（不串流）；預處理與 /api/tts/stream 緩存未命中時相同"""
+    processed_text = preprocess_for_cantonese_tts(optimize_text_for_cantonese_tts(strip_html_tags(text)))
+    communicate = edge_tts.Communicate(processed_text, voice, rate=f"{rate - 100:+d}%", pitch=f"{pitch - 100:+d}Hz")
+    audio = io.BytesIO()
+    async for chunk in communicate.stream():
+        if chunk["type"] == "audio":
+            audio.write(chunk["data"])
+    return audio.getvalue()
+
+
+answer_audio = AnswerAudioPreSynthesizer(
+    knowledge_base, tts_cache, _synthesize_audio, EDGE_TTS_VOICES,
+    preprocess=lambda text: preprocess_for_cantonese_tts(text),  # 客戶端朗讀前做的讀法預處理
+    concurrency=TTS_PRESYNTH_CONFIG["CONCURRENCY"],
+    max_mb=TTS_PRESYNTH_CONFIG["MAX_MB"]
+)
+
+# 預取的天氣回應文字改變時，以相同佇列為每個粵語語音預合成
+weather_prefetcher = WeatherPrefetcher(
+    weather_service, WEATHER_CONFIG["PREFETCH_INTERVAL"],
+    on_update=lambda site, date, text: answer_audio.schedule_text(f"weather:{site}:{date}", text),
+    locations=WEATHER_LOCATIONS
+)
+
+def _observe_client_latency(kind: str, value: float):
+    """客戶端回報的首段音頻延遲（毫秒）同時計入 Prometheus 直方圖"""
+    if kind == "first_chunk":
+        tts_first_chunk_seconds.labels("client").observe(value / 1000)
+
+# 客戶端量度的延遲：首段音頻及句間空隙與伺服器端共用直方圖
+client_telemetry = ClientTelemetryAggregator(
+    {
+        "first_chunk": performance_monitor.metrics["first_chunk_latencies"],
+        "chunk_gap": performance_monitor.metrics["chunk_gaps"],
+        "tts_request": WindowedSketch(),
+        "chat_first_token": WindowedSketch(),
+    },
+    counted=TELEMETRY_CONFIG["COUNTED_EVENTS"],
+    max_clients=TELEMETRY_CONFIG["MAX_CLIENTS"],
+    max_events=TELEMETRY_CONFIG["MAX_EVENTS_PER_BATCH"],
+    max_age=TELEMETRY_CONFIG["MAX_EVENT_AGE"],
+    on_value=_observe_client_latency
+)
+
+tracer = Tracer(TRACING_CONFIG["PATH"], TRACING_CONFIG["SAMPLE_RATE"], TRACING_CONFIG["SLOW_MS"],
+                TRACING_CONFIG["MAX_MB"], TRACING_CONFIG["BACKUPS"], enabled=TRACING_CONFIG["ENABLED"])
+
+# ===== Prometheus 指標 =====
+# 直方圖在熱路徑上只做原地加法；其餘數值在 /metrics 抓取時從現有統計讀取
+metrics_registry = MetricsRegistry(prefix="chatbot_")
+http_request_seconds = metrics_registry.histogram(
+    "http_request_duration_seconds", "HTTP request duration by route (streaming responses until the last byte)",
+    ("method", "route", "status"))
+kb_lookup_seconds = metrics_registry.histogram(
+    "kb_lookup_seconds", "Knowledge-base find_answer time", ("result",))
+weather_lookup_seconds = metrics_registry.histogram(
+    "weather_lookup_seconds", "Weather lookup time in /api/chat", ("source",))
+llm_first_token_seconds = metrics_registry.histogram(
+    "llm_first_token_seconds", "LLM time to first token", ("provider", "model"))
+tts_first_chunk_seconds = metrics_registry.histogram(
+    "tts_first_chunk_seconds", "TTS time to first audio chunk", ("provider",))
+event_loop_lag_seconds = metrics_registry.histogram(
+    "event_loop_lag_seconds", "Event loop wake-up delay", buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+event_loop_lag_last = metrics_registry.gauge("event_loop_lag_last_seconds", "Most recent event loop wake-up delay")
+metrics_registry.callback("tts_cache_requests_total", "TTS cache lookups", "counter",
+                          lambda: {("hit",): tts_cache.hits, ("miss",): tts_cache.misses}, ("result",))
+metrics_registry.callback("tts_cache_hit_bytes_total", "Audio bytes served from the TTS cache", "counter",
+                          lambda: {(): tts_cache.hit_bytes})
+metrics_registry.callback("tts_cache_evictions_total", "TTS cache LRU evictions", "counter",
+                          lambda: {(): tts_cache.evictions})
+metrics_registry.callback("tts_cache_bytes", "Audio bytes held in the TTS cache", "gauge",
+                          lambda: {("all",): sum(tts_cache.cache_sizes.values()),
+                                   ("pinned",): tts_cache.pinned_bytes()}, ("kind",))
+metrics_registry.callback("tts_cache_entries", "TTS cache entries", "gauge", lambda: {(): len(tts_cache.cache)})
+metrics_registry.callback(
+    "tts_pool_connections", "Edge TTS pool connections by voice and state", "gauge",
+    lambda: {(voice, state): sum(1 for c in connections if c.status == state)
+             for voice, connections in connection_pool.pools.items() for state in ("ACTIVE", "IDLE")},
+    ("voice", "state"))
+metrics_registry.callback(
+    "tts_pool_utilization", "Active Edge TTS connections / MAX_CONNECTIONS_PER_VOICE", "gauge",
+    lambda: {(voice,): sum(1 for c in connections if c.status == "ACTIVE")
+             / PERFORMANCE_CONFIG["MAX_CONNECTIONS_PER_VOICE"]
+             for voice, connections in connection_pool.pools.items()},
+    ("voice",))
+metrics_registry.callback(
+    "kb_answer_cache_requests_total", "Knowledge-base answer cache lookups", "counter",
+    lambda: {("hit",): knowledge_base.get_cache_stats()["hits"], ("miss",): knowledge_base.get_cache_stats()["misses"]},
+    ("result",))
+metrics_registry.callback(
+    "weather_cache_requests_total", "Weather forecast cache lookups", "counter",
+    lambda: {(result,): weather_service.get_cache_stats()[key]
+             for result, key in (("hit", "hits"), ("stale", "stale_hits"), ("miss", "misses"))},
+    ("result",))
+metrics_registry.callback(
+    "requests_total", "Requests by type (PerformanceMonitor)", "counter",
+    lambda: dict(((kind,), count) for kind, count in performance_monitor.metrics["request_counts"].items()),
+    ("type",))
+metrics_registry.callback(
+    "client_telemetry_events_total", "Client telemetry events accepted by type", "counter",
+    lambda: dict(((kind,), count) for kind, count in client_telemetry.counts.items()),
+    ("type",))
+metrics_registry.callback("client_telemetry_clients", "Clients with retained telemetry", "gauge",
+                          lambda: {(): client_telemetry.client_count})
+metrics_registry.callback(
+    "errors_total", "Errors by type (PerformanceMonitor)", "counter",
+    lambda: dict(((kind,), count) for kind, count in performance_monitor.metrics["error_counts"].items()),
+    ("type",))
+
+# ===== 客戶端斷線取消 =====
+class ClientDisconnected(Exception):
+    """客戶端在響應開始前已斷線"""
+
+
+class CancellableStreamingResponse(StreamingResponse):
+    """客戶端斷線時立即關閉 body 生成器，令上游 httpx / Edge TTS 串流隨之關閉"""
+
+    def __init__(self, content, *args, kind: str = "stream", **kwargs):
+        super().__init__(content, *args, **kwargs)
+        self.kind = kind
+        self.client_disconnected = False
+
+    async def listen_for_disconnect(self, receive):
+        await super().listen_for_disconnect(receive)
+        self.client_disconnected = True
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            # Starlette 只取消發送任務；停在 yield 的生成器要主動關閉才會釋放上游連接
+            aclose = getattr(self.body_iterator, "aclose", None)
+            if aclose:
+                with anyio.CancelScope(shield=True):
+                    await aclose()
+            if self.client_disconnected:
+                performance_monitor.record_request(f"client_disconnect_{self.kind}")
+
+
+async def _wait_for_disconnect(request: Request):
+    """等待客戶端斷線"""
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def _run_until_disconnect(request: Optional[Request], awaitable, kind: str, on_cancel=None, **savings):
+    """執行 awaitable；若客戶端先斷線則取消它並拋出 ClientDisconnected"""
+    if request is None:
+        return await awaitable
+
+    task = asyncio.ensure_future(awaitable)
+    watcher = asyncio.ensure_future(_wait_for_disconnect(request))
+    try:
+        done, _ = await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    except BaseException:
+        task.cancel()
+        raise
+    finally:
+        watcher.cancel()
+
+    if task in done:
+        return task.result()
+
+    task.cancel()
+    if on_cancel:
+        on_cancel()
+    performance_monitor.record_cancellation(kind, **savings)
+    logger.info(f"Client disconnected, cancelled {kind}")
+    raise ClientDisconnected(kind)
+
+async def _enable_segmenter():
+    try:
+        if await segmenter.load_async() is not None:
+            await knowledge_base.run_async(knowledge_base.enable_segmenter)
+            logger.info("知識庫已切換至 jieba 分詞")
+    except Exception as e:
+        logger.error(f"jieba 分詞啟用失敗，繼續使用正則分詞: {e}")
 
 # ===== Lifespan Context Manager ===== - unchanged
 @asynccontextmanager
@@ -567,6 +958,19 @@ async def lifespan(app: FastAPI):
     logger.info("正在初始化TTS連接池...")
     await connection_pool._ensure_initialized()
     logger.info("TTS連接池初始化完成")
+
+    # jieba 詞典在背景載入，完成前知識庫使用正則分詞
+    segmenter_task = asyncio.create_task(_enable_segmenter())
+    # 意圖路由詞表在背景線程預先編譯，首個聊天請求不必等待
+    intent_router.refresh()
+
+    # 知識庫答案在背景預合成到 TTS 緩存
+    if TTS_PRESYNTH_CONFIG["ENABLED"]:
+        answer_audio.start()
+        answer_audio.schedule_all()  # 由工作協程分頁排入，不延遲啟動；出錯記入 last_error
+    if WEATHER_CONFIG["PREFETCH_ENABLED"]:
+        weather_prefetcher.start()
+    loop_lag_task = asyncio.create_task(monitor_event_loop_lag(event_loop_lag_seconds, event_loop_lag_last))
     
     logger.info(f'{"="*70}')
     logger.info('🚀 小狐狸AI助手 - 極速TTS版服務器')
@@ -590,6 +994,13 @@ async def lifespan(app: FastAPI):
         except asyncio.CancelledError:
             pass
     logger.info("TTS連接池清理完成")
+    if not segmenter_task.done():
+        segmenter_task.cancel()
+    loop_lag_task.cancel()
+    await weather_prefetcher.stop()
+    await answer_audio.stop()
+    tracer.close()
+    knowledge_base.close()
 
 # ===== 創建 FastAPI 實例 ===== - unchanged
 app = FastAPI(
@@ -605,7 +1016,10 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[TRACE_HEADER],
 )
+app.add_middleware(HTTPMetricsMiddleware, histogram=http_request_seconds)
+app.add_middleware(TracingMiddleware, tracer=tracer)
 
 # ===== 靜態文件服務配置 ===== - unchanged
 if not os.path.exists("static"):
@@ -679,6 +1093,9 @@ class ChatRequest(BaseModel):
     prompt: str
     model: str = 'gemini-1.5-flash-001'
     responseLength: str = 'brief'
+    location: Optional[str] = None  # 天氣查詢的地點名稱（WEATHER_LOCATIONS）
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
 
 class QAPairRequest(BaseModel):
     category: str
@@ -713,6 +1130,14 @@ async def health_check():
         },
         "performance": perf_stats,
         "cache": cache_stats,
+        "knowledge_cache": knowledge_base.get_cache_stats(),
+        "weather_cache": weather_service.get_cache_stats(),
+        "weather_prefetch": {
+            **weather_prefetcher.get_stats(),
+            "audio_ready": [f"{site}:{date}" for site in WEATHER_LOCATIONS for date in WeatherPrefetcher.DATES
+                            if answer_audio.has_audio(f"weather:{site}:{date}")]
+        },
+        "tracing": tracer.get_stats(),
         "pool_status": {
             voice: len(connections) for voice, connections in connection_pool.pools.items()
         }
@@ -727,7 +1152,7 @@ async def get_voices():
     return {"voices": EDGE_TTS_VOICES}
 
 @app.post("/api/tts/stream")
-async def tts_stream_optimized(req: TTSRequest):
+async def tts_stream_optimized(req: TTSRequest, request: Request):
     """優化版 TTS 流式合成：先做廣東話數字/單位『點』讀法預處理，再合成"""
     start_time = time.time()
     performance_monitor.record_request("tts_stream")
@@ -742,7 +1167,10 @@ async def tts_stream_optimized(req: TTSRequest):
         logger.info(f"TTS request: voice={req.voice}, rate={req.rate}, pitch={req.pitch}, text_length={len(req.text)}")
 
         # 1) 先查快取
-        cached_audio = await tts_cache.get(req.text, req.voice, req.rate, req.pitch)
+        with tracing.span("tts_cache_lookup") as span:
+            cached_audio = await tts_cache.get(req.text, req.voice, req.rate, req.pitch)
+            span["hit"] = bool(cached_audio)
+        tracing.annotate(voice=req.voice, chars=len(req.text), cache_hit=bool(cached_audio))
         if cached_audio:
             logger.info(f"TTS cache hit: {req.text[:30]}...")
             return await _stream_cached_audio(cached_audio, start_time)
@@ -767,9 +1195,12 @@ async def tts_stream_optimized(req: TTSRequest):
         connection = None
 
         try:
-            connection = await connection_pool.acquire(req.voice)
+            with tracing.span("tts_pool_acquire"):
+                connection = await connection_pool.acquire(req.voice)
             # 4) 合成並以串流方式回傳
-            return await _synthesize_and_stream(connection, processed_text, req, start_time)
+            return await _synthesize_and_stream(connection, processed_text, req, start_time, request)
+        except ClientDisconnected:
+            raise
         except Exception as edge_error:
             edge_tts_failed = True
             edge_error_msg = str(edge_error)
@@ -795,7 +1226,9 @@ async def tts_stream_optimized(req: TTSRequest):
             if AZURE_TTS_ENABLED:
                 logger.info("🔄 Attempting fallback to Azure TTS (Cantonese)...")
                 try:
-                    return await _synthesize_with_azure(processed_text, req, start_time)
+                    return await _synthesize_with_azure(processed_text, req, start_time, request)
+                except ClientDisconnected:
+                    raise
                 except Exception as azure_error:
                     performance_monitor.record_error("azure_tts_failure")
                     logger.warning(f"⚠️ Azure TTS also failed: {azure_error}")
@@ -813,6 +1246,8 @@ async def tts_stream_optimized(req: TTSRequest):
 
     except HTTPException:
         raise  # Re-raise HTTP exceptions as-is
+    except ClientDisconnected:
+        return Response(status_code=499)  # 客戶端已離開，不再回應
     except Exception as e:
         performance_monitor.record_error("tts_synthesis")
         logger.exception(f"TTS error: {e}")
@@ -852,6 +1287,8 @@ async def _stream_cached_audio(cached_audio: bytes, start_time: float):
 
             first_chunk_latency = (time.time() - start_time) * 1000
             performance_monitor.record_first_chunk_latency(first_chunk_latency)
+            tts_first_chunk_seconds.labels("cache").observe(first_chunk_latency / 1000)
+            tracing.mark("tts_first_chunk", provider="cache")
 
             # Stream remaining chunks
             for i in range(first_chunk_size, len(cached_audio), chunk_size):
@@ -932,7 +1369,7 @@ async def _synthesize_with_gtts(text: str, req: TTSRequest, start_time: float):
         raise
 
 
-async def _synthesize_with_azure(text: str, req: TTSRequest, start_time: float):
+async def _synthesize_with_azure(text: str, req: TTSRequest, start_time: float, request: Optional[Request] = None):
     """Synthesize using Azure Cognitive Services TTS (Cantonese)"""
     if not AZURE_TTS_ENABLED:
         raise Exception("Azure TTS not available or not configured")
@@ -986,10 +1423,14 @@ async def _synthesize_with_azure(text: str, req: TTSRequest, start_time: float):
         )
 
         # Synthesize using SSML (run in thread pool to not block event loop)
+        # 客戶端斷線時取消排隊中的工作，並停止正在進行的合成
         loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(
-            None,
-            lambda: synthesizer.speak_ssml_async(ssml).get()
+        result = await _run_until_disconnect(
+            request,
+            loop.run_in_executor(None, lambda: synthesizer.speak_ssml_async(ssml).get()),
+            "tts_azure",
+            on_cancel=synthesizer.stop_speaking_async,
+            chars_saved=len(text)
         )
 
         # Check result
@@ -1007,6 +1448,10 @@ async def _synthesize_with_azure(text: str, req: TTSRequest, start_time: float):
             except Exception as cache_error:
                 logger.warning(f"Failed to cache Azure TTS audio: {cache_error}")
 
+            # Azure 一次合成完整音頻，首段延遲即合成時間
+            tts_first_chunk_seconds.labels("azure").observe(time.time() - start_time)
+            tracing.mark("tts_first_chunk", provider="azure")
+
             # Stream the audio
             async def audio_generator():
                 chunk_size = PERFORMANCE_CONFIG["CHUNK_SIZE"]
@@ -1037,12 +1482,15 @@ async def _synthesize_with_azure(text: str, req: TTSRequest, start_time: float):
         else:
             raise Exception(f"Azure TTS unexpected result: {result.reason}")
 
+    except ClientDisconnected:
+        raise
     except Exception as e:
         logger.error(f"❌ Azure TTS synthesis failed: {e}", exc_info=True)
         raise
 
 
-async def _synthesize_and_stream(connection: TTSConnection, text: str, req: TTSRequest, start_time: float):
+async def _synthesize_and_stream(connection: TTSConnection, text: str, req: TTSRequest, start_time: float,
+                                 request: Optional[Request] = None):
     """合成並流式返回音頻 - Fixed with proper error handling and stream completion"""
     # ✅ Validate text is not empty before synthesis
     if not text or not text.strip():
@@ -1058,10 +1506,17 @@ async def _synthesize_and_stream(connection: TTSConnection, text: str, req: TTSR
     communicate = edge_tts.Communicate(text, req.voice, rate=rate_str, pitch=pitch_str)
 
     # Try to get the first chunk to verify Edge TTS is working
+    stream_iterator = communicate.stream()
     try:
-        stream_iterator = communicate.stream()
-        first_chunk = await stream_iterator.__anext__()
+        with tracing.span("tts_edge_connect"):
+            first_chunk = await _run_until_disconnect(
+                request, stream_iterator.__anext__(), "tts_edge", chars_saved=len(text)
+            )
         # If we got here, Edge TTS is working, proceed with normal streaming
+    except ClientDisconnected:
+        with anyio.CancelScope(shield=True):
+            await stream_iterator.aclose()
+        raise
     except Exception as test_error:
         logger.error(f"Edge TTS failed on first chunk: {test_error}")
         raise  # Raise exception to trigger gTTS fallback
@@ -1071,6 +1526,8 @@ async def _synthesize_and_stream(connection: TTSConnection, text: str, req: TTSR
         first_chunk_sent = False
         chunk_count = 0
         has_audio = False  # Track if any audio was generated
+        cancelled = False
+        spoken_chars = 0  # 已合成句子的字數（SentenceBoundary）
 
         try:
             # Process the first chunk we already fetched
@@ -1084,12 +1541,16 @@ async def _synthesize_and_stream(connection: TTSConnection, text: str, req: TTSR
                 yield audio_data[:first_chunk_size]
                 first_chunk_latency = (time.time() - start_time) * 1000
                 performance_monitor.record_first_chunk_latency(first_chunk_latency)
+                tts_first_chunk_seconds.labels("edge").observe(first_chunk_latency / 1000)
+                tracing.mark("tts_first_chunk", provider="edge")
                 if len(audio_data) > first_chunk_size:
                     yield audio_data[first_chunk_size:]
                 chunk_count += 1
 
             # Continue with remaining chunks
             async for chunk in stream_iterator:
+                if chunk["type"] == "SentenceBoundary":
+                    spoken_chars += len(chunk.get("text", ""))
                 if chunk["type"] == "audio":
                     audio_data = chunk["data"]
                     audio_buffer.write(audio_data)
@@ -1105,6 +1566,11 @@ async def _synthesize_and_stream(connection: TTSConnection, text: str, req: TTSR
             # Log completion status
             logger.info(f"TTS synthesis completed: {chunk_count} chunks, {len(audio_buffer.getvalue())} bytes, has_audio={has_audio}")
 
+        except (GeneratorExit, asyncio.CancelledError):
+            # 客戶端斷線：關閉 Edge 串流，不緩存不完整的音頻
+            cancelled = True
+            raise
+
         except (ClientError, OSError) as exc:
             performance_monitor.record_error("tts_network_unreachable")
             logger.error(f"Edge TTS network error for text '{text[:100]}...': {exc}")
@@ -1117,9 +1583,17 @@ async def _synthesize_and_stream(connection: TTSConnection, text: str, req: TTSR
             # Cannot raise HTTPException here - response already started streaming
             # Client will receive empty/partial audio and handle with fallback
         finally:
-            # Always try to cache the audio we did generate
             complete_audio = audio_buffer.getvalue()
-            if len(complete_audio) > 0:
+            if cancelled:
+                with anyio.CancelScope(shield=True):
+                    await stream_iterator.aclose()
+                performance_monitor.record_cancellation(
+                    "tts_edge",
+                    chars_saved=max(0, len(text) - spoken_chars),
+                    bytes_streamed=len(complete_audio)
+                )
+            # Always try to cache the audio we did generate
+            elif len(complete_audio) > 0:
                 try:
                     await tts_cache.put(req.text, req.voice, req.rate, req.pitch, complete_audio)
                     logger.debug(f"Cached TTS audio: {req.text[:30]}... ({len(complete_audio)} bytes)")
@@ -1136,16 +1610,17 @@ async def _synthesize_and_stream(connection: TTSConnection, text: str, req: TTSR
         "X-Content-Type-Options": "nosniff"
     }
 
-    return StreamingResponse(
+    return CancellableStreamingResponse(
         audio_generator(),
         media_type="audio/mpeg",
-        headers=headers
+        headers=headers,
+        kind="tts_edge"
     )
 
 @app.post("/api/tts")
-async def tts_alias(req: TTSRequest):
+async def tts_alias(req: TTSRequest, request: Request):
     """TTS別名端點（向後兼容）- unchanged"""
-    return await tts_stream_optimized(req)
+    return await tts_stream_optimized(req, request)
 
 # TTS status tracking
 _tts_status = {
@@ -1203,33 +1678,81 @@ async def get_tts_status():
         "recommended_action": None if edge_available else "Edge TTS unavailable. Please check network connection or try again later."
     }
 
+def _ingest_client_events(request: Request, meta: dict, events: list) -> dict:
+    client_host = request.client.host if request.client else "unknown"
+    key = client_telemetry.client_key(meta.get("session_id") or request.headers.get("X-Session-Id"), client_host)
+    result = client_telemetry.ingest(events, key, sent_at=meta.get("sent_at"))
+    for _ in range(result["counts"].get("error", 0) + result["counts"].get("tts_error", 0)):
+        performance_monitor.record_error("client_error")
+    if result["counts"].get("tts_alert"):
+        alerts = [e.get("alert") for e in events if isinstance(e, dict) and e.get("type") == "tts_alert"]
+        logger.warning(f"Client TTS alert ({key}): {alerts[:3]}")
+    return result
+
+
 @app.post("/api/telemetry")
 async def record_telemetry(request: Request):
-    """記錄遙測數據 - unchanged"""
+    """記錄單一遙測事件（舊格式：data 為數值或句間空隙列表）；新客戶端請用 /api/telemetry/batch"""
     try:
         data = await request.json()
         telemetry_type = data.get("type")
-        
-        if telemetry_type == "first_chunk":
-            latency = data.get("data", 0)
-            performance_monitor.record_first_chunk_latency(latency)
-        elif telemetry_type == "chunk_gap":
-            gaps = data.get("data", [])
-            for gap in gaps[-5:]:
-                performance_monitor.record_chunk_gap(gap)
-        elif telemetry_type == "error":
-            performance_monitor.record_error("client_error")
-        
+        value = data.get("data")
+        if telemetry_type == "chunk_gap" and isinstance(value, list):
+            events = [{"type": "chunk_gap", "value": gap} for gap in value]
+        elif isinstance(value, (int, float)):
+            events = [{"type": telemetry_type, "value": value}]
+        else:
+            events = [data]
+        _ingest_client_events(request, data, events)
         return {"status": "recorded"}
     except Exception as e:
         logger.error(f"Telemetry error: {e}")
         return {"status": "error", "message": str(e)}
 
+
+@app.post("/api/telemetry/batch")
+async def record_telemetry_batch(request: Request):
+    """
+    批量遙測：JSON 陣列、{"session_id", "sent_at", "events": [...]} 或 NDJSON；
+    每個事件為 {"type", "value"（毫秒，延遲類）, "ts"（客戶端時間，毫秒）}。
+    navigator.sendBeacon 以 text/plain 送出，因此不檢查 Content-Type
+    """
+    body = await request.body()
+    if len(body) > TELEMETRY_CONFIG["MAX_BODY_KB"] * 1024:
+        raise HTTPException(status_code=413, detail="telemetry batch too large")
+    try:
+        meta, events = parse_batch(body)
+    except TelemetryFormatError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    meta = {**dict(request.query_params), **meta}
+    if isinstance(meta.get("sent_at"), str):
+        try:
+            meta["sent_at"] = float(meta["sent_at"])
+        except ValueError:
+            meta["sent_at"] = None
+    return {"status": "recorded", **_ingest_client_events(request, meta, events)}
+
+
+@app.get("/api/telemetry/clients/{client_id}")
+async def get_client_telemetry(client_id: str):
+    """單一客戶端（session_id）的延遲分佈及事件計數"""
+    stats = client_telemetry.get_client(client_id)
+    if stats is None:
+        raise HTTPException(status_code=404, detail="client not found")
+    return stats
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus 抓取端點"""
+    return Response(metrics_registry.render(), media_type=METRICS_CONTENT_TYPE)
+
 @app.get("/api/performance")
-async def get_performance_metrics():
-    """獲取性能指標 - unchanged"""
+async def get_performance_metrics(window: str = "1h"):
+    """獲取性能指標；window = 1m / 5m / 1h / all"""
+    if window not in WINDOWS and window != "all":
+        raise HTTPException(status_code=400, detail=f"window 必須是 {', '.join(WINDOWS)} 或 all")
     return {
-        "performance": performance_monitor.get_stats(),
+        "performance": performance_monitor.get_stats(window),
         "cache": tts_cache.get_stats(),
         "pool_status": {
             voice: {
@@ -1239,6 +1762,10 @@ async def get_performance_metrics():
             }
             for voice, connections in connection_pool.pools.items()
         },
+        "llm_rate_limits": llm_rate_limiter.get_stats(),
+        "model_routing": model_router.get_stats(),
+        "segmenter": segmenter.get_stats(),
+        "client_telemetry": client_telemetry.get_stats(window),
         "config": PERFORMANCE_CONFIG
     }
 
@@ -1296,23 +1823,69 @@ async def test_qwen_api():
             }
 
 # ===== 知識庫 API =====
+KB_PAGE_SIZE = 100
+KB_PAGE_MAX = 1000
+
+
+async def _stream_qa_pages(fields, search, category, to_record=None):
+    """按 id 逐頁讀取並輸出 NDJSON，每次只持有一頁"""
+    after_id = 0
+    while True:
+        page = await knowledge_base.run_async(knowledge_base.list_page, after_id, EXPORT_PAGE,
+                                              fields, search, category)
+        if not page:
+            break
+        yield "".join(json.dumps(to_record(qa) if to_record else qa, ensure_ascii=False) + "\n"
+                      for qa in page)
+        after_id = page[-1]["id"]
+
+
 @app.get("/api/knowledge/qa-pairs")
-async def get_qa_pairs():
-    """獲取所有問答對"""
+async def get_qa_pairs(after_id: int = 0, limit: int = KB_PAGE_SIZE, fields: Optional[str] = None,
+                       q: Optional[str] = None, category: Optional[str] = None, format: str = "json"):
+    """
+    分頁獲取問答對（按 id 的 keyset 分頁，下一頁以 next_after_id 作 after_id）
+    fields: 逗號分隔的欄位，例如 id,questions；q: 問題、別名或答案包含的文字；
+    format=ndjson 時忽略 limit，串流輸出所有符合條件的問答
+    """
+    field_list = [f.strip() for f in fields.split(",") if f.strip()] if fields else None
+    if field_list is not None and not set(field_list) <= set(LIST_FIELDS):
+        raise HTTPException(status_code=400, detail=f"fields must be a subset of {', '.join(LIST_FIELDS)}")
+    if format not in ("json", "ndjson"):
+        raise HTTPException(status_code=400, detail="format must be json or ndjson")
+    q = q.strip() if q else None
+
+    if format == "ndjson":
+        return StreamingResponse(_stream_qa_pages(field_list, q, category), media_type="application/x-ndjson")
+
+    limit = max(1, min(limit, KB_PAGE_MAX))
     try:
-        qa_pairs = knowledge_base.get_all_qa_pairs()
-        return {
-            "status": "success",
-            "data": qa_pairs
-        }
+        # 多取一條以判斷是否還有下一頁
+        page = await knowledge_base.run_async(knowledge_base.list_page, after_id, limit + 1,
+                                              field_list, q, category)
+        summary = await knowledge_base.run_async(knowledge_base.get_summary)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    has_more = len(page) > limit
+    page = page[:limit]
+    return {
+        "status": "success",
+        "data": page,
+        "next_after_id": page[-1]["id"] if has_more else None,
+        "categories": summary["categories"],
+        "stats": {"total": summary["total"], "enabled": summary["enabled"],
+                  "cache_info": knowledge_base.get_cache_stats()}
+    }
 
 @app.post("/api/knowledge/qa-pairs")
 async def add_qa_pair_endpoint(req: QAPairRequest):
     """添加新的問答對"""
+    if not req.questions:
+        raise HTTPException(status_code=400, detail="At least one question is required")
     try:
-        qa_pair = knowledge_base.add_qa_pair(req.questions[0], req.answer)  # Simplified for now
+        qa_pair = await knowledge_base.run_async(knowledge_base.add_qa_pair, req.questions[0], req.answer,
+                                                 req.category, req.questions[1:])
+        answer_audio.schedule(qa_pair["id"])
         return {
             "status": "success",
             "data": qa_pair
@@ -1326,8 +1899,9 @@ async def add_qa_pair_endpoint(req: QAPairRequest):
 async def toggle_qa_pair(qa_id: int):
     """啟用/停用問答對"""
     try:
-        result = knowledge_base.toggle_qa_pair(qa_id)
+        result = await knowledge_base.run_async(knowledge_base.toggle_qa_pair, qa_id)
         if result:
+            answer_audio.schedule(qa_id)
             return {"status": "success", "data": result}
         else:
             raise HTTPException(status_code=404, detail="QA pair not found")
@@ -1338,8 +1912,9 @@ async def toggle_qa_pair(qa_id: int):
 async def delete_qa_pair(qa_id: int):
     """刪除問答對"""
     try:
-        success = knowledge_base.delete_qa_pair(qa_id)
+        success = await knowledge_base.run_async(knowledge_base.delete_qa_pair, qa_id)
         if success:
+            answer_audio.schedule(qa_id)
             return {"status": "success"}
         else:
             raise HTTPException(status_code=404, detail="QA pair not found")
@@ -1349,9 +1924,13 @@ async def delete_qa_pair(qa_id: int):
 @app.put("/api/knowledge/qa-pairs/{qa_id}")
 async def update_qa_pair(qa_id: int, req: QAPairRequest):
     """更新問答對"""
+    if not req.questions:
+        raise HTTPException(status_code=400, detail="At least one question is required")
     try:
-        result = knowledge_base.update_qa_pair(qa_id, req.questions[0], req.answer)
+        result = await knowledge_base.run_async(knowledge_base.update_qa_pair, qa_id, req.questions[0], req.answer,
+                                                req.category, req.questions[1:])
         if result:
+            answer_audio.schedule(qa_id)
             return {"status": "success", "data": result}
         else:
             raise HTTPException(status_code=404, detail="QA pair not found")
@@ -1360,6 +1939,68 @@ async def update_qa_pair(qa_id: int, req: QAPairRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/knowledge/import")
+async def import_qa_pairs(request: Request):
+    """
+    批量匯入 JSONL（每行 {"questions": [...], "answer": "...", "category": "..."}）
+    先接收並切行（上限 KNOWLEDGE_IMPORT_MAX_MB），再在一個交易中寫入；任何一行格式錯誤則整批回滾
+    """
+    max_bytes = int(KNOWLEDGE_IMPORT_MAX_MB * 1024 * 1024)
+    too_large = HTTPException(status_code=413, detail=f"import exceeds {KNOWLEDGE_IMPORT_MAX_MB:g} MB")
+    if request.headers.get("content-length", "").isdigit() and int(request.headers["content-length"]) > max_bytes:
+        raise too_large
+    lines = []
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    pending = ""
+    received = 0
+    async for chunk in request.stream():
+        received += len(chunk)
+        if received > max_bytes:
+            raise too_large
+        pending += decoder.decode(chunk)
+        *complete, pending = pending.split("\n")
+        lines.extend(complete)
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        lines.append(pending)
+
+    try:
+        stats = await knowledge_base.run_async(knowledge_base.import_jsonl, lines)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if stats["imported"]:
+        answer_audio.schedule_all()  # 由預合成工作協程在背景分頁排入，不阻塞匯入請求
+    return {"status": "success", "data": stats}
+
+@app.get("/api/knowledge/export")
+async def export_qa_pairs():
+    """以 JSONL 串流匯出所有問答（含別名及分類），格式與匯入相同"""
+    def to_record(qa):
+        return {"id": qa["id"], "category": qa["category"], "questions": qa["questions"],
+                "answer": qa["answer"], "enabled": bool(qa["enabled"])}
+
+    return StreamingResponse(_stream_qa_pages(None, None, None, to_record), media_type="application/x-ndjson",
+                             headers={"Content-Disposition": "attachment; filename=knowledge_base.jsonl"})
+
+@app.get("/api/knowledge/tts-presynthesis")
+async def get_tts_presynthesis():
+    """知識庫答案語音預合成的進度及積壓"""
+    return {"status": "success", "enabled": TTS_PRESYNTH_CONFIG["ENABLED"], "data": answer_audio.get_stats()}
+
+def _resolve_weather_location(req: ChatRequest):
+    """返回 (地點名稱或 None, 座標)：座標優先，其次地點名稱，否則預設地點"""
+    if req.latitude is not None or req.longitude is not None:
+        if req.latitude is None or req.longitude is None \
+                or not -90 <= req.latitude <= 90 or not -180 <= req.longitude <= 180:
+            raise HTTPException(status_code=400, detail="latitude 及 longitude 必須同時提供且在有效範圍內")
+        return None, {"latitude": req.latitude, "longitude": req.longitude, "timezone": "auto"}
+    site = req.location or "default"
+    if site not in WEATHER_LOCATIONS:
+        raise HTTPException(status_code=400, detail=f"未知的地點: {site}")
+    return site, WEATHER_LOCATIONS[site]
+
 # ===== LLM-CONTEXT-START: CHAT ROUTE =====
 # @LLM-CONTEXT: 核心聊天路由邏輯
 # ===== Chat API =====
@@ -1368,14 +2009,35 @@ async def chat(req: ChatRequest):
     """聊天API（添加性能監控）"""
     performance_monitor.record_request("chat")
     
+    # 預編譯自動機判斷意圖：天氣 → 按摩指令（直接交 LLM）→ 知識庫 → LLM
+    with tracing.span("intent"):
+        intent = intent_router.classify(req.prompt)
+
     # 先检查是否是天气查询
-    weather_intent = weather_service.extract_weather_intent(req.prompt)
+    weather_intent = intent.weather
     if weather_intent:
         logger.info(f"Weather query detected: {req.prompt[:30]}...")
-        weather_data = await weather_service.get_weather(weather_intent['date'])
-        if weather_data:
-            response = weather_service.format_weather_response(weather_data)
-            
+        site, location = _resolve_weather_location(req)
+        weather_start = time.perf_counter()
+        # 優先使用預取時已格式化的回應（文字不變，語音已預合成）
+        response = weather_prefetcher.get_response(weather_intent['date'], site) if site else None
+        source = "prefetched"
+        if response is None:
+            weather_data = await weather_service.get_weather(weather_intent['date'],
+                                                             timeout=WEATHER_CONFIG["BUDGET_SECONDS"],
+                                                             location=location)
+            source = "service"
+            if weather_data:
+                response = weather_service.format_weather_response(weather_data)
+            else:
+                source = "unavailable"
+                performance_monitor.record_error("weather_unavailable")
+                if WEATHER_CONFIG["ON_TIMEOUT"] == "placeholder":
+                    response = WEATHER_CONFIG["PLACEHOLDER"]
+        weather_lookup_seconds.labels(source).observe(time.perf_counter() - weather_start)
+        tracing.record("weather", (time.perf_counter() - weather_start) * 1000, source=source)
+        tracing.annotate(route="weather")
+        if response:
             # 返回天气响应
             async def weather_event_generator():
                 response_data = {
@@ -1389,10 +2051,16 @@ async def chat(req: ChatRequest):
             
             return StreamingResponse(weather_event_generator(), media_type="text/event-stream")
     
-    # 再检查知识库
-    kb_answer = knowledge_base.find_answer(req.prompt)
+    # 再检查知识库（問題不含任何知識庫詞語時不可能命中，直接跳過）
+    kb_answer = None
+    if intent.knowledge and not intent.massage_command:
+        kb_start = time.perf_counter()
+        kb_answer = await knowledge_base.run_async(knowledge_base.find_answer, req.prompt)
+        kb_lookup_seconds.labels("hit" if kb_answer else "miss").observe(time.perf_counter() - kb_start)
+        tracing.record("kb_lookup", (time.perf_counter() - kb_start) * 1000, hit=bool(kb_answer))
     if kb_answer:
         logger.info(f"Knowledge base hit: {req.prompt[:30]}...")
+        tracing.annotate(route="knowledge_base")
         
         # 返回知识库答案的流式响应
         async def kb_event_generator():
@@ -1408,17 +2076,227 @@ async def chat(req: ChatRequest):
         return StreamingResponse(kb_event_generator(), media_type="text/event-stream")
     
     # 如果都没有匹配，使用 AI 模型处理
+    if req.model == AUTO_MODEL:
+        req.model = _choose_auto_model()
+        logger.info(f"Auto routing selected {req.model}")
+
+    # 先經供應商限流
+    tracing.annotate(route="llm", model=req.model)
+    try:
+        with tracing.span("llm_queue"):
+            lease = await _acquire_llm_lease(req)
+    except RateLimitExceeded as e:
+        performance_monitor.record_error("llm_rate_limited")
+        logger.warning(f"LLM request rejected by rate limiter: {e}")
+        raise HTTPException(
+            status_code=429,
+            detail=f"{e.provider} 服務繁忙，請稍後再試",
+            headers={"Retry-After": str(max(1, round(e.retry_after)))}
+        )
+
+    try:
+        response = await _dispatch_chat(req, lease)
+    except BaseException:
+        lease.release()
+        raise
+
+    # 串流結束（或客戶端斷線）後才釋放並發名額
+    response.background = BackgroundTask(lease.release)
+    return response
+
+
+def _resolve_llm_provider(model: str) -> str:
+    """按 _dispatch_chat 的分派規則推斷模型所屬供應商"""
+    model_config = AVAILABLE_MODELS.get(model)
+    if model_config:
+        return model_config['provider']
+
+    model_name = MODEL_ALIASES.get(model, model)
+    if model_name.startswith('deepseek'):
+        return 'deepseek'
+    elif model.startswith('together'):
+        return 'together'
+    elif model_name.startswith('qwen'):
+        return 'qwen'
+    elif model_name.startswith('xunfei'):
+        return 'xunfei'
+    return 'gemini'
+
+
+def _llm_route_key(model: str) -> str:
+    """模型在指標及路由中的鍵（provider/model_id，與 LLMCallTimer 一致）"""
+    provider = _resolve_llm_provider(model)
+    model_config = AVAILABLE_MODELS.get(model)
+    if model_config:
+        model_id = model_config['model_id']
+    elif provider == 'deepseek':
+        model_id = 'deepseek-chat'
+    else:
+        model_id = MODEL_ALIASES.get(model, model)
+    return f"{provider}/{model_id}"
+
+
+def _choose_auto_model() -> str:
+    """為 "auto" 選擇具備所需能力且已配置的最快模型"""
+    required = set(AUTO_ROUTING_CONFIG["REQUIRE_CAPABILITIES"])
+    candidates = {
+        model: _llm_route_key(model)
+        for model, capabilities in AUTO_ROUTING_CANDIDATES.items()
+        if required <= set(capabilities) and _provider_configured(_resolve_llm_provider(model))
+    }
+    if not candidates:
+        raise HTTPException(status_code=503, detail="No configured model available for auto routing")
+    return model_router.choose(candidates)
+
+
+def _provider_configured(provider: str) -> bool:
+    """供應商是否已配置 API Key"""
+    return {
+        'together': bool(TOGETHER_API_KEY and TOGETHER_API_KEY != 'your_together_api_key'),
+        'qwen': bool(QWEN_API_KEY),
+        'deepseek': bool(DEEPSEEK_API_KEY),
+        'gemini': bool(GEMINI_API_KEY and GEMINI_API_KEY != 'your_gemini_api_key'),
+    }.get(provider, False)
+
+
+# 各回答長度的最大輸出 token，用於估算 token 預算
+LLM_RESPONSE_TOKENS = {'very_brief': 50, 'brief': 100, 'normal': 200, 'detailed': 350}
+
+async def _acquire_llm_lease(req: ChatRequest):
+    """取得供應商配額；排隊超時則嘗試後備供應商（會改寫 req.model）"""
+    tokens = len(req.prompt) + LLM_RESPONSE_TOKENS.get(req.responseLength, 200)
+    provider = _resolve_llm_provider(req.model)
+
+    try:
+        return await llm_rate_limiter.acquire(provider, tokens)
+    except RateLimitExceeded as first_error:
+        for model in LLM_FAILOVER_MODELS:
+            fallback = _resolve_llm_provider(model)
+            if fallback == provider or not _provider_configured(fallback):
+                continue
+            try:
+                lease = await llm_rate_limiter.acquire(fallback, tokens, timeout=0)
+            except RateLimitExceeded:
+                continue
+            logger.warning(f"{provider} rate limited ({first_error.reason}), failing over to {model}")
+            performance_monitor.record_request(f"llm_failover_{fallback}")
+            req.model = model
+            return lease
+        raise first_error
+
+
+def _report_upstream_status(lease, response):
+    """把上游狀態碼回報給限流器（429 會自動降速）"""
+    if lease is None:
+        return
+    if response.status_code == 429:
+        lease.throttled(response.headers.get('Retry-After'))
+    elif response.status_code == 200:
+        lease.succeeded()
+
+
+class LLMCallTimer:
+    """記錄單次 LLM 串流的連接時間、首 token 時間、總時長及吞吐量"""
+
+    def __init__(self, provider: str, model_id: str, max_tokens: int = 0):
+        self.provider = provider
+        self.model_id = model_id
+        self.max_tokens = max_tokens
+        self.start = time.time()
+        self.connect_ms = None
+        self.first_token_ms = None
+        self.chars = 0
+        self.deltas = 0  # 串流增量數；供應商可在一個增量中合併多個 token
+        self.bytes = 0
+        self.ok = True
+        self.was_cancelled = False
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+        self._sse_buffer = ""
+
+    def connected(self):
+        """上游返回響應標頭"""
+        if self.connect_ms is None:
+            self.connect_ms = (time.time() - self.start) * 1000
+            tracing.mark("llm_connected", provider=self.provider)
+
+    def feed_sse(self, chunk):
+        """解析 OpenAI 格式 SSE 片段，統計內容字數"""
+        if isinstance(chunk, bytes):
+            self.bytes += len(chunk)
+            chunk = self._decoder.decode(chunk)
+        else:
+            self.bytes += len(chunk.encode('utf-8'))
+
+        self._sse_buffer += chunk
+        *lines, self._sse_buffer = self._sse_buffer.split('\n')
+        for line in lines:
+            line = line.strip()
+            if not line.startswith('data: ') or line == 'data: [DONE]':
+                continue
+            try:
+                data = json.loads(line[6:])
+            except json.JSONDecodeError:
+                continue
+            for choice in data.get('choices', []):
+                content = (choice.get('delta') or {}).get('content')
+                if content:
+                    self.add_content(content)
+
+    def add_content(self, text: str):
+        """記錄一個串流增量"""
+        if self.first_token_ms is None:
+            self.first_token_ms = (time.time() - self.start) * 1000
+            tracing.mark("llm_first_token", provider=self.provider)
+        self.chars += len(text)
+        self.deltas += 1
+
+    def failed(self):
+        self.ok = False
+
+    def cancelled(self):
+        """客戶端斷線，上游串流被提前關閉"""
+        self.was_cancelled = True
+
+    def finish(self):
+        if self.was_cancelled:
+            performance_monitor.record_cancellation(
+                f"llm_{self.provider}",
+                deltas_streamed=self.deltas,
+                # 每個增量至少一個 token，故為節省量的上限
+                tokens_saved=max(0, self.max_tokens - self.deltas)
+            )
+        # 首 token 前被取消的調用不代表供應商健康狀況
+        if not (self.was_cancelled and self.first_token_ms is None):
+            model_router.observe(f"{self.provider}/{self.model_id}", self.first_token_ms, self.ok)
+        if self.first_token_ms is not None:
+            llm_first_token_seconds.labels(self.provider, self.model_id).observe(self.first_token_ms / 1000)
+        tracing.record("llm_stream", (time.time() - self.start) * 1000, provider=self.provider,
+                       model=self.model_id, deltas=self.deltas, ok=self.ok, cancelled=self.was_cancelled)
+        performance_monitor.record_llm_call(
+            self.provider, self.model_id,
+            connect_ms=self.connect_ms,
+            first_token_ms=self.first_token_ms,
+            duration_ms=(time.time() - self.start) * 1000,
+            chars=self.chars,
+            deltas=self.deltas,
+            bytes_received=self.bytes,
+            ok=self.ok
+        )
+
+
+async def _dispatch_chat(req: ChatRequest, lease=None):
+    """按模型分派到對應供應商"""
     model_config = AVAILABLE_MODELS.get(req.model)
     
     if model_config:
         provider = model_config.get('provider')
         
         if provider == 'together':
-            return await handle_together_request(req.prompt, model_config, req.responseLength)
+            return await handle_together_request(req.prompt, model_config, req.responseLength, lease=lease)
         elif provider == 'qwen':
-            return await chat_with_qwen(req)
+            return await chat_with_qwen(req, lease=lease)
         elif provider == 'deepseek':
-            return await chat_with_deepseek(req)
+            return await chat_with_deepseek(req, lease=lease)
         else:
             raise HTTPException(status_code=501, detail=f"Provider {provider} is not implemented")
     
@@ -1427,7 +2305,7 @@ async def chat(req: ChatRequest):
     
     try:
         if model_name.startswith('deepseek'):
-            return await chat_with_deepseek(req)
+            return await chat_with_deepseek(req, lease=lease)
         elif req.model.startswith('together'):
             # 对于 together 模型，尝试从别名获取完整的 model_id
             full_model_id = MODEL_ALIASES.get(req.model)
@@ -1439,14 +2317,14 @@ async def chat(req: ChatRequest):
                 "model_id": full_model_id,
                 "name": req.model
             }
-            return await handle_together_request(req.prompt, model_config, req.responseLength)
+            return await handle_together_request(req.prompt, model_config, req.responseLength, lease=lease)
         elif model_name.startswith('qwen'):
-            return await chat_with_qwen(req)
+            return await chat_with_qwen(req, lease=lease)
         elif model_name.startswith('xunfei'):
             return await chat_with_xunfei(req)
         else:
             req.model = model_name
-            return await chat_with_gemini(req)
+            return await chat_with_gemini(req, lease=lease)
             
     except Exception as e:
         performance_monitor.record_error("chat_general")
@@ -1456,7 +2334,7 @@ async def chat(req: ChatRequest):
 
 # ===== LLM-REF-START: CHAT HANDLERS =====
 # @LLM-REF: 聊天處理函數 - 已穩定運行
-async def chat_with_deepseek(req: ChatRequest):
+async def chat_with_deepseek(req: ChatRequest, lease=None):
     """使用 DeepSeek API 進行聊天 - unchanged"""
     if not DEEPSEEK_API_KEY:
         raise HTTPException(status_code=500, detail="DEEPSEEK_API_KEY is not configured")
@@ -1480,6 +2358,7 @@ async def chat_with_deepseek(req: ChatRequest):
     }
     
     async def event_generator():
+        timer = LLMCallTimer("deepseek", request_body["model"], request_body["max_tokens"])
         async with httpx.AsyncClient(timeout=60.0) as client:
             headers = {
                 "Content-Type": "application/json",
@@ -1488,7 +2367,10 @@ async def chat_with_deepseek(req: ChatRequest):
             
             try:
                 async with client.stream("POST", DEEPSEEK_API_URL, json=request_body, headers=headers) as response:
+                    timer.connected()
+                    _report_upstream_status(lease, response)
                     if response.status_code != 200:
+                        timer.failed()
                         performance_monitor.record_error("deepseek_api")
                         error_body = await response.aread()
                         error_text = error_body.decode('utf-8')
@@ -1505,6 +2387,7 @@ async def chat_with_deepseek(req: ChatRequest):
                     
                     buffer = ""
                     async for chunk in response.aiter_text():
+                        timer.feed_sse(chunk)
                         buffer += chunk
                         lines = buffer.split('\n')
                         buffer = lines[-1]
@@ -1525,13 +2408,20 @@ async def chat_with_deepseek(req: ChatRequest):
                                     except Exception:
                                         continue
                                         
+            except (GeneratorExit, asyncio.CancelledError):
+                # 客戶端斷線：退出 async with 會關閉上游 httpx 串流
+                timer.cancelled()
+                raise
             except Exception as e:
+                timer.failed()
                 performance_monitor.record_error("deepseek_stream")
                 error_response = {'choices': [{'delta': {'content': f'DeepSeek 服務錯誤: {str(e)}'}, 'finish_reason': 'error'}]}
                 yield f"data: {json.dumps(error_response, ensure_ascii=False)}\n\n"
                 yield f"data: [DONE]\n\n"
+            finally:
+                timer.finish()
     
-    return StreamingResponse(event_generator(), media_type="text/event-stream")
+    return CancellableStreamingResponse(event_generator(), media_type="text/event-stream", kind="llm_deepseek")
 
 def clean_together_output(text: str, model_id: str) -> str:
     """清理 Together API 模型的輸出"""
@@ -1561,7 +2451,7 @@ def clean_together_output(text: str, model_id: str) -> str:
     
     return text.strip()
 
-async def handle_together_request(prompt: str, model_config: dict, response_length: str):
+async def handle_together_request(prompt: str, model_config: dict, response_length: str, lease=None):
     log(f"Calling Together API - Model: {model_config['model_id']}, Length: {response_length}")
     
     if not TOGETHER_API_KEY or TOGETHER_API_KEY == 'your_together_api_key':
@@ -1614,6 +2504,7 @@ Example bad response: 你好！😊 [Note: Using friendly tone] I'm here to help
     }
 
     async def event_generator():
+        timer = LLMCallTimer("together", model_config['model_id'], config['max_tokens'])
         async with httpx.AsyncClient(timeout=60.0) as client:
             headers = {
                 'Content-Type': 'application/json',
@@ -1622,7 +2513,10 @@ Example bad response: 你好！😊 [Note: Using friendly tone] I'm here to help
             
             try:
                 async with client.stream("POST", TOGETHER_API_URL, json=request_body, headers=headers) as response:
+                    timer.connected()
+                    _report_upstream_status(lease, response)
                     if response.status_code != 200:
+                        timer.failed()
                         error_text = await response.aread()
                         error_response = {'choices': [{'delta': {'content': 'Together API 錯誤'}, 'finish_reason': 'error'}]}
                         yield f"data: {json.dumps(error_response, ensure_ascii=False)}\n\n"
@@ -1634,6 +2528,7 @@ Example bad response: 你好！😊 [Note: Using friendly tone] I'm here to help
                         full_response = ""
                         
                         async for chunk in response.aiter_bytes():
+                            timer.feed_sse(chunk)
                             chunk_str = chunk.decode('utf-8', 'ignore')
                             
                             # 解析 SSE 格式
@@ -1666,17 +2561,25 @@ Example bad response: 你好！😊 [Note: Using friendly tone] I'm here to help
                     else:
                         # 其他模型直接轉發
                         async for chunk in response.aiter_bytes():
+                            timer.feed_sse(chunk)
                             yield chunk
 
+            except (GeneratorExit, asyncio.CancelledError):
+                # 客戶端斷線：退出 async with 會關閉上游 httpx 串流
+                timer.cancelled()
+                raise
             except Exception as e:
+                timer.failed()
                 error_response = {'choices': [{'delta': {'content': f'Together 服務錯誤: {e}'}, 'finish_reason': 'error'}]}
                 yield f"data: {json.dumps(error_response, ensure_ascii=False)}\n\n"
                 yield f"data: [DONE]\n\n"
+            finally:
+                timer.finish()
 
-    return StreamingResponse(event_generator(), media_type="text/event-stream")
+    return CancellableStreamingResponse(event_generator(), media_type="text/event-stream", kind="llm_together")
 
 # Updated Qwen handler from server_gemini.py
-async def chat_with_qwen(req: ChatRequest):
+async def chat_with_qwen(req: ChatRequest, lease=None):
     """使用 Qwen API 進行聊天 - Updated from server_gemini.py"""
     log(f"Calling Qwen API (stream) - Model: {req.model}, Length: {req.responseLength}")
     
@@ -1718,10 +2621,14 @@ async def chat_with_qwen(req: ChatRequest):
     }
 
     async def event_generator():
+        timer = LLMCallTimer("qwen", model_id, config['max_tokens'])
         async with httpx.AsyncClient(timeout=60.0) as client:
             try:
                 async with client.stream("POST", QWEN_API_URL, json=request_body, headers=headers) as response:
+                    timer.connected()
+                    _report_upstream_status(lease, response)
                     if response.status_code != 200:
+                        timer.failed()
                         error_text = await response.aread()
                         log(f"Qwen API Error: {response.status_code} - {error_text.decode()}")
                         error_response = {'choices': [{'delta': {'content': 'Qwen API 錯誤'}, 'finish_reason': 'error'}]}
@@ -1730,15 +2637,23 @@ async def chat_with_qwen(req: ChatRequest):
                         return
 
                     async for chunk in response.aiter_bytes():
+                        timer.feed_sse(chunk)
                         yield chunk
 
+            except (GeneratorExit, asyncio.CancelledError):
+                # 客戶端斷線：退出 async with 會關閉上游 httpx 串流
+                timer.cancelled()
+                raise
             except Exception as e:
+                timer.failed()
                 log(f"Qwen stream error: {e}")
                 error_response = {'choices': [{'delta': {'content': f'Qwen 服務錯誤: {e}'}, 'finish_reason': 'error'}]}
                 yield f"data: {json.dumps(error_response, ensure_ascii=False)}\n\n"
                 yield f"data: [DONE]\n\n"
+            finally:
+                timer.finish()
 
-    return StreamingResponse(event_generator(), media_type="text/event-stream")
+    return CancellableStreamingResponse(event_generator(), media_type="text/event-stream", kind="llm_qwen")
 
 async def chat_with_xunfei(req: ChatRequest):
     """使用訊飛星火 API 進行聊天 - unchanged"""
@@ -1757,7 +2672,7 @@ async def chat_with_xunfei(req: ChatRequest):
     
     return StreamingResponse(event_generator(), media_type="text/event-stream")
 
-async def chat_with_gemini(req: ChatRequest):
+async def chat_with_gemini(req: ChatRequest, lease=None):
     """使用 Gemini API 進行聊天 - unchanged"""
     if not GEMINI_API_KEY or GEMINI_API_KEY == 'your_gemini_api_key':
         raise HTTPException(status_code=500, detail="GEMINI_API_KEY is not configured")
@@ -1783,12 +2698,16 @@ async def chat_with_gemini(req: ChatRequest):
     }
 
     async def event_generator():
+        timer = LLMCallTimer("gemini", model_id, request_body["generationConfig"]["maxOutputTokens"])
         async with httpx.AsyncClient(timeout=60.0) as client:
             url = f"{GEMINI_API_URL}?key={GEMINI_API_KEY}&alt=sse"
             
             try:
                 async with client.stream("POST", url, json=request_body, headers={"Content-Type": "application/json"}) as response:
+                    timer.connected()
+                    _report_upstream_status(lease, response)
                     if response.status_code != 200:
+                        timer.failed()
                         performance_monitor.record_error("gemini_api")
                         error_body = await response.aread()
                         error_text = error_body.decode('utf-8')
@@ -1805,6 +2724,7 @@ async def chat_with_gemini(req: ChatRequest):
 
                     buffer = ""
                     async for chunk in response.aiter_text():
+                        timer.bytes += len(chunk.encode('utf-8'))
                         buffer += chunk
                         lines = buffer.split('\n')
                         buffer = lines[-1]
@@ -1830,6 +2750,7 @@ async def chat_with_gemini(req: ChatRequest):
                                                 for part in parts:
                                                     if 'text' in part:
                                                         text = part['text']
+                                                        timer.add_content(text)
                                                         
                                                         openai_format = {
                                                             'choices': [{
@@ -1842,13 +2763,20 @@ async def chat_with_gemini(req: ChatRequest):
                                     except json.JSONDecodeError:
                                         continue
 
+            except (GeneratorExit, asyncio.CancelledError):
+                # 客戶端斷線：退出 async with 會關閉上游 httpx 串流
+                timer.cancelled()
+                raise
             except Exception as e:
+                timer.failed()
                 performance_monitor.record_error("gemini_stream")
                 error_response = {'choices': [{'delta': {'content': f'Gemini 服務錯誤: {str(e)}'}, 'finish_reason': 'error'}]}
                 yield f"data: {json.dumps(error_response, ensure_ascii=False)}\n\n"
                 yield f"data: [DONE]\n\n"
+            finally:
+                timer.finish()
 
-    return StreamingResponse(event_generator(), media_type="text/event-stream")
+    return CancellableStreamingResponse(event_generator(), media_type="text/event-stream", kind="llm_gemini")
 # ===== LLM-REF-END: CHAT HANDLERS =====
 
 
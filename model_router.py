@@ -0,0 +1,86 @@
+"""
+自適應模型路由
+按滾動時間窗內觀察到的首 token 延遲及錯誤率，為 "auto" 模型選擇最快的健康供應商，
+並保留少量流量探索其他模型
+"""
+import random
+import time
+from collections import defaultdict, deque
+from typing import Dict, Optional
+
+
+class AdaptiveModelRouter:
+    def __init__(self, window_seconds: float = 300, max_samples: int = 100,
+                 exploration_rate: float = 0.05, max_error_rate: float = 0.5,
+                 min_samples: int = 3, prior_first_token_ms: float = 1500,
+                 rng: Optional[random.Random] = None):
+        self.window_seconds = window_seconds
+        self.exploration_rate = exploration_rate
+        self.max_error_rate = max_error_rate
+        self.min_samples = min_samples
+        self.prior_first_token_ms = prior_first_token_ms
+        self._rng = rng or random.Random()
+
+        # route_key ("provider/model_id") -> deque[(時間, 首 token 毫秒或 None, 是否成功)]
+        self._samples = defaultdict(lambda: deque(maxlen=max_samples))
+        self._selections = defaultdict(int)
+        self._explorations = defaultdict(int)
+
+    def observe(self, route_key: str, first_token_ms: Optional[float], ok: bool):
+        """記錄一次調用結果"""
+        self._samples[route_key].append((time.time(), first_token_ms, ok and first_token_ms is not None))
+
+    def _window(self, route_key: str) -> list:
+        cutoff = time.time() - self.window_seconds
+        samples = self._samples.get(route_key)
+        if not samples:
+            return []
+        while samples and samples[0][0] < cutoff:
+            samples.popleft()
+        return list(samples)
+
+    def _health(self, route_key: str) -> dict:
+        samples = self._window(route_key)
+        latencies = sorted(ttft for _, ttft, ok in samples if ok)
+        errors = sum(1 for _, _, ok in samples if not ok)
+        error_rate = errors / len(samples) if samples else 0.0
+        return {
+            "samples": len(samples),
+            "error_rate": round(error_rate, 3),
+            "p50_first_token_ms": round(latencies[len(latencies) // 2], 2) if latencies else None,
+            "healthy": len(samples) < self.min_samples or error_rate <= self.max_error_rate,
+        }
+
+    def choose(self, candidates: Dict[str, str]) -> str:
+        """從 {模型: route_key} 中選出模型"""
+        if not candidates:
+            raise ValueError("No candidate models")
+
+        health = {model: self._health(route_key) for model, route_key in candidates.items()}
+        healthy = [model for model in candidates if health[model]["healthy"]]
+        if not healthy:
+            # 全部不健康時選錯誤率最低者
+            healthy = [min(candidates, key=lambda m: health[m]["error_rate"])]
+
+        def expected_latency(model):
+            p50 = health[model]["p50_first_token_ms"]
+            return p50 if p50 is not None else self.prior_first_token_ms
+
+        best = min(healthy, key=expected_latency)
+        others = [model for model in candidates if model != best]
+        if others and self._rng.random() < self.exploration_rate:
+            choice = self._rng.choice(others)
+            self._explorations[choice] += 1
+        else:
+            choice = best
+        self._selections[choice] += 1
+        return choice
+
+    def get_stats(self) -> dict:
+        return {
+            "routes": {route_key: self._health(route_key) for route_key in list(self._samples.keys())},
+            "selections": dict(self._selections),
+            "explorations": dict(self._explorations),
+            "exploration_rate": self.exploration_rate,
+            "window_seconds": self.window_seconds,
+        }
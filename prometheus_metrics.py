@@ -0,0 +1,243 @@
+"""
+Prometheus 文字格式指標（/metrics）
+不依賴 prometheus_client：計數器及直方圖按標籤值取得子項後，記錄只是原地的整數 / 浮點數加法，
+全部在事件循環線程上執行，不需要鎖；緩存、連接池等現有統計在抓取時由回調讀取，熱路徑不需額外記錄
+"""
+import asyncio
+import bisect
+import math
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# 秒；覆蓋知識庫查詢（亞毫秒）至 LLM / TTS（數秒）
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+
+class _GaugeChild(_CounterChild):
+    __slots__ = ()
+
+    def set(self, value: float):
+        self.value = value
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # 最後一格為 +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Metric:
+    """子類提供 _lines()，逐行輸出樣本"""
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}", *self._lines()]
+
+
+class _LabelledMetric(_Metric):
+    """按標籤值保存子項的指標；子類以 _new_child() 建立子項"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+
+    def labels(self, *values):
+        """按標籤值取得子項（熱路徑可保存返回值重複使用）"""
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            child = self._children[key] = self._new_child()
+        return child
+
+    def _lines(self) -> Iterable[str]:
+        for values, child in list(self._children.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}"
+
+
+class Counter(_LabelledMetric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1.0):
+        self.labels().inc(amount)
+
+
+class Gauge(_LabelledMetric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+
+class Histogram(_LabelledMetric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.bounds = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.bounds)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def _lines(self) -> Iterable[str]:
+        names = self.labelnames + ("le",)
+        for values, child in list(self._children.items()):
+            cumulative = 0
+            for bound, count in zip(self.bounds + (math.inf,), child.counts):
+                cumulative += count
+                yield f"{self.name}_bucket{_format_labels(names, values + (_format_value(bound),))} {cumulative}"
+            labels = _format_labels(self.labelnames, values)
+            yield f"{self.name}_sum{labels} {_format_value(child.sum)}"
+            yield f"{self.name}_count{labels} {child.count}"
+
+
+class CallbackMetric(_Metric):
+    """抓取時調用 collect()，返回 {標籤值元組: 數值}"""
+
+    def __init__(self, name: str, documentation: str, kind: str,
+                 collect: Callable[[], Dict[Tuple, float]], labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.kind = kind
+        self.collect = collect
+
+    def _lines(self) -> Iterable[str]:
+        for values, value in self.collect().items():
+            values = values if isinstance(values, tuple) else (values,)
+            yield f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(float(value))}"
+
+
+class MetricsRegistry:
+    def __init__(self, prefix: str = ""):
+        self.prefix = prefix
+        self._metrics: List[_Metric] = []
+
+    def _add(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._add(Counter(self.prefix + name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._add(Gauge(self.prefix + name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(self.prefix + name, documentation, labelnames, buckets))
+
+    def callback(self, name: str, documentation: str, kind: str,
+                 collect: Callable[[], Dict[Tuple, float]], labelnames: Sequence[str] = ()) -> CallbackMetric:
+        return self._add(CallbackMetric(self.prefix + name, documentation, kind, collect, labelnames))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class HTTPMetricsMiddleware:
+    """
+    純 ASGI 中介層（不經 BaseHTTPMiddleware，不影響串流回應及斷線偵測）：
+    按方法、路由模板及狀態碼記錄請求總耗時；未匹配的路徑歸入 "unmatched"，避免標籤無限增長
+    """
+
+    def __init__(self, app, histogram: Histogram):
+        self.app = app
+        self.histogram = histogram
+        self._route_paths: Optional[Dict[object, str]] = None
+
+    def _route_path(self, scope) -> str:
+        endpoint = scope.get("endpoint")
+        router = scope.get("router")
+        if endpoint is None or router is None:
+            return "unmatched"
+        if self._route_paths is None:
+            self._route_paths = {getattr(route, "endpoint", None) or getattr(route, "app", None): route.path
+                                 for route in router.routes}
+        return self._route_paths.get(endpoint, "unmatched")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            self.histogram.labels(scope["method"], self._route_path(scope), status).observe(
+                time.perf_counter() - start)
+
+
+async def monitor_event_loop_lag(histogram: Histogram, gauge: Gauge, interval: float = 0.5):
+    """定時睡眠並量度實際喚醒的延遲（事件循環被阻塞的時間）"""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - start - interval)
+        histogram.observe(lag)
+        gauge.set(lag)
@@ -0,0 +1,227 @@
+"""
+LLM 供應商限流器
+按供應商限制每秒請求數、並發串流數及可選的 token 預算，
+並根據上游 429 / Retry-After 自動調整速率
+"""
+import asyncio
+import logging
+import time
+from collections import defaultdict, deque
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitExceeded(Exception):
+    """在期限內無法取得供應商配額"""
+
+    def __init__(self, provider: str, reason: str, retry_after: float = 1.0):
+        super().__init__(f"{provider} rate limited ({reason})")
+        self.provider = provider
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """解析 Retry-After 標頭（秒數或 HTTP 日期）"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """預約式令牌桶：允許預支，返回需要等待的秒數"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float, max_wait: float, now: float) -> Optional[float]:
+        """預約 amount 個令牌；若等待時間超過 max_wait 則不預約並返回 None"""
+        self._refill(now)
+        wait = 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+        if wait > max_wait:
+            return None
+        self.tokens -= amount
+        return wait
+
+    def refund(self, amount: float):
+        """退回未使用的預約"""
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class ProviderLease:
+    """一次已獲准的上游請求，用於回報結果及釋放並發名額"""
+
+    def __init__(self, limiter: Optional["ProviderLimiter"], queue_ms: float = 0.0):
+        self._limiter = limiter
+        self.queue_ms = queue_ms
+        self._released = False
+
+    @property
+    def provider(self) -> Optional[str]:
+        return self._limiter.provider if self._limiter else None
+
+    def succeeded(self):
+        """上游返回 200"""
+        if self._limiter:
+            self._limiter.on_success()
+
+    def throttled(self, retry_after_header: Optional[str] = None):
+        """上游返回 429"""
+        if self._limiter:
+            self._limiter.on_throttled(parse_retry_after(retry_after_header))
+
+    def release(self):
+        """釋放並發名額（可重複調用）"""
+        if self._released:
+            return
+        self._released = True
+        if self._limiter:
+            self._limiter.release()
+
+
+class ProviderLimiter:
+    """單一供應商的速率、並發及 token 預算限制"""
+
+    def __init__(self, provider: str, rps: float, burst: Optional[float] = None,
+                 max_concurrency: int = 8, tokens_per_minute: Optional[int] = None,
+                 min_rps: Optional[float] = None):
+        self.provider = provider
+        self.base_rps = rps
+        self.min_rps = min_rps or max(rps * 0.1, 0.1)
+        self.requests = TokenBucket(rps, burst or max(rps, 1))
+        self.tokens = TokenBucket(tokens_per_minute / 60.0, tokens_per_minute) if tokens_per_minute else None
+        self.max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.active = 0
+        self.waiting = 0
+        self.blocked_until = 0.0
+
+        self.stats = defaultdict(int)
+        self.queue_times = deque(maxlen=1000)
+
+    async def acquire(self, tokens: int = 0, timeout: float = 2.0) -> ProviderLease:
+        """在 timeout 秒內取得配額，否則拋出 RateLimitExceeded"""
+        start = time.monotonic()
+        deadline = start + timeout
+        self.waiting += 1
+        try:
+            # 1) 上游要求暫停（429 Retry-After）
+            if self.blocked_until > start:
+                if self.blocked_until > deadline:
+                    raise self._reject("upstream_cooldown", self.blocked_until - start)
+                await asyncio.sleep(self.blocked_until - start)
+
+            # 2) 每秒請求數
+            now = time.monotonic()
+            max_wait = max(0.0, deadline - now)
+            wait = self.requests.reserve(1, max_wait, now)
+            if wait is None:
+                raise self._reject("rps", 1.0 / self.requests.rate)
+
+            # 3) token 預算
+            if self.tokens and tokens:
+                token_wait = self.tokens.reserve(tokens, max_wait, now)
+                if token_wait is None:
+                    self.requests.refund(1)
+                    raise self._reject("token_budget", tokens / self.tokens.rate)
+                wait = max(wait, token_wait)
+            try:
+                if wait > 0:
+                    await asyncio.sleep(wait)
+
+                # 4) 並發串流數
+                remaining = deadline - time.monotonic()
+                try:
+                    await asyncio.wait_for(self._semaphore.acquire(), max(remaining, 0.001))
+                except asyncio.TimeoutError:
+                    raise self._reject("concurrency", 1.0)
+            except BaseException:
+                # 並發超時或排隊時被取消：退回已預約的速率及 token 配額，被拒的請求不消耗預算
+                self.requests.refund(1)
+                if self.tokens and tokens:
+                    self.tokens.refund(tokens)
+                raise
+        finally:
+            self.waiting -= 1
+
+        self.active += 1
+        queue_ms = (time.monotonic() - start) * 1000
+        self.queue_times.append(queue_ms)
+        self.stats["acquired"] += 1
+        return ProviderLease(self, queue_ms)
+
+    def _reject(self, reason: str, retry_after: float) -> RateLimitExceeded:
+        self.stats["rejected"] += 1
+        self.stats[f"rejected_{reason}"] += 1
+        return RateLimitExceeded(self.provider, reason, retry_after)
+
+    def release(self):
+        self.active -= 1
+        self._semaphore.release()
+
+    def on_success(self):
+        """加性恢復速率"""
+        if self.requests.rate < self.base_rps:
+            self.requests.rate = min(self.base_rps, self.requests.rate + self.base_rps * 0.05)
+
+    def on_throttled(self, retry_after: Optional[float]):
+        """乘性降速，並按 Retry-After 暫停"""
+        self.stats["upstream_429"] += 1
+        self.requests.rate = max(self.min_rps, self.requests.rate * 0.5)
+        pause = retry_after if retry_after is not None else 1.0 / self.requests.rate
+        self.blocked_until = max(self.blocked_until, time.monotonic() + pause)
+        logger.warning(f"{self.provider} returned 429; rate lowered to {self.requests.rate:.2f} rps, "
+                       f"pausing {pause:.1f}s")
+
+    def get_stats(self) -> dict:
+        queue_times = sorted(self.queue_times)
+        stats = {
+            "current_rps": round(self.requests.rate, 3),
+            "base_rps": self.base_rps,
+            "active": self.active,
+            "waiting": self.waiting,
+            "max_concurrency": self.max_concurrency,
+            "cooldown_seconds": round(max(0.0, self.blocked_until - time.monotonic()), 2),
+            **self.stats,
+        }
+        if queue_times:
+            stats["queue_ms"] = {
+                "avg": round(sum(queue_times) / len(queue_times), 2),
+                "p95": round(queue_times[int(len(queue_times) * 0.95)], 2),
+                "max": round(queue_times[-1], 2),
+            }
+        return stats
+
+
+class LLMRateLimiter:
+    """按供應商管理 ProviderLimiter；未配置的供應商不限流"""
+
+    def __init__(self, config: Dict[str, dict], queue_timeout: float = 2.0):
+        self.queue_timeout = queue_timeout
+        self.limiters = {provider: ProviderLimiter(provider, **limits) for provider, limits in config.items()}
+
+    async def acquire(self, provider: str, tokens: int = 0, timeout: Optional[float] = None) -> ProviderLease:
+        limiter = self.limiters.get(provider)
+        if limiter is None:
+            return ProviderLease(None)
+        return await limiter.acquire(tokens, self.queue_timeout if timeout is None else timeout)
+
+    def get_stats(self) -> dict:
+        return {provider: limiter.get_stats() for provider, limiter in self.limiters.items()}
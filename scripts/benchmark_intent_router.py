@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+意圖路由基準測試
+
+比較舊流程（逐個關鍵詞 any() 掃描 + 每個問題都查一次知識庫）與
+IntentRouter.classify（單次 Aho-Corasick 掃描，只有命中知識庫詞語才查庫）的每問題耗時
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from intent_keywords import TOMORROW_WORDS, TODAY_WORDS, WEATHER_KEYWORDS
+from intent_router import IntentRouter
+from knowledge_base import KnowledgeBase
+
+SYSTEM_PROMPT = "你是智能按摩護理助手小護。\n\n# 當前對話\n\n用戶: "
+
+SAMPLE_UTTERANCES = [
+    "你好", "今日天氣點樣", "聽日會唔會落雨", "幫我按摩肩膀", "我腰部好痛",
+    "講個笑話聽下", "你叫咩名", "學校在哪一年創辦", "點樣預約", "多謝你",
+]
+
+
+def legacy_route(kb: KnowledgeBase, prompt: str) -> str:
+    """舊流程：天氣關鍵詞 any() 掃描，再無條件查知識庫"""
+    if any(k in prompt for k in WEATHER_KEYWORDS):
+        if any(w in prompt for w in TOMORROW_WORDS):
+            return "weather"
+        any(w in prompt for w in TODAY_WORDS)
+        return "weather"
+    if kb.find_answer(prompt):
+        return "knowledge"
+    return "llm"
+
+
+def build_kb(path: str, size: int) -> KnowledgeBase:
+    kb = KnowledgeBase(path)
+    rng = random.Random(0)
+    topics = ["學校", "課程", "老師", "報名", "按摩", "護理", "時間", "地址", "費用", "預約"]
+    for i in range(size):
+        question = f"{rng.choice(topics)}{rng.choice(topics)}問題{i}"
+        kb.add_qa_pair(question, f"答案{i}")
+    kb.add_qa_pair("學校在哪一年創辦", "1919年")
+    return kb
+
+
+def timed(fn, prompts, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for prompt in prompts:
+            fn(prompt)
+    return (time.perf_counter() - start) * 1e6 / (rounds * len(prompts))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark intent routing")
+    parser.add_argument("--kb-size", type=int, default=200, help="知識庫問答數量")
+    parser.add_argument("--rounds", type=int, default=20, help="重複次數")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        kb = build_kb(os.path.join(tmp, "kb.db"), args.kb_size)
+        router = IntentRouter(kb)
+        prompts = [SYSTEM_PROMPT + u + "\n小護: " for u in SAMPLE_UTTERANCES]
+        router.classify(prompts[0])  # 預先編譯詞表
+
+        def routed(prompt):
+            intent = router.classify(prompt)
+            if intent.knowledge and not intent.massage_command:
+                kb.find_answer(prompt)
+
+        legacy_us = timed(lambda p: legacy_route(kb, p), prompts, args.rounds)
+        router_us = timed(routed, prompts, args.rounds)
+        classify_us = timed(router.classify, prompts, args.rounds)
+
+    print(f"KB size: {args.kb_size}, prompts: {len(prompts)}, rounds: {args.rounds}")
+    print(f"legacy any() + find_answer : {legacy_us:10.1f} µs/prompt")
+    print(f"router + gated find_answer : {router_us:10.1f} µs/prompt")
+    print(f"router.classify only       : {classify_us:10.1f} µs/prompt")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+知識庫匹配基準及召回率測試
+
+由 SYNONYM_GROUPS 生成 100 至 100k 條合成粵語問答（每條含獨有的專名），
+查詢為已存問題的同義改寫（同義詞替換、加前後綴），另加語料中不存在的專名作為反例。
+量度每次查詢的延遲百分位、索引記憶體，以及在目前 0.4 Jaccard 規則下 top-1 的準確率及召回率；
+結果寫入 JSON，可用 --compare 與之前的版本比較
+
+    python scripts/benchmark_kb.py --sizes 100 1000 10000 --output kb_bench.json
+    python scripts/benchmark_kb.py --sizes 100 1000 10000 --compare kb_bench.json
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import synonyms_config
+from knowledge_base import MATCH_THRESHOLD, KnowledgeBase
+
+# 專名用字：避開同義詞組及粵語詞典常見字，組合出不重複的 2-3 字專名
+NAME_CHARS = "葵竺楓梓柏榕樺檀桂蘭芷芸蔚嵐岑崧峻澄潁漪瀾汀滄灝燁煦熠珂琦瑜瑤璇瑾璞琨翎翊翔彥彬昕昀晞晟旻杉"
+SUBJECT_WORDS = ["學校", "老師", "學生", "活動", "考試", "假期", "上課", "午餐", "菜單", "創辦"]
+ASPECT_WORDS = ["時間", "位置", "費用"]
+PREFIXES = ["", "請問", "想問下", "唔該", "我想知"]
+SUFFIXES = ["", "呀", "啊", "呢", "㗎"]
+CHITCHAT = ["今日食咩好", "講個笑話聽下", "你叫咩名", "你鍾唔鍾意音樂", "唱首歌嚟聽", "點樣煮飯"]
+
+METRICS = ("precision", "recall", "false_positive_rate", "p50_ms", "p95_ms", "p99_ms", "index_mb")
+
+
+def entity_name(index: int) -> str:
+    """第 index 個專名：先用完所有 2 字組合，再用 3 字組合"""
+    n = len(NAME_CHARS)
+    if index < n * n:
+        return NAME_CHARS[index // n] + NAME_CHARS[index % n]
+    index -= n * n
+    return NAME_CHARS[index // (n * n) % n] + NAME_CHARS[index // n % n] + NAME_CHARS[index % n]
+
+
+def group_words(word: str):
+    return sorted(synonyms_config.get_word_synonyms(word))
+
+
+def build_corpus(rng: random.Random, size: int):
+    """返回 [(專名, 主題詞, 方面詞)]，第 i 條的答案為「答案i」"""
+    return [(entity_name(i), rng.choice(SUBJECT_WORDS), rng.choice(ASPECT_WORDS)) for i in range(size)]
+
+
+def paraphrase(rng: random.Random, entity: str, subject: str, aspect: str) -> str:
+    """同義詞替換並隨機加前後綴"""
+    return (rng.choice(PREFIXES) + entity + rng.choice(group_words(subject))
+            + rng.choice(group_words(aspect)) + rng.choice(SUFFIXES))
+
+
+def build_queries(rng: random.Random, corpus, count: int):
+    """返回 [(查詢, 預期答案或 None)]，約五分之一為反例"""
+    positives = rng.sample(range(len(corpus)), min(count, len(corpus)))
+    queries = [(paraphrase(rng, *corpus[i]), f"答案{i}") for i in positives]
+    for i in range(max(1, len(positives) // 4)):
+        if i % 2:
+            queries.append((rng.choice(CHITCHAT), None))
+        else:
+            # 語料中不存在的專名
+            unseen = entity_name(len(corpus) + i)
+            queries.append((paraphrase(rng, unseen, rng.choice(SUBJECT_WORDS), rng.choice(ASPECT_WORDS)), None))
+    rng.shuffle(queries)
+    return queries
+
+
+def percentile(sorted_values, p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))] * 1000
+
+
+def evaluate(match, queries) -> dict:
+    correct = answered = false_positives = 0
+    latencies = []
+    for query, expected in queries:
+        start = time.perf_counter()
+        answer = match(query)
+        latencies.append(time.perf_counter() - start)
+        if answer is None:
+            continue
+        answered += 1
+        if expected is None:
+            false_positives += 1
+        else:
+            correct += answer == expected
+    positives = sum(1 for _, expected in queries if expected is not None)
+    negatives = len(queries) - positives
+    latencies.sort()
+    return {
+        "queries": len(queries),
+        "precision": round(correct / answered, 4) if answered else 0.0,
+        "recall": round(correct / positives, 4) if positives else 0.0,
+        "false_positive_rate": round(false_positives / negatives, 4) if negatives else 0.0,
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 4),
+        "p50_ms": round(percentile(latencies, 0.50), 4),
+        "p95_ms": round(percentile(latencies, 0.95), 4),
+        "p99_ms": round(percentile(latencies, 0.99), 4),
+        "max_ms": round(latencies[-1] * 1000, 4),
+    }
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return round(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20, 1)
+    except (OSError, ValueError, AttributeError):
+        return 0.0
+
+
+def run_case(size: int, segmenter_name: str, query_count: int, seed: int) -> list:
+    rng = random.Random(seed + size)
+    corpus = build_corpus(rng, size)
+    queries = build_queries(rng, corpus, query_count)
+    lines = (json.dumps({"question": f"{entity}{subject}{aspect}", "answer": f"答案{i}"}, ensure_ascii=False)
+             for i, (entity, subject, aspect) in enumerate(corpus))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        kb = KnowledgeBase(os.path.join(tmp, "kb.db"))
+        if segmenter_name == "jieba" and not kb.enable_segmenter():
+            kb.close()
+            return []
+        rss_before = rss_mb()
+        start = time.perf_counter()
+        kb.import_jsonl(lines)
+        import_s = time.perf_counter() - start
+
+        # 重建索引一次，量度索引本身的記憶體
+        gc.collect()
+        tracemalloc.start()
+        start = time.perf_counter()
+        kb._load_index()
+        index_s = time.perf_counter() - start
+        index_mb = tracemalloc.get_traced_memory()[0] / 2 ** 20
+        tracemalloc.stop()
+        kb.version += 1
+
+        common = {
+            "size": size,
+            "segmenter": segmenter_name,
+            "import_s": round(import_s, 3),
+            "index_build_s": round(index_s, 3),
+            "index_mb": round(index_mb, 2),
+            "rss_delta_mb": round(rss_mb() - rss_before, 1),
+        }
+        results = [
+            dict(common, mode="keywords", **evaluate(kb._match_keywords, queries)),
+            dict(common, mode="find_answer", **evaluate(kb.find_answer, queries)),
+            # 第二遍全部命中結果緩存
+            dict(common, mode="find_answer_cached", **evaluate(kb.find_answer, queries)),
+        ]
+        kb.close()
+    return results
+
+
+def run_suite(sizes, queries: int = 500, segmenters=("regex", "jieba"), seed: int = 0) -> dict:
+    results = []
+    # jieba 啟用後不會再停用，正則分詞必須先跑
+    for segmenter_name in sorted(set(segmenters), key=["regex", "jieba"].index):
+        for size in sizes:
+            results.extend(run_case(size, segmenter_name, queries, seed))
+    return {
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "match_threshold": MATCH_THRESHOLD,
+        "queries": queries,
+        "seed": seed,
+        "results": results,
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, timeout=5).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+
+def result_key(row: dict):
+    return row["size"], row["segmenter"], row["mode"]
+
+
+def print_report(report: dict, baseline: dict = None):
+    previous = {result_key(row): row for row in (baseline or {}).get("results", [])}
+    print(f"revision {report['revision'] or '?'}  threshold {report['match_threshold']}  "
+          f"{report['queries']} queries per size")
+    for row in report["results"]:
+        line = (f"{row['size']:>7} {row['segmenter']:>6} {row['mode']:>18}: "
+                f"P {row['precision']:.3f}  R {row['recall']:.3f}  FP {row['false_positive_rate']:.2f}  "
+                f"p50 {row['p50_ms']:.3f}  p95 {row['p95_ms']:.3f}  p99 {row['p99_ms']:.3f} ms  "
+                f"index {row['index_mb']:.1f} MB")
+        old = previous.get(result_key(row))
+        if old:
+            deltas = [f"{name} {row[name] - old[name]:+.3f}" for name in METRICS
+                      if name in old and round(row[name] - old[name], 3)]
+            line += "  | " + (", ".join(deltas) if deltas else "unchanged")
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark knowledge-base matching latency, memory and recall")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000],
+                        help="corpus sizes (100 to 100000)")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--segmenters", nargs="+", default=["regex", "jieba"], choices=["regex", "jieba"])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results as JSON")
+    parser.add_argument("--compare", help="earlier JSON results to diff against")
+    args = parser.parse_args()
+
+    report = run_suite(args.sizes, args.queries, args.segmenters, args.seed)
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+知識庫寫入對事件循環的阻塞測試
+
+before: 舊寫法，在事件循環上每次新建連接（rollback journal）寫入
+after:  KnowledgeBase.run_async，在 SQLite 專用線程上用長期 WAL 連接寫入
+期間用 1ms 心跳任務量度事件循環延遲
+"""
+
+import argparse
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from knowledge_base import KnowledgeBase
+
+
+async def measure_lag(stop: asyncio.Event, samples: list):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.001)
+        samples.append((time.perf_counter() - start - 0.001) * 1000)
+
+
+def legacy_insert(db_path: str, question: str):
+    with sqlite3.connect(db_path) as conn:
+        conn.execute('INSERT INTO qa_pairs (question, answer) VALUES (?, ?)', (question, "答案"))
+        conn.commit()
+
+
+async def run(mode: str, db_path: str, writes: int, concurrency: int) -> dict:
+    kb = KnowledgeBase(db_path)
+    if mode == "before":
+        kb.close()
+        sqlite3.connect(db_path).execute('PRAGMA journal_mode=DELETE').connection.close()
+
+    stop, samples = asyncio.Event(), []
+    ticker = asyncio.create_task(measure_lag(stop, samples))
+    await asyncio.sleep(0.01)
+
+    async def writer(worker: int):
+        for i in range(worker, writes, concurrency):
+            if mode == "before":
+                legacy_insert(db_path, f"{mode}問題{i}")
+                await asyncio.sleep(0)
+            else:
+                await kb.run_async(kb.add_qa_pair, f"{mode}問題{i}", "答案")
+
+    start = time.perf_counter()
+    await asyncio.gather(*(writer(w) for w in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await ticker
+    if mode == "after":
+        kb.close()
+
+    samples.sort()
+    return {
+        "mode": mode,
+        "writes_per_s": writes / elapsed,
+        "lag_p50_ms": samples[len(samples) // 2],
+        "lag_p99_ms": samples[int(len(samples) * 0.99)],
+        "lag_max_ms": samples[-1],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure event-loop stalls caused by knowledge-base writes")
+    parser.add_argument("--writes", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    for mode in ("before", "after"):
+        with tempfile.TemporaryDirectory() as tmp:
+            result = asyncio.run(run(mode, os.path.join(tmp, "kb.db"), args.writes, args.concurrency))
+        print(f"{result['mode']:>6}: {result['writes_per_s']:8.0f} writes/s  "
+              f"loop lag p50 {result['lag_p50_ms']:6.2f} ms  p99 {result['lag_p99_ms']:6.2f} ms  "
+              f"max {result['lag_max_ms']:6.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+知識庫召回率及延遲比較（合成粵語語料）
+
+keywords: 只用同義詞關鍵詞 Jaccard（KnowledgeBase._match_keywords）
+keywords+fts: find_answer，關鍵詞失敗時以 FTS5 trigram 召回再重排
+查詢為已存問題的改寫（加前後綴、同義詞替換），另加無關問題量度誤報
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import synonyms_config
+from knowledge_base import KnowledgeBase
+
+SUBJECTS = ["學校", "圖書館", "飯堂", "醫務室", "禮堂", "操場", "校務處", "課室", "宿舍", "停車場",
+            "病房", "復康中心", "藥房", "診所", "護士站", "按摩室", "物理治療部", "探病區", "洗手間", "升降機"]
+PREDICATES = ["喺邊度", "幾點開門", "幾點收工", "點樣去", "收費幾多", "要唔要預約", "可唔可以帶嘢食",
+              "有冇得泊車", "邊個負責", "聽日開唔開", "星期日開唔開", "點樣聯絡", "有冇輪椅", "幾時裝修"]
+PREFIXES = ["", "請問", "想問下", "唔該", "我想知"]
+SUFFIXES = ["", "呀", "啊", "呢", "㗎"]
+DISTRACTORS = ["今日食咩好", "講個笑話聽下", "你叫咩名", "幫我按摩肩膀", "聽日會唔會落雨",
+               "點樣煮飯", "最近有咩電影睇", "我有啲頭痛", "你鍾唔鍾意音樂", "唱首歌嚟聽"]
+
+
+def synonym_swap(rng: random.Random, text: str) -> str:
+    for group in synonyms_config.SYNONYM_GROUPS:
+        for word in group:
+            if word in text:
+                return text.replace(word, rng.choice(sorted(group)), 1)
+    return text
+
+
+def build_corpus(rng: random.Random, size: int):
+    pairs = []
+    seen = set()
+    while len(pairs) < size:
+        subject = rng.choice(SUBJECTS)
+        if len(pairs) >= len(SUBJECTS) * len(PREDICATES):
+            subject = f"{subject}{len(pairs)}號"
+        question = f"{subject}{rng.choice(PREDICATES)}"
+        if question in seen:
+            continue
+        seen.add(question)
+        pairs.append((rng.choice(PREFIXES[1:]) + question, f"答案{len(pairs)}"))
+    return pairs
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] * 1000
+
+
+def evaluate(match, queries):
+    hits, false_positives, latencies = 0, 0, []
+    for query, expected in queries:
+        start = time.perf_counter()
+        answer = match(query)
+        latencies.append(time.perf_counter() - start)
+        if expected is None:
+            false_positives += answer is not None
+        else:
+            hits += answer == expected
+    positives = sum(1 for _, expected in queries if expected is not None)
+    return {
+        "recall": hits / positives,
+        "false_positive_rate": false_positives / (len(queries) - positives),
+        "p50_ms": percentile(latencies, 0.5),
+        "p95_ms": percentile(latencies, 0.95),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare keyword matching with FTS5 trigram recall")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--queries", type=int, default=300)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        rng = random.Random(size)
+        with tempfile.TemporaryDirectory() as tmp:
+            kb = KnowledgeBase(os.path.join(tmp, "kb.db"))
+            if not kb.fts_enabled:
+                print("SQLite 未支援 FTS5 trigram")
+                return
+            pairs = build_corpus(rng, size)
+            kb._db.run(lambda conn: conn.executemany(
+                'INSERT INTO qa_pairs (question, answer) VALUES (?, ?)', pairs) and conn.commit())
+            kb._load_index()
+            kb.version += 1
+
+            queries = []
+            for question, answer in rng.sample(pairs, min(args.queries, len(pairs))):
+                core = question
+                for prefix in PREFIXES[1:]:
+                    if core.startswith(prefix):
+                        core = core[len(prefix):]
+                query = rng.choice(PREFIXES) + synonym_swap(rng, core) + rng.choice(SUFFIXES)
+                queries.append((query, answer))
+            queries += [(d, None) for d in DISTRACTORS]
+
+            results = {
+                "keywords": evaluate(kb._match_keywords, queries),
+                "keywords+fts": evaluate(kb.find_answer, queries),
+            }
+            kb.close()
+
+        for name, r in results.items():
+            print(f"{size:>6} pairs {name:>13}: recall {r['recall']:.3f}  "
+                  f"false positives {r['false_positive_rate']:.2f}  "
+                  f"p50 {r['p50_ms']:.3f} ms  p95 {r['p95_ms']:.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+請求追蹤報告
+
+讀取 tracing.py 寫入的 JSONL（連同輪替出來的 .1 … .N 檔），按階段列出次數及耗時百分位，
+並列出最慢的請求；--trace 顯示單一請求的完整時間線
+
+    python scripts/trace_report.py
+    python scripts/trace_report.py --name "POST /api/chat" --since 3600 --slowest 5
+    python scripts/trace_report.py --trace 3f9c0a1b2d4e5f60
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_PATH = os.getenv("TRACE_LOG_PATH", os.path.join(ROOT, "logs", "traces.jsonl"))
+
+
+def trace_files(path: str) -> list:
+    """由舊至新：traces.jsonl.N … traces.jsonl.1、traces.jsonl"""
+    rotated = [p for p in glob.glob(glob.escape(path) + ".*") if p.rsplit(".", 1)[1].isdigit()]
+    rotated.sort(key=lambda p: int(p.rsplit(".", 1)[1]), reverse=True)
+    return rotated + ([path] if os.path.exists(path) else [])
+
+
+def load_traces(path: str, name: str = None, since: float = None) -> list:
+    traces = []
+    for file_path in trace_files(path):
+        with open(file_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    trace = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # 寫入中途被截斷的行
+                if name and trace.get("name") != name:
+                    continue
+                if since and trace.get("ts", 0) < since:
+                    continue
+                traces.append(trace)
+    return traces
+
+
+def percentile(sorted_values, p: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+def stage_breakdown(traces) -> dict:
+    """{階段: {count, mean_ms, p50_ms, p95_ms, p99_ms}}；時間點（如首 token）取相對請求開始的時間"""
+    durations = defaultdict(list)
+    for trace in traces:
+        durations["total"].append(trace["duration_ms"])
+        for span in trace.get("spans", []):
+            durations[span["name"]].append(span.get("duration_ms", span["start_ms"]))
+    result = {}
+    for stage, values in durations.items():
+        values.sort()
+        result[stage] = {
+            "count": len(values),
+            "mean_ms": round(sum(values) / len(values), 2),
+            "p50_ms": round(percentile(values, 0.50), 2),
+            "p95_ms": round(percentile(values, 0.95), 2),
+            "p99_ms": round(percentile(values, 0.99), 2),
+        }
+    return result
+
+
+def print_breakdown(traces, slowest: int = 10):
+    if not traces:
+        print("no traces")
+        return
+    print(f"{len(traces)} traces")
+    print(f"{'stage':<22}{'count':>7}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}  (ms)")
+    breakdown = stage_breakdown(traces)
+    for stage, row in sorted(breakdown.items(), key=lambda item: -item[1]["p95_ms"]):
+        print(f"{stage:<22}{row['count']:>7}{row['mean_ms']:>10.1f}{row['p50_ms']:>10.1f}"
+              f"{row['p95_ms']:>10.1f}{row['p99_ms']:>10.1f}")
+    if slowest:
+        print(f"\nslowest {slowest}:")
+        for trace in sorted(traces, key=lambda t: -t["duration_ms"])[:slowest]:
+            when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(trace["ts"]))
+            spans = max((s for s in trace.get("spans", []) if "duration_ms" in s),
+                        key=lambda s: s["duration_ms"], default=None)
+            worst = f"  slowest stage {spans['name']} {spans['duration_ms']:.0f} ms" if spans else ""
+            print(f"  {trace['trace_id']}  {when}  {trace['name']}  {trace['duration_ms']:.0f} ms{worst}")
+
+
+def print_trace(trace: dict):
+    print(f"{trace['trace_id']}  {trace['name']}  status {trace.get('status')}  {trace['duration_ms']:.1f} ms")
+    if trace.get("attrs"):
+        print("  " + json.dumps(trace["attrs"], ensure_ascii=False))
+    for span in sorted(trace.get("spans", []), key=lambda s: s["start_ms"]):
+        extra = {k: v for k, v in span.items() if k not in ("name", "start_ms", "duration_ms")}
+        duration = f"{span['duration_ms']:>9.1f}" if "duration_ms" in span else f"{'·':>9}"
+        print(f"  {span['start_ms']:>9.1f}  {duration}  {span['name']}"
+              + (f"  {json.dumps(extra, ensure_ascii=False)}" if extra else ""))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Summarize request traces written by tracing.py")
+    parser.add_argument("--path", default=DEFAULT_PATH, help="trace log (rotated .1 … .N files are included)")
+    parser.add_argument("--name", help='only traces with this name, e.g. "POST /api/chat"')
+    parser.add_argument("--since", type=float, help="only traces from the last N seconds")
+    parser.add_argument("--slowest", type=int, default=10, help="list the N slowest traces")
+    parser.add_argument("--trace", help="print the timeline of one trace id")
+    args = parser.parse_args(argv)
+
+    since = time.time() - args.since if args.since else None
+    traces = load_traces(args.path, args.name, since)
+    if args.trace:
+        matches = [t for t in traces if t["trace_id"] == args.trace]
+        if not matches:
+            print(f"trace {args.trace} not found", file=sys.stderr)
+            return 1
+        for trace in matches:
+            print_trace(trace)
+        return 0
+    print_breakdown(traces, args.slowest)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,156 @@
+"""
+知識庫分詞
+jieba 分詞 + 由 SYNONYM_GROUPS 及粵語詞彙生成的用戶詞典；詞典模型序列化到緩存檔，
+啟動時在背景線程載入（數百毫秒，而非 jieba 初始化的數秒）。載入完成前由調用方使用正則分詞
+"""
+import asyncio
+import hashlib
+import logging
+import marshal
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import List, Optional
+
+import synonyms_config
+
+logger = logging.getLogger(__name__)
+
+# 粵語及護理常用詞（jieba 預設詞典以簡體為主，這些詞不加入會被拆成單字）
+CANTONESE_TERMS = [
+    "喺邊度", "邊度", "幾點", "幾時", "幾多", "幾多錢", "點樣", "點解", "點去", "邊個", "咩嘢", "做咩",
+    "係咪", "有冇", "可唔可以", "要唔要", "使唔使", "得唔得", "唔該", "多謝", "聽日", "今日", "琴日",
+    "而家", "宜家", "今晚", "聽朝", "禮拜", "星期日", "食飯", "飯堂", "返工", "放工", "返學", "放學",
+    "開門", "收工", "預約", "探病", "病房", "護士", "醫生", "姑娘", "藥房", "診所", "洗手間", "升降機",
+    "輪椅", "按摩", "推拿", "肩膀", "背部", "腰部", "腿部", "頸部", "手臂", "頭痛", "唔舒服",
+]
+# 用戶詞的詞頻：足以蓋過單字切分
+USER_WORD_FREQ = 100000
+
+CACHE_PATH = os.environ.get("JIEBA_CACHE_PATH",
+                            os.path.join(tempfile.gettempdir(), "massage_chatbot_jieba.cache"))
+
+
+def user_dictionary_words() -> List[str]:
+    words = {w for group in synonyms_config.SYNONYM_GROUPS for w in group}
+    words.update(CANTONESE_TERMS)
+    return sorted(w for w in words if len(w) >= 2)
+
+
+def _signature(words: List[str]) -> str:
+    import jieba
+    digest = hashlib.md5()
+    digest.update(getattr(jieba, "__version__", "").encode())
+    digest.update(str(USER_WORD_FREQ).encode())
+    digest.update("\n".join(words).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def build_tokenizer(cache_path: str = CACHE_PATH):
+    """
+    返回 (已初始化的 jieba.Tokenizer, 來源)；
+    緩存檔的簽名與目前用戶詞典一致時直接載入，否則重新建立並寫入緩存
+    """
+    import jieba
+    words = user_dictionary_words()
+    signature = _signature(words)
+    tokenizer = jieba.Tokenizer()
+
+    try:
+        with open(cache_path, "rb") as f:
+            cached_signature, freq, total = marshal.loads(f.read())
+        if cached_signature == signature:
+            tokenizer.FREQ, tokenizer.total = freq, total
+            tokenizer.initialized = True
+            return tokenizer, "cache"
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+
+    tokenizer.initialize()
+    for word in words:
+        tokenizer.add_word(word, USER_WORD_FREQ)
+    # 先寫臨時檔再改名，避免多個進程同時寫入時讀到半個檔案
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            marshal.dump((signature, tokenizer.FREQ, tokenizer.total), f)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logger.warning(f"無法寫入 jieba 詞典緩存 {cache_path}: {e}")
+    return tokenizer, "built"
+
+
+class Segmenter:
+    """持有已載入的 jieba 分詞器；未就緒時 active() 返回 None"""
+
+    def __init__(self, cache_path: str = CACHE_PATH):
+        self.cache_path = cache_path
+        self._tokenizer = None
+        self._active = None
+        self._override = threading.local()
+        self._lock = threading.Lock()
+        self.load_ms: Optional[float] = None
+        self.source: Optional[str] = None
+        self.error: Optional[str] = None
+
+    def load(self):
+        """建立（或從緩存載入）分詞器；不會啟用，見 activate()"""
+        with self._lock:
+            if self._tokenizer is not None:
+                return self._tokenizer
+            start = time.perf_counter()
+            try:
+                self._tokenizer, self.source = build_tokenizer(self.cache_path)
+            except ImportError as e:
+                self.error = str(e)
+                logger.warning(f"jieba 未安裝，知識庫繼續使用正則分詞: {e}")
+                return None
+            self.load_ms = round((time.perf_counter() - start) * 1000, 1)
+            logger.info(f"jieba 詞典已載入（{self.source}，{self.load_ms}ms）")
+            return self._tokenizer
+
+    async def load_async(self):
+        """在背景線程載入，不阻塞事件循環"""
+        return await asyncio.to_thread(self.load)
+
+    def update_user_words(self) -> int:
+        """同義詞更新後把新詞加入已載入的分詞器，返回新增詞數（緩存簽名不符，下次啟動時會重建）"""
+        tokenizer = self._tokenizer
+        if tokenizer is None:
+            return 0
+        added = [word for word in user_dictionary_words() if not tokenizer.FREQ.get(word)]
+        for word in added:
+            tokenizer.add_word(word, USER_WORD_FREQ)
+        return len(added)
+
+    def activate(self):
+        self._active = self._tokenizer
+
+    def active(self):
+        """目前線程應使用的分詞器（None 表示使用正則）"""
+        override = getattr(self._override, "tokenizer", False)
+        return self._active if override is False else override
+
+    @contextmanager
+    def using(self, tokenizer):
+        """在目前線程暫時使用指定分詞器（用於重建索引）"""
+        previous = getattr(self._override, "tokenizer", False)
+        self._override.tokenizer = tokenizer
+        try:
+            yield
+        finally:
+            self._override.tokenizer = previous
+
+    def get_stats(self) -> dict:
+        return {
+            "backend": "jieba" if self._active is not None else "regex",
+            "loaded": self._tokenizer is not None,
+            "source": self.source,
+            "load_ms": self.load_ms,
+            "error": self.error,
+        }
+
+
+segmenter = Segmenter()
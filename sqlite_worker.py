@@ -0,0 +1,56 @@
+"""
+SQLite 存取層
+單一專用線程持有一個長期 WAL 連接（含預編譯語句緩存），所有查詢都在該線程上串行執行，
+異步端點通過 run_async 等待結果而不阻塞事件循環
+"""
+import asyncio
+import logging
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteWorker:
+    def __init__(self, db_path: str, cached_statements: int = 256, busy_timeout_ms: int = 5000):
+        self.db_path = db_path
+        self.cached_statements = cached_statements
+        self.busy_timeout_ms = busy_timeout_ms
+        self._conn: Optional[sqlite3.Connection] = None
+        self._thread_id: Optional[int] = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite",
+                                            initializer=self._open)
+
+    def _open(self):
+        self._thread_id = threading.get_ident()
+        conn = sqlite3.connect(self.db_path, cached_statements=self.cached_statements)
+        conn.execute('PRAGMA journal_mode=WAL')
+        # WAL 下 NORMAL 仍保證一致性，只在斷電時可能丟失最後的交易
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout_ms)}')
+        self._conn = conn
+
+    def run(self, fn: Callable[..., Any], *args) -> Any:
+        """在專用線程上執行 fn(conn, *args) 並等待結果；已在該線程上時直接執行"""
+        if threading.get_ident() == self._thread_id:
+            return fn(self._conn, *args)
+        return self._executor.submit(self._call, fn, args).result()
+
+    async def run_async(self, fn: Callable[..., Any], *args) -> Any:
+        """異步版本：事件循環在查詢期間可繼續處理其他請求"""
+        return await asyncio.wrap_future(self._executor.submit(self._call, fn, args))
+
+    def _call(self, fn, args):
+        return fn(self._conn, *args)
+
+    def close(self):
+        def _close(conn):
+            if conn is not None:
+                conn.close()
+        try:
+            self._executor.submit(self._call, _close, ()).result()
+        except RuntimeError:
+            pass  # 已關閉
+        self._executor.shutdown(wait=True)
@@ -29,6 +29,17 @@
         let API_URL = serverConfig.api_url || `${serverConfig.protocol}://${serverConfig.host}:${serverConfig.port}`;
         let actualPort = String(serverConfig.port);
 
+        // 遙測事件批量上報（tts-infrastructure.js 的 TelemetryBatcher），使用探測後的 API_URL
+        const telemetry = window.telemetryBatcher || { record() {}, flush() {} };
+        telemetry.getApiUrl = () => API_URL;
+
+        // 院舍地點（天氣查詢用）：網址 ?site=名稱 設定一次後保存在本機，之後每個聊天請求都帶上
+        const WEATHER_SITE = (() => {
+            const site = new URLSearchParams(window.location.search).get('site');
+            if (site) localStorage.setItem('weatherSite', site);
+            return site || localStorage.getItem('weatherSite') || undefined;
+        })();
+
         // 備用端口，如果主端口失敗則嘗試
         const possiblePorts = Array.from(new Set([
             String(serverConfig.port), 
@@ -590,6 +601,7 @@
 
             async _synthesizeAudio(text, sequence) {
                 this.pendingRequests++; // 增加請求計數
+                const requestStart = performance.now();
                 
                 try {
                     const response = await fetch(`${API_URL}/api/tts/stream`, {
@@ -608,9 +620,11 @@
                     });
 
                     if (!response.ok) throw new Error(`TTS failed: ${response.status}`);
+                    telemetry.record('first_chunk', performance.now() - requestStart);
                     
                     const arrayBuffer = await response.arrayBuffer();
                     const audioBuffer = await this.audioContext.decodeAudioData(arrayBuffer);
+                    telemetry.record('tts_request', performance.now() - requestStart);
                     
                     // 存儲解碼後的音頻
                     this.synthesisQueue.set(sequence, {
@@ -627,6 +641,7 @@
                     
                 } catch (error) {
                     console.error(`Synthesis error [${sequence}]:`, error);
+                    telemetry.record('tts_error', null, { error: error.message });
 
                     // 🔧 Check if browser TTS fallback is disabled
                     const disableBrowserTTS = document.getElementById('disableBrowserTTS')?.checked;
@@ -671,6 +686,7 @@
 
                 this.isPlaying = true;
                 this.nextStartTime = this.audioContext.currentTime;
+                this.lastEndTime = null; // 上一段音頻結束的時間，用於量度句間空隙
 
                 // 開始播放循環
                 this._playbackLoop();
@@ -696,6 +712,10 @@
                     const gapSeconds = 0.08; // add a small gap to avoid audible word overlap
                     const startTime = Math.max(this.audioContext.currentTime, this.nextStartTime);
                     source.start(startTime);
+                    if (this.lastEndTime !== null) {
+                        telemetry.record('chunk_gap', (startTime - this.lastEndTime) * 1000);
+                    }
+                    this.lastEndTime = startTime + audioData.buffer.duration;
                     
                     // 更新下一個開始時間（留少量空隙而非重疊）
                     this.nextStartTime = startTime + audioData.buffer.duration + gapSeconds;
@@ -1039,14 +1059,7 @@
                         this._showFallbackWarning();
                         
                         // 發送遙測數據
-                        fetch(`${API_URL}/api/telemetry`, {
-                            method: 'POST',
-                            headers: { 'Content-Type': 'application/json' },
-                            body: JSON.stringify({
-                                type: 'media_source_fallback',
-                                data: { error: error.message }
-                            })
-                        }).catch(() => {});
+                        telemetry.record('media_source_fallback', null, { error: error.message });
                         
                         // 重新獲取為Blob
                         const blob = await audioSource.blob();
@@ -4517,7 +4530,8 @@
                     body: JSON.stringify({
                         prompt: '今日香港天氣點樣?幾多度?',
                         model: 'gemini-1.5-flash-001',
-                        responseLength: 'brief'
+                        responseLength: 'brief',
+                        location: WEATHER_SITE
                     }),
                     signal: controller.signal // 加入超時控制
                 });
@@ -4715,16 +4729,29 @@
         }
 
         // ===== 知識庫管理功能 =====
+        // 服務端按 id 分頁；knowledgeData 只包含已載入的頁
         let knowledgeData = [];
+        let knowledgeNextAfterId = null;
+        let knowledgeSearchTimer = null;
+
+        function knowledgeListUrl(afterId) {
+            const params = new URLSearchParams({ after_id: afterId, limit: 100 });
+            const search = document.getElementById('kbSearch')?.value.trim();
+            if (search) {
+                params.set('q', search);
+            }
+            return `${API_URL}/api/knowledge/qa-pairs?${params}`;
+        }
 
         async function loadQAPairs() {
             try {
-                const response = await fetch(`${API_URL}/api/knowledge/qa-pairs`);
+                const response = await fetch(knowledgeListUrl(0));
                 const result = await response.json();
                 
                 if (result.status === 'success') {
                     knowledgeData = result.data;
-                    displayQAPairs(result.data);
+                    knowledgeNextAfterId = result.next_after_id;
+                    displayQAPairs(knowledgeData);
                     updateCategoryList(result.categories);
                     
                     // 更新統計
@@ -4745,8 +4772,29 @@
             }
         }
 
+        async function loadMoreQAPairs() {
+            if (knowledgeNextAfterId === null) {
+                return;
+            }
+            try {
+                const response = await fetch(knowledgeListUrl(knowledgeNextAfterId));
+                const result = await response.json();
+                if (result.status === 'success') {
+                    knowledgeData = knowledgeData.concat(result.data);
+                    knowledgeNextAfterId = result.next_after_id;
+                    displayQAPairs(knowledgeData);
+                }
+            } catch (error) {
+                console.error('載入更多問答對失敗:', error);
+            }
+        }
+
         function displayQAPairs(qaPairs) {
             const qaList = document.getElementById('qaList');
+            const loadMoreBtn = document.getElementById('kbLoadMore');
+            if (loadMoreBtn) {
+                loadMoreBtn.style.display = knowledgeNextAfterId === null ? 'none' : '';
+            }
             
             if (qaPairs.length === 0) {
                 qaList.innerHTML = '<p style="text-align: center; color: var(--text-secondary);">還沒有問答對，快來添加吧！</p>';
@@ -5151,6 +5199,7 @@
                     fullPrompt = "請簡短回答（2-3句話）。\n\n" + fullPrompt;
                 }
 
+                const chatStart = performance.now();
                 const response = await fetch(`${API_URL}/api/chat`, {
                     method: 'POST',
                     headers: {
@@ -5161,6 +5210,7 @@
                         prompt: fullPrompt,
                         model: document.getElementById('modelSelect').value,
                         responseLength: responseLengthSelect.value,
+                        location: WEATHER_SITE,
                         temperature: 0.7,  // 稍微提高創造性
                         max_tokens: 500
                     })
@@ -5221,6 +5271,7 @@
                                 const content = parsed.choices?.[0]?.delta?.content;
                                 if (content) {
                                     if (firstChunk) {
+                                        telemetry.record('chat_first_token', performance.now() - chatStart);
                                         document.getElementById('responseBox').innerHTML = '';
                                         firstChunk = false;
                                         setFoxState(null);
@@ -6111,6 +6162,15 @@ function autoFillControlsFromText(text) {
                     loadQAPairs();
                 });
             }
+
+            // 知識庫搜尋（服務端過濾，輸入停頓後才請求）
+            const kbSearch = document.getElementById('kbSearch');
+            if (kbSearch) {
+                kbSearch.addEventListener('input', () => {
+                    clearTimeout(knowledgeSearchTimer);
+                    knowledgeSearchTimer = setTimeout(loadQAPairs, 300);
+                });
+            }
             
             // 關閉知識庫管理面板
             const closeKnowledge = document.getElementById('closeKnowledge');
@@ -6249,6 +6309,9 @@ function autoFillControlsFromText(text) {
                     
                     if (modelInfo) {
                         switch(selectedModel) {
+                            case 'auto':
+                                modelInfo.textContent = '自動選擇 - 按回應速度揀最快嘅模型';
+                                break;
                             case 'gemini-2.5-flash':
                                 modelInfo.textContent = '使用 Gemini 2.5 Flash - 最快速的回應';
                                 break;
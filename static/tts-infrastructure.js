@@ -8,7 +8,7 @@
  * 4. Retry with Exponential Backoff - Handles transient failures
  * 5. AbortController Integration - Supports cancellation
  * 6. TTS Provider Abstraction - Unified interface with fallback chain
- * 7. Telemetry - Monitoring and diagnostics
+ * 7. Telemetry - Monitoring and diagnostics, with batched upload to the server
  */
 
 // ============================================================================
@@ -789,6 +789,7 @@ class TTSTelemetry {
         EventBus.on(TTSEvents.TTS_PLAY_ERROR, (data) => {
             this.metrics.failures++;
             this._recordError(data);
+            telemetryBatcher.record('tts_error', null, { error: String(data?.error?.message || data?.error || '') });
         });
 
         EventBus.on(TTSEvents.TTS_CIRCUIT_OPEN, () => {
@@ -858,6 +859,124 @@ class TTSTelemetry {
     }
 }
 
+/**
+ * Telemetry Batcher - queues client events and uploads them together to
+ * /api/telemetry/batch instead of one request per event.
+ *
+ * Flushes when maxBatch events are queued, after flushIntervalMs, or with
+ * navigator.sendBeacon when the page is hidden or unloaded. Bodies are sent as
+ * text/plain so beacons stay CORS-simple; the server parses them as JSON.
+ */
+class TelemetryBatcher {
+    constructor(options = {}) {
+        this.getApiUrl = options.getApiUrl || (() => '');
+        this.maxBatch = options.maxBatch || 100;
+        this.maxQueue = options.maxQueue || 500;
+        this.flushIntervalMs = options.flushIntervalMs || 15000;
+
+        this.sessionId = this._loadSessionId();
+        this.queue = [];
+        this.dropped = 0;
+        this.stats = { batches: 0, events: 0 };
+        this._timer = null;
+
+        this._setupLifecycleFlush();
+    }
+
+    _loadSessionId() {
+        const newId = () => (window.crypto?.randomUUID
+            ? window.crypto.randomUUID()
+            : Date.now().toString(36) + Math.random().toString(36).slice(2, 10));
+        try {
+            let id = sessionStorage.getItem('telemetrySessionId');
+            if (!id) {
+                id = newId();
+                sessionStorage.setItem('telemetrySessionId', id);
+            }
+            return id;
+        } catch (error) {
+            return newId();
+        }
+    }
+
+    _setupLifecycleFlush() {
+        if (typeof document === 'undefined') return;
+        document.addEventListener('visibilitychange', () => {
+            if (document.visibilityState === 'hidden') this.flush(true);
+        });
+        window.addEventListener('pagehide', () => this.flush(true));
+    }
+
+    /**
+     * Queue an event
+     * @param {string} type - Event type (first_chunk, chunk_gap, tts_error, ...)
+     * @param {number|null} value - Latency in ms for latency events
+     * @param {Object} extra - Additional fields
+     */
+    record(type, value = null, extra = {}) {
+        if (this.queue.length >= this.maxQueue) {
+            this.queue.shift();
+            this.dropped++;
+        }
+        const event = { type, ts: Date.now(), ...extra };
+        if (value !== null && value !== undefined && Number.isFinite(value)) {
+            event.value = Math.round(value * 10) / 10;
+        }
+        this.queue.push(event);
+
+        if (this.queue.length >= this.maxBatch) {
+            this.flush();
+        } else if (!this._timer) {
+            this._timer = setTimeout(() => this.flush(), this.flushIntervalMs);
+        }
+    }
+
+    /**
+     * Upload all queued events
+     * @param {boolean} useBeacon - Use navigator.sendBeacon (page is being hidden/unloaded)
+     * @returns {boolean} Whether anything was sent
+     */
+    flush(useBeacon = false) {
+        if (this._timer) {
+            clearTimeout(this._timer);
+            this._timer = null;
+        }
+        const apiUrl = this.getApiUrl();
+        if (!apiUrl || this.queue.length === 0) return false;
+
+        const url = `${apiUrl}/api/telemetry/batch`;
+        while (this.queue.length > 0) {
+            const events = this.queue.splice(0, this.maxBatch);
+            const body = JSON.stringify({ session_id: this.sessionId, sent_at: Date.now(), events });
+            this.stats.batches++;
+            this.stats.events += events.length;
+
+            if (useBeacon && navigator.sendBeacon &&
+                navigator.sendBeacon(url, new Blob([body], { type: 'text/plain' }))) {
+                continue;
+            }
+            fetch(url, {
+                method: 'POST',
+                headers: { 'Content-Type': 'text/plain' },
+                body,
+                keepalive: true
+            }).catch(() => {
+                // Silently fail - telemetry must never affect playback
+            });
+        }
+        return true;
+    }
+
+    getStats() {
+        return { queued: this.queue.length, dropped: this.dropped, ...this.stats };
+    }
+}
+
+// Shared instance; app.js points getApiUrl at its resolved API_URL
+const telemetryBatcher = new TelemetryBatcher({
+    getApiUrl: () => window.robustTTS?.apiUrl || ''
+});
+
 // ============================================================================
 // 7. INTEGRATED TTS SERVICE
 // ============================================================================
@@ -1784,25 +1903,13 @@ class TTSAlertManager {
         this._sendTelemetryAlert(alertData);
     }
 
-    async _sendTelemetryAlert(alertData) {
-        try {
-            // Get API URL from window or default
-            const apiUrl = window.robustTTS?.apiUrl || '';
-            if (!apiUrl) return;
-
-            await fetch(`${apiUrl}/api/telemetry`, {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({
-                    type: 'tts_alert',
-                    alert: alertData,
-                    userAgent: navigator.userAgent,
-                    timestamp: Date.now()
-                })
-            });
-        } catch (error) {
-            // Silently fail - don't block on telemetry
-        }
+    _sendTelemetryAlert(alertData) {
+        // Alerts are rare and time-sensitive: queue with the batch and flush now
+        telemetryBatcher.record('tts_alert', null, {
+            alert: alertData,
+            userAgent: navigator.userAgent
+        });
+        telemetryBatcher.flush();
     }
 
     /**
@@ -1993,6 +2100,8 @@ window.TTSInfrastructure = {
     SpeechLane,
     TTSProviderManager,
     TTSTelemetry,
+    TelemetryBatcher,
+    telemetryBatcher,
     RobustTTSService,
     TTSNotification,
     TTSAudioCache,
@@ -2001,6 +2110,7 @@ window.TTSInfrastructure = {
 
 // Create global instance (will be configured in app.js)
 window.robustTTS = null;
+window.telemetryBatcher = telemetryBatcher;
 
 console.log('[TTS Infrastructure] Module loaded (v2 with cache, notifications, alerts)');
 // Helper to respect UI/setting toggle for browser TTS
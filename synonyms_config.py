@@ -2,6 +2,7 @@
 中文同義詞配置文件
 用於知識庫智能匹配
 """
+import threading
 
 # 同義詞組配置
 SYNONYM_GROUPS = {
@@ -48,6 +49,55 @@ SYNONYM_GROUPS = {
     frozenset(['活動', '節目', '比賽', '表演', '慶典', '儀式']),
 }
 
+class SynonymTable:
+    """
+    編譯後的同義詞查找表（不可變）：詞 -> 組號 為 O(1) 字典查找。
+    更新同義詞時建立新表再整體替換，讀取方取得的表在使用期間不會改變；
+    version 每次替換遞增，供下游索引判斷是否需要重建
+    """
+    __slots__ = ('version', 'groups', 'group_ids')
+
+    def __init__(self, groups, version=0):
+        # 排序令組號穩定；詞出現在多個組時歸入排序最前的組
+        self.groups = tuple(sorted({frozenset(group) for group in groups if group}, key=sorted))
+        group_ids = {}
+        for group_id, group in enumerate(self.groups):
+            for word in group:
+                group_ids.setdefault(word, group_id)
+        self.group_ids = group_ids
+        self.version = version
+
+    def group_id(self, word):
+        return self.group_ids.get(word)
+
+    def synonyms(self, word):
+        group_id = self.group_ids.get(word)
+        return self.groups[group_id] if group_id is not None else {word}
+
+
+_table = SynonymTable(SYNONYM_GROUPS)
+_write_lock = threading.Lock()
+
+
+def _install(groups):
+    """以新詞組建立查找表並替換（調用方須持有 _write_lock）"""
+    global SYNONYM_GROUPS, _table
+    table = SynonymTable(groups, _table.version + 1)
+    # 換成新的集合物件而非原地修改，正在遍歷舊集合的線程不受影響
+    SYNONYM_GROUPS = set(table.groups)
+    _table = table
+
+
+def get_table():
+    """目前的同義詞查找表；需要多次查找時先取得表，保證前後一致"""
+    return _table
+
+
+def get_version():
+    """同義詞表版本，每次更新遞增"""
+    return _table.version
+
+
 def get_word_synonyms(word):
     """
     獲取指定詞語的所有同義詞
@@ -58,10 +108,7 @@ def get_word_synonyms(word):
     Returns:
         set: 包含該詞及其同義詞的集合
     """
-    for group in SYNONYM_GROUPS:
-        if word in group:
-            return group
-    return {word}
+    return _table.synonyms(word)
 
 def add_synonym_group(words):
     """
@@ -70,8 +117,8 @@ def add_synonym_group(words):
     Args:
         words (list): 同義詞列表
     """
-    global SYNONYM_GROUPS
-    SYNONYM_GROUPS.add(frozenset(words))
+    with _write_lock:
+        _install(set(_table.groups) | {frozenset(words)})
     
 def remove_synonym_group(sample_word):
     """
@@ -80,20 +127,15 @@ def remove_synonym_group(sample_word):
     Args:
         sample_word (str): 同義詞組中的任一詞語
     """
-    global SYNONYM_GROUPS
-    group_to_remove = None
-    for group in SYNONYM_GROUPS:
-        if sample_word in group:
-            group_to_remove = group
-            break
-    
-    if group_to_remove:
-        SYNONYM_GROUPS.remove(group_to_remove)
+    with _write_lock:
+        group_id = _table.group_id(sample_word)
+        if group_id is not None:
+            _install(group for i, group in enumerate(_table.groups) if i != group_id)
 
 # 可選：載入外部配置檔案的功能
 def load_synonyms_from_file(file_path):
     """
-    從 JSON 檔案載入同義詞配置
+    從 JSON 檔案載入同義詞配置；載入失敗時保留原有配置
     
     Args:
         file_path (str): JSON 檔案路徑
@@ -102,9 +144,10 @@ def load_synonyms_from_file(file_path):
     try:
         with open(file_path, 'r', encoding='utf-8') as f:
             data = json.load(f)
-            global SYNONYM_GROUPS
-            SYNONYM_GROUPS = {frozenset(group) for group in data.get('synonym_groups', [])}
+        groups = {frozenset(group) for group in data.get('synonym_groups', [])}
+        with _write_lock:
+            _install(groups)
     except FileNotFoundError:
         print(f"同義詞配置檔案 {file_path} 不存在")
     except Exception as e:
-        print(f"載入同義詞配置失敗: {e}")
\ No newline at end of file
+        print(f"載入同義詞配置失敗: {e}")
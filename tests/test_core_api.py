@@ -0,0 +1,1078 @@
+"""
+核心功能測試 - 不依賴外部網絡（make test-core）
+"""
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from intent_keywords import KeywordAutomaton, weather_intent
+from intent_router import IntentRouter
+from knowledge_base import KnowledgeBase
+from model_router import AdaptiveModelRouter
+from rate_limiter import LLMRateLimiter, RateLimitExceeded, parse_retry_after
+
+
+@pytest.fixture(scope="session", autouse=True)
+def isolated_knowledge_base(tmp_path_factory):
+    """main 匯入時即建立 KnowledgeBase：指向臨時數據庫，測試不會寫入倉庫中的 knowledge_base.db"""
+    previous = os.environ.get("KNOWLEDGE_BASE_PATH")
+    os.environ["KNOWLEDGE_BASE_PATH"] = str(tmp_path_factory.mktemp("kb") / "knowledge_base.db")
+    yield
+    if previous is None:
+        os.environ.pop("KNOWLEDGE_BASE_PATH", None)
+    else:
+        os.environ["KNOWLEDGE_BASE_PATH"] = previous
+
+
+# ===== LLM 限流 =====
+def test_rate_limiter_rejects_when_burst_exhausted():
+    async def run():
+        limiter = LLMRateLimiter({"together": {"rps": 1, "burst": 2, "max_concurrency": 10}})
+        await limiter.acquire("together", timeout=0)
+        await limiter.acquire("together", timeout=0)
+        with pytest.raises(RateLimitExceeded) as exc_info:
+            await limiter.acquire("together", timeout=0)
+        assert exc_info.value.reason == "rps"
+        assert limiter.get_stats()["together"]["rejected"] == 1
+
+    asyncio.run(run())
+
+
+def test_rate_limiter_caps_concurrency_until_release():
+    async def run():
+        limiter = LLMRateLimiter({"qwen": {"rps": 100, "burst": 100, "max_concurrency": 1}})
+        lease = await limiter.acquire("qwen", timeout=0.05)
+        with pytest.raises(RateLimitExceeded):
+            await limiter.acquire("qwen", timeout=0.05)
+        lease.release()
+        lease.release()  # 重複釋放不應多釋放名額
+        second = await limiter.acquire("qwen", timeout=0.05)
+        assert limiter.get_stats()["qwen"]["active"] == 1
+        second.release()
+
+    asyncio.run(run())
+
+
+def test_rate_limiter_refunds_budget_when_queueing_fails():
+    async def run():
+        limiter = LLMRateLimiter({"qwen": {"rps": 0.01, "burst": 3, "max_concurrency": 1,
+                                           "tokens_per_minute": 600}})
+        provider = limiter.limiters["qwen"]
+        lease = await limiter.acquire("qwen", tokens=100, timeout=0.05)
+        # 並發名額超時：速率及 token 預約都退回
+        with pytest.raises(RateLimitExceeded) as exc_info:
+            await limiter.acquire("qwen", tokens=100, timeout=0.05)
+        assert exc_info.value.reason == "concurrency"
+        assert provider.requests.tokens == pytest.approx(2, abs=0.01)
+        assert provider.tokens.tokens == pytest.approx(500, abs=1)
+
+        # 排隊時被取消亦然
+        waiter = asyncio.create_task(limiter.acquire("qwen", tokens=100, timeout=1))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert provider.requests.tokens == pytest.approx(2, abs=0.01)
+        assert provider.tokens.tokens == pytest.approx(500, abs=1)
+        lease.release()
+
+    asyncio.run(run())
+
+
+def test_rate_limiter_token_budget():
+    async def run():
+        limiter = LLMRateLimiter({"deepseek": {"rps": 100, "burst": 100, "tokens_per_minute": 600}})
+        await limiter.acquire("deepseek", tokens=500, timeout=0)
+        with pytest.raises(RateLimitExceeded) as exc_info:
+            await limiter.acquire("deepseek", tokens=500, timeout=0)
+        assert exc_info.value.reason == "token_budget"
+
+    asyncio.run(run())
+
+
+def test_rate_limiter_backs_off_on_429():
+    async def run():
+        limiter = LLMRateLimiter({"gemini": {"rps": 4, "burst": 4}})
+        lease = await limiter.acquire("gemini", timeout=0)
+        lease.throttled("30")
+        stats = limiter.get_stats()["gemini"]
+        assert stats["current_rps"] == 2
+        assert stats["upstream_429"] == 1
+        with pytest.raises(RateLimitExceeded) as exc_info:
+            await limiter.acquire("gemini", timeout=0.1)
+        assert exc_info.value.reason == "upstream_cooldown"
+
+    asyncio.run(run())
+
+
+def test_rate_limiter_unknown_provider_is_unlimited():
+    async def run():
+        limiter = LLMRateLimiter({})
+        lease = await limiter.acquire("xunfei", timeout=0)
+        assert lease.provider is None
+        lease.release()
+
+    asyncio.run(run())
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("2") == 2.0
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("not-a-date") is None
+
+
+# ===== LLM 指標 =====
+def test_llm_call_timer_records_per_model_stats():
+    main = pytest.importorskip("main")
+    monitor = main.PerformanceMonitor()
+    main_monitor, main.performance_monitor = main.performance_monitor, monitor
+    try:
+        timer = main.LLMCallTimer("qwen", "qwen-turbo-latest")
+        timer.connected()
+        payload = 'data: {"choices": [{"delta": {"content": "你好"}}]}\n\ndata: [DONE]\n\n'.encode("utf-8")
+        # 刻意在多字節字符中間切開
+        cut = payload.index("你".encode("utf-8")) + 1
+        timer.feed_sse(payload[:cut])
+        timer.feed_sse(payload[cut:])
+        assert timer.deltas == 1  # 按串流增量計數，不是 token
+        timer.finish()
+    finally:
+        main.performance_monitor = main_monitor
+
+    stats = monitor.get_stats()["performance"]["llm"]["qwen/qwen-turbo-latest"]
+    assert stats["requests"] == 1
+    assert stats["chars"] == 2
+    assert stats["bytes"] == len(payload)
+    assert stats["first_token_ms"]["samples"] == 1
+    assert set(stats["connect_ms"]) >= {"p50", "p95", "p99"}
+
+
+# ===== 自適應模型路由 =====
+def test_router_prefers_fastest_healthy_model():
+    router = AdaptiveModelRouter(exploration_rate=0)
+    for _ in range(5):
+        router.observe("qwen/turbo", 300, True)
+        router.observe("together/qwen", 900, True)
+        router.observe("deepseek/chat", 100, False)  # 最快但全部失敗
+    choice = router.choose({"qwen-turbo": "qwen/turbo", "together-qwen": "together/qwen",
+                            "deepseek-chat": "deepseek/chat"})
+    assert choice == "qwen-turbo"
+    assert router.get_stats()["routes"]["deepseek/chat"]["healthy"] is False
+
+
+def test_router_explores_other_models():
+    import random
+    router = AdaptiveModelRouter(exploration_rate=0.5, rng=random.Random(1))
+    router.observe("a/fast", 100, True)
+    router.observe("b/slow", 2000, True)
+    choices = [router.choose({"a": "a/fast", "b": "b/slow"}) for _ in range(200)]
+    assert 40 < choices.count("b") < 160
+    assert router.get_stats()["explorations"]["b"] == choices.count("b")
+
+
+# ===== 客戶端斷線取消 =====
+def test_cancellable_response_closes_generator_on_disconnect():
+    main = pytest.importorskip("main")
+    state = {"closed": False}
+
+    async def run():
+        first_sent = asyncio.Event()
+
+        async def body():
+            try:
+                yield b"data: 1\n\n"
+                yield b"data: 2\n\n"
+            finally:
+                state["closed"] = True
+
+        async def receive():
+            await first_sent.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            if message["type"] == "http.response.body" and message.get("body"):
+                first_sent.set()
+                await asyncio.sleep(3600)  # 慢客戶端：生成器停在 yield
+
+        response = main.CancellableStreamingResponse(body(), media_type="text/event-stream", kind="test")
+        await asyncio.wait_for(response({"type": "http"}, receive, send), 1)
+        assert response.client_disconnected
+
+    asyncio.run(run())
+    assert state["closed"]
+
+
+def test_run_until_disconnect_cancels_pending_work():
+    main = pytest.importorskip("main")
+
+    class FakeRequest:
+        async def receive(self):
+            return {"type": "http.disconnect"}
+
+    async def run():
+        stopped = []
+        work = asyncio.ensure_future(asyncio.sleep(3600))
+        with pytest.raises(main.ClientDisconnected):
+            await main._run_until_disconnect(FakeRequest(), work, "test_work",
+                                             on_cancel=lambda: stopped.append(True), chars_saved=10)
+        await asyncio.sleep(0)
+        assert work.cancelled()
+        assert stopped == [True]
+
+    asyncio.run(run())
+    assert main.performance_monitor.cancellations["test_work"]["chars_saved"] == 10
+
+
+# ===== 意圖路由 =====
+def test_keyword_automaton_finds_overlapping_keywords():
+    automaton = KeywordAutomaton([("天氣", "a"), ("天氣情況", "b"), ("氣情", "c"), ("今日", "d")])
+    assert automaton.scan("今日天氣情況點") == {"a": {"天氣"}, "b": {"天氣情況"}, "c": {"氣情"}, "d": {"今日"}}
+    assert automaton.scan("冇關係") == {}
+
+
+def test_weather_intent_matches_previous_keyword_rules():
+    assert weather_intent("聽日天氣點樣") == {"type": "weather", "date": "tomorrow"}
+    assert weather_intent("而家幾度") == {"type": "weather", "date": "today"}
+    assert weather_intent("會唔會落雨") == {"type": "weather", "date": "today"}
+    assert weather_intent("明日幾點開門") is None
+
+
+def test_intent_router_gates_knowledge_base(tmp_path):
+    kb = KnowledgeBase(str(tmp_path / "kb.db"))
+    kb.add_qa_pair("學校在哪一年創辦", "1919年")
+    router = IntentRouter(kb)
+
+    prompts = ["學校在哪一年創辦呢", "學校哪一年創辦", "學校幾時成立", "你好嗎", "今日食咩好", "年創辦"]
+    for prompt in prompts:
+        if kb.find_answer(prompt):
+            assert router.classify(prompt).knowledge, prompt
+    assert router.classify("學校在哪一年創辦呢").route == "knowledge"
+    assert router.classify("你好嗎").route == "llm"
+
+    # 寫入後詞表自動重建
+    assert not router.classify("午餐食咩").knowledge
+    kb.add_qa_pair("午餐食咩", "今日有飯")
+    assert router.classify("午餐食咩").knowledge
+
+
+def test_intent_router_rebuilds_off_the_event_loop(tmp_path):
+    kb = KnowledgeBase(str(tmp_path / "kb.db"))
+    kb.add_qa_pair("學校在哪一年創辦", "1919年")
+    router = IntentRouter(kb)
+
+    async def scenario():
+        # 首次分類只啟動背景重建；舊（空）詞表未命中，但重建完成前一律交由 find_answer 判斷
+        intent = router.classify("學校在哪一年創辦呢")
+        assert "knowledge" not in intent.matches and intent.knowledge
+        await router.refresh()
+        assert "knowledge" in router.classify("學校在哪一年創辦呢").matches
+        assert not router.classify("今日天氣點樣").knowledge
+
+        kb.add_qa_pair("午餐食咩", "今日有飯")
+        intent = router.classify("午餐食咩")
+        assert "knowledge" not in intent.matches and intent.route == "knowledge"
+        task = router.refresh()
+        assert task is router.refresh()  # 同一時間只有一個重建
+        await task
+        assert router.classify("午餐食咩").knowledge and router.refresh() is None
+
+    asyncio.run(scenario())
+    assert router.rebuilds == 2
+    kb.close()
+
+
+def test_intent_router_massage_command_uses_user_turn():
+    router = IntentRouter()
+    system_prompt = "你是智能按摩護理助手，識別按摩部位（肩膀、背部）。\n\n# 當前對話\n\n用戶: "
+    assert router.classify(system_prompt + "你好\n小護: ").route == "llm"
+    assert router.classify(system_prompt + "幫我按摩肩膀\n小護: ").route == "massage_command"
+
+
+# ===== 知識庫索引 =====
+def test_knowledge_base_index_follows_writes(tmp_path):
+    kb = KnowledgeBase(str(tmp_path / "kb.db"))
+    first = kb.add_qa_pair("學校在哪一年創辦", "1919年")
+    second = kb.add_qa_pair("學校哪一年創辦", "較後的答案")
+    assert kb.find_answer("學校哪一年創辦") == "1919年"  # 同分時取較早的條目
+
+    kb.toggle_qa_pair(first["id"])
+    assert kb.find_answer("學校哪一年創辦") == "較後的答案"
+    kb.toggle_qa_pair(first["id"])
+    assert kb.find_answer("學校哪一年創辦") == "1919年"
+
+    kb.update_qa_pair(first["id"], "午餐食咩", "今日有飯")
+    assert kb.find_answer("午餐食咩") == "今日有飯"
+    assert kb.find_answer("學校哪一年創辦") == "較後的答案"
+
+    kb.delete_qa_pair(second["id"])
+    assert kb.find_answer("學校哪一年創辦") is None
+
+    # 重新載入後結果一致
+    reloaded = KnowledgeBase(str(tmp_path / "kb.db"))
+    assert reloaded.find_answer("午餐食咩") == "今日有飯"
+    assert reloaded.find_answer("學校哪一年創辦") is None
+
+
+def test_knowledge_base_inverted_index_matches_full_scan(tmp_path):
+    import random
+    import synonyms_config
+    from knowledge_base import MATCH_THRESHOLD, extract_semantic_keywords, normalize_question
+
+    rng = random.Random(7)
+    words = sorted(w for group in synonyms_config.SYNONYM_GROUPS for w in group if len(w) == 2)
+    words += ["按摩", "肩膀", "預約", "護士"]
+    kb = KnowledgeBase(str(tmp_path / "kb.db"))
+    questions = []
+    for i in range(150):
+        question = "/".join(rng.sample(words, rng.randint(1, 4)))
+        if question not in questions:
+            questions.append(question)
+            kb.add_qa_pair(question, f"答案{len(questions) - 1}")
+
+    def full_scan(query):
+        user = extract_semantic_keywords(normalize_question(query))
+        best, best_score = None, 0
+        for i, question in enumerate(questions):
+            stored = extract_semantic_keywords(normalize_question(question))
+            if user and stored:
+                score = len(user & stored) / len(user | stored)
+                if score > best_score:
+                    best, best_score = f"答案{i}", score
+        return best if best_score >= MATCH_THRESHOLD else None
+
+    for _ in range(300):
+        query = "/".join(rng.sample(words, rng.randint(1, 4)))
+        assert kb._match_keywords(query) == full_scan(query), query
+
+
+def test_knowledge_base_bitset_search_agrees_with_find_answer(tmp_path):
+    kb = KnowledgeBase(str(tmp_path / "kb.db"))
+    kb.add_qa_pair("學校/哪一年/創辦", "1919年")
+    kb.add_qa_pair("學校/哪一年/創辦/報名", "較後的答案")
+    kb.add_qa_pair("午餐/食咩", "今日有飯")
+
+    top = kb.search("學府/幾時/創校", top_k=2)
+    assert [row["answer"] for row in top] == ["1919年", "較後的答案"]
+    assert top[0]["score"] > top[1]["score"] >= 0.4
+
+    questions = ["學府/幾時/創校", "中飯/食咩", "你好嗎"]
+    batch = kb.search_batch(questions, top_k=1)
+    assert [rows[0]["answer"] if rows else None for rows in batch] == [kb.find_answer(q) for q in questions]
+
+    kb.delete_qa_pair(top[0]["id"])
+    assert kb.search("學府/幾時/創校", top_k=1)[0]["answer"] == "較後的答案"
+
+
+def test_knowledge_base_runs_queries_on_wal_worker_thread(tmp_path):
+    kb = KnowledgeBase(str(tmp_path / "kb.db"))
+
+    async def run():
+        added = await kb.run_async(kb.add_qa_pair, "午餐/食咩", "今日有飯")
+        with pytest.raises(ValueError):
+            await kb.run_async(kb.add_qa_pair, "午餐/食咩", "重複")
+        return added, await kb.run_async(kb.get_all_qa_pairs)
+
+    added, rows = asyncio.run(run())
+    assert rows == [{"id": added["id"], "question": "午餐/食咩", "questions": ["午餐/食咩"],
+                     "answer": "今日有飯", "enabled": 1, "category": "未分類"}]
+    assert kb._db.run(lambda conn: conn.execute("PRAGMA journal_mode").fetchone()[0]) == "wal"
+    kb.close()
+
+
+def test_knowledge_base_fts_fallback_recalls_unaligned_phrasing(tmp_path):
+    kb = KnowledgeBase(str(tmp_path / "kb.db"))
+    if not kb.fts_enabled:
+        pytest.skip("SQLite 未支援 FTS5 trigram")
+    qa = kb.add_qa_pair("請問學校喺邊度", "喺九龍塘")
+    kb.add_qa_pair("午餐幾點開始", "十二點")
+
+    assert kb._match_keywords("學校喺邊度呀") is None  # 分詞邊界不同，關鍵詞匹配失敗
+    assert kb.find_answer("學校喺邊度呀") == "喺九龍塘"
+    assert kb.find_answer("學府喺邊度") == "喺九龍塘"  # 同義詞
+    assert kb.find_answer("今日天氣點樣") is None
+
+    # 觸發器同步更新及刪除
+    kb.update_qa_pair(qa["id"], "請問醫院喺邊度", "喺九龍城")
+    assert kb.find_answer("學校喺邊度呀") is None
+    assert kb.find_answer("醫院喺邊度呀") == "喺九龍城"
+    kb.delete_qa_pair(qa["id"])
+    assert kb.find_answer("醫院喺邊度呀") is None
+
+    # FTS 預先判斷的 bigram 統計隨寫入增量維護，與全量重算一致
+    def recount():
+        enabled = [e.bigrams for e in kb._index.values() if e.enabled]
+        counts = {}
+        for bigrams in enabled:
+            for bigram in bigrams:
+                counts[bigram] = counts.get(bigram, 0) + 1
+        return counts, max(map(len, enabled), default=0)
+
+    long_qa = kb.add_qa_pair("請問院舍探訪時間係幾點至幾點", "十點至八點")
+    kb.toggle_qa_pair(long_qa["id"])
+    assert (kb._bigram_counts, kb._max_bigrams) == recount()
+    assert not kb.may_match_fts("院舍探訪時間係幾點")
+    kb.toggle_qa_pair(long_qa["id"])
+    assert (kb._bigram_counts, kb._max_bigrams) == recount()
+    assert kb.may_match_fts("院舍探訪時間係幾點")
+
+
+def test_knowledge_base_aliases_and_bulk_import(tmp_path):
+    import json
+
+    kb = KnowledgeBase(str(tmp_path / "kb.db"))
+    qa = kb.add_qa_pair("學校/哪一年/創辦", "1919年", "校史", ["校慶/邊日"])
+    assert qa["questions"] == ["學校/哪一年/創辦", "校慶/邊日"] and qa["category"] == "校史"
+    assert kb.find_answer("校慶/邊日") == "1919年"  # 經別名命中
+
+    lines = [
+        json.dumps({"questions": ["午餐/食咩", "中午/食咩"], "answer": "今日有飯", "category": "膳食"}),
+        "",
+        json.dumps({"question": "學校/哪一年/創辦", "answer": "重複"}),
+        json.dumps({"questions": ["收費/多少錢"], "answer": "免費", "enabled": False}),
+    ]
+    stats = kb.import_jsonl(lines)
+    assert (stats["imported"], stats["skipped"], stats["aliases"]) == (2, 1, 1)
+    assert kb.find_answer("中午/食咩") == "今日有飯"
+    assert kb.find_answer("收費/多少錢") is None  # 匯入為停用
+    assert [r[0]["id"] for r in kb.search_batch(["午餐/食咩"], top_k=1)] == [qa["id"] + 1]
+
+    with pytest.raises(ValueError, match="Line 2"):
+        kb.import_jsonl([json.dumps({"question": "新問題/一", "answer": "a"}), "{not json"])
+    assert kb.find_answer("新問題/一") is None  # 整批回滾
+
+    exported = [row for page in (kb.export_page(0, 2), kb.export_page(2, 2)) for row in page]
+    assert [row["questions"] for row in exported] == [["學校/哪一年/創辦", "校慶/邊日"],
+                                                      ["午餐/食咩", "中午/食咩"], ["收費/多少錢"]]
+
+    kb.update_qa_pair(qa["id"], "學校/哪一年/創辦", "1919年", aliases=[])
+    assert kb.find_answer("校慶/邊日") is None
+    kb.delete_qa_pair(qa["id"] + 1)
+    assert kb.find_answer("中午/食咩") is None
+
+
+def test_knowledge_base_primary_questions_and_aliases_share_one_namespace(tmp_path):
+    import json
+
+    kb = KnowledgeBase(str(tmp_path / "kb.db"))
+    first = kb.add_qa_pair("學校在哪一年創辦", "1919年", aliases=["校慶/邊日"])
+    other = kb.add_qa_pair("學校創辦年份", "1920年")
+
+    # 別名與其他問答的主問題重複
+    with pytest.raises(ValueError, match="學校在哪一年創辦"):
+        kb.add_qa_pair("學校幾時成立", "1920年", aliases=["學校在哪一年創辦"])
+    with pytest.raises(ValueError, match="學校在哪一年創辦"):
+        kb.update_qa_pair(other["id"], "學校創辦年份", "1920年", aliases=["學校在哪一年創辦"])
+    # 主問題與其他問答的別名重複
+    with pytest.raises(ValueError, match="校慶/邊日"):
+        kb.add_qa_pair("校慶/邊日", "十月")
+    with pytest.raises(ValueError, match="校慶/邊日"):
+        kb.update_qa_pair(other["id"], "校慶/邊日", "1920年")
+    assert kb.find_answer("學校創辦年份") == "1920年"
+    assert kb.find_answer("學校在哪一年創辦") == "1919年"
+
+    # 主問題改為自身別名時，該別名移除
+    updated = kb.update_qa_pair(first["id"], "校慶/邊日", "1919年")
+    assert updated["questions"] == ["校慶/邊日"]
+
+    # 匯入：任一問法已存在（不論是主問題或別名）的記錄整條略過
+    stats = kb.import_jsonl([
+        json.dumps({"questions": ["午餐/食咩", "學校創辦年份"], "answer": "a"}),
+        json.dumps({"questions": ["放學/幾點", "校慶/邊日"], "answer": "b"}),
+        json.dumps({"questions": ["校車/路線"], "answer": "c"}),
+    ])
+    assert (stats["imported"], stats["skipped"]) == (1, 2)
+    assert [row["questions"] for row in kb.export_page(0, 10)] == [["校慶/邊日"], ["學校創辦年份"], ["校車/路線"]]
+
+
+def test_knowledge_import_rejects_oversized_upload(monkeypatch):
+    main = pytest.importorskip("main")
+    from fastapi import HTTPException
+    from starlette.requests import Request
+
+    monkeypatch.setattr(main, "KNOWLEDGE_IMPORT_MAX_MB", 1 / 1024)  # 1 KB
+    chunks = [b'{"question": "a", "answer": "' + b"x" * 600 + b'"}\n'] * 2
+    received = []
+
+    async def receive():
+        # 未聲明 Content-Length：超出上限後不再讀取剩餘內容
+        received.append(chunks[len(received)])
+        return {"type": "http.request", "body": received[-1], "more_body": len(received) < len(chunks)}
+
+    def request(headers=()):
+        return Request({"type": "http", "method": "POST", "path": "/api/knowledge/import",
+                        "headers": list(headers), "query_string": b""}, receive)
+
+    with pytest.raises(HTTPException) as excinfo:
+        asyncio.run(main.import_qa_pairs(request()))
+    assert excinfo.value.status_code == 413 and len(received) == 2
+
+    received.clear()
+    with pytest.raises(HTTPException) as excinfo:
+        asyncio.run(main.import_qa_pairs(request([(b"content-length", b"4096")])))
+    assert excinfo.value.status_code == 413 and not received
+
+
+# ===== 分詞 =====
+def test_jieba_segmenter_uses_cached_user_dictionary(tmp_path, monkeypatch):
+    pytest.importorskip("jieba")
+    import knowledge_base
+    from segmenter import Segmenter
+
+    cache_path = str(tmp_path / "jieba.cache")
+    first = Segmenter(cache_path)
+    first.load()
+    assert first.source == "built" and os.path.exists(cache_path)
+
+    seg = Segmenter(cache_path)
+    seg.load()
+    assert seg.source == "cache"
+    monkeypatch.setattr(knowledge_base, "segmenter", seg)
+
+    kb = KnowledgeBase(str(tmp_path / "kb.db"))
+    kb.add_qa_pair("請問學校喺邊度", "喺九龍塘")
+    assert knowledge_base.extract_words("請問學校喺邊度") == ["請問學校", "喺邊度"]  # 未啟用：正則
+
+    version = kb.version
+    assert kb.enable_segmenter()
+    assert kb.version > version and seg.get_stats()["backend"] == "jieba"
+    # 詞典詞整詞切出，未識別的片段仍按正則切分
+    assert knowledge_base.extract_words("請問學校喺邊度") == ["請問", "學校", "喺邊度"]
+    assert knowledge_base.extract_words("天竺葵學校") == ["天竺葵", "學校"]
+    assert kb._match_keywords("學府喺邊度") == "喺九龍塘"
+
+
+def test_synonym_table_hot_reload_invalidates_knowledge_base(tmp_path):
+    import json
+    import synonyms_config
+
+    kb = KnowledgeBase(str(tmp_path / "kb.db"))
+    kb.add_qa_pair("按摩/預約", "請致電預約")
+    router = IntentRouter(kb)
+    assert kb.find_answer("推拿/預約") is None
+
+    table, version = synonyms_config.get_table(), kb.version
+    try:
+        synonyms_config.add_synonym_group(["按摩", "推拿", "揼骨"])
+        assert synonyms_config.get_version() == table.version + 1
+        assert synonyms_config.get_word_synonyms("推拿") == {"按摩", "推拿", "揼骨"}
+        assert table.group_id("推拿") is None  # 舊表不受影響
+        assert kb.find_answer("推拿/預約") == "請致電預約"
+        assert kb.version > version
+        assert router.classify("揼骨/預約").knowledge
+
+        # 載入失敗保留原表；成功時整體替換
+        bad = tmp_path / "bad.json"
+        bad.write_text("{", encoding="utf-8")
+        synonyms_config.load_synonyms_from_file(str(bad))
+        assert synonyms_config.get_word_synonyms("揼骨") == {"按摩", "推拿", "揼骨"}
+        good = tmp_path / "synonyms.json"
+        good.write_text(json.dumps({"synonym_groups": [["預約", "訂位"]]}), encoding="utf-8")
+        synonyms_config.load_synonyms_from_file(str(good))
+        assert synonyms_config.get_word_synonyms("學府") == {"學府"}
+        assert kb.find_answer("按摩/訂位") == "請致電預約"
+    finally:
+        with synonyms_config._write_lock:
+            synonyms_config._install(table.groups)
+    assert synonyms_config.get_word_synonyms("推拿") == {"推拿"}
+
+
+def test_knowledge_base_answer_cache_invalidated_by_version(tmp_path):
+    kb = KnowledgeBase(str(tmp_path / "kb.db"))
+    qa = kb.add_qa_pair("午餐食咩", "今日有飯")
+
+    assert kb.find_answer("午餐食咩？") == "今日有飯"
+    assert kb.find_answer("午餐食咩") == "今日有飯"  # 標準化後相同
+    assert kb.find_answer("你好嗎") is None
+    assert kb.find_answer("你好嗎") is None  # 未命中同樣緩存
+    stats = kb.get_cache_stats()
+    assert (stats["hits"], stats["misses"], stats["negative"]) == (2, 2, 1)
+
+    kb.update_qa_pair(qa["id"], "午餐食咩", "今日有麵")
+    assert kb.find_answer("午餐食咩") == "今日有麵"
+    kb.add_qa_pair("你好嗎", "我很好")
+    assert kb.find_answer("你好嗎") == "我很好"
+    assert kb.get_cache_stats()["hit_rate"] == 0.3333
+
+
+def test_knowledge_base_benchmark_suite_reports_recall_and_latency():
+    import importlib.util
+    spec = importlib.util.spec_from_file_location(
+        "benchmark_kb", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                     "scripts", "benchmark_kb.py"))
+    benchmark_kb = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(benchmark_kb)
+
+    report = benchmark_kb.run_suite([100], queries=40, segmenters=["regex"], seed=1)
+    rows = {row["mode"]: row for row in report["results"]}
+    assert set(rows) == {"keywords", "find_answer", "find_answer_cached"}
+    assert report["match_threshold"] == 0.4 and rows["find_answer"]["queries"] == 50
+    assert rows["find_answer"]["recall"] > 0
+    # 緩存不改變結果
+    assert rows["find_answer_cached"]["recall"] == rows["find_answer"]["recall"]
+    assert rows["find_answer"]["p50_ms"] <= rows["find_answer"]["p99_ms"]
+
+
+def test_knowledge_base_list_page_keyset_projection_and_search(tmp_path):
+    kb = KnowledgeBase(str(tmp_path / "kb.db"))
+    for i in range(5):
+        kb.add_qa_pair(f"問題{i}", f"答案{i}", "學校" if i % 2 else "飯堂", [f"別名{i}"])
+
+    first = kb.list_page(0, 2, fields=["id", "questions"])
+    assert first == [{"id": 1, "questions": ["問題0", "別名0"]}, {"id": 2, "questions": ["問題1", "別名1"]}]
+    assert [qa["id"] for qa in kb.list_page(first[-1]["id"], 10, fields=["id"])] == [3, 4, 5]
+
+    assert [qa["id"] for qa in kb.list_page(search="別名3")] == [4]
+    assert [qa["id"] for qa in kb.list_page(search="答案", category="學校")] == [2, 4]
+    assert kb.list_page(0, 1) == [{"id": 1, "question": "問題0", "answer": "答案0", "enabled": 1,
+                                   "category": "飯堂", "questions": ["問題0", "別名0"]}]
+    with pytest.raises(ValueError):
+        kb.list_page(fields=["password"])
+
+    kb.toggle_qa_pair(1)
+    assert kb.get_summary() == {"total": 5, "enabled": 4, "categories": ["學校", "飯堂"]}
+
+
+def test_answer_audio_presynthesis_pins_client_chunks(tmp_path):
+    main = pytest.importorskip("main")
+    from answer_audio import CLIENT_PITCH, CLIENT_RATE, AnswerAudioPreSynthesizer, client_tts_texts
+
+    # 與 UltraFastTTSPlayer 相同：逐句切段，短於 8 字的尾段不朗讀，Markdown 符號被移除
+    assert client_tts_texts("**開放時間**係朝早9.30。星期日休息！好") == ["開放時間係朝早9.30。", "星期日休息！"]
+    long_text = "甲" * 20 + "，" + "乙" * 40
+    assert client_tts_texts(long_text) == ["甲" * 20 + "，", "乙" * 40]
+
+    kb = KnowledgeBase(str(tmp_path / "kb.db"))
+    cache = main.IntelligentTTSCache()
+    cache.max_size = 2
+    synthesized = []
+
+    async def synthesize(text, voice, rate, pitch):
+        synthesized.append((text, voice))
+        return text.encode()
+
+    async def scenario():
+        job = AnswerAudioPreSynthesizer(kb, cache, synthesize, ["v1", "v2"])
+        job.start()
+        qa = kb.add_qa_pair("幾點開門", "朝早九點開門。晚上六點關門。")
+        job.schedule_all()  # 工作協程在背景分頁排入全部問答
+        while job.get_stats()["backlog_answers"] or job.get_stats()["answers_processed"] < 1:
+            await asyncio.sleep(0.01)
+        assert len(synthesized) == 4 and job.get_stats()["pinned_clips"] == 4
+
+        # 固定的音頻不被 LRU 淘汰
+        for i in range(5):
+            await cache.put(f"其他{i}", "v1", CLIENT_RATE, CLIENT_PITCH, b"x")
+        assert await cache.get("朝早九點開門。", "v2", CLIENT_RATE, CLIENT_PITCH) == "朝早九點開門。".encode()
+
+        # 更新答案：只補合成新段落，舊段落移除
+        kb.update_qa_pair(qa["id"], "幾點開門", "朝早九點開門。晚上七點關門。")
+        job.schedule(qa["id"])
+        while job.get_stats()["answers_processed"] < 2:
+            await asyncio.sleep(0.01)
+        assert len(synthesized) == 6
+        assert await cache.get("晚上六點關門。", "v1", CLIENT_RATE, CLIENT_PITCH) is None
+
+        kb.delete_qa_pair(qa["id"])
+        job.schedule(qa["id"])
+        while job.get_stats()["answers_processed"] < 3:
+            await asyncio.sleep(0.01)
+        stats = job.get_stats()
+        await job.stop()
+        return stats
+
+    stats = asyncio.run(scenario())
+    assert stats["pinned_clips"] == 0 and stats["removed"] == 6
+    assert cache.pinned_bytes() == 0
+
+
+def test_answer_audio_records_only_cached_clips(tmp_path):
+    main = pytest.importorskip("main")
+    from answer_audio import CLIENT_PITCH, CLIENT_RATE, AnswerAudioPreSynthesizer
+
+    cache = main.IntelligentTTSCache()
+    failing = {"v2"}
+
+    async def synthesize(text, voice, rate, pitch):
+        if voice in failing:
+            raise RuntimeError("edge down")
+        return text.encode()
+
+    async def run(job, processed):
+        while job.get_stats()["answers_processed"] < processed:
+            await asyncio.sleep(0.01)
+        return job.get_stats()
+
+    async def scenario():
+        job = AnswerAudioPreSynthesizer(None, cache, synthesize, ["v1", "v2"])
+        job.start()
+        job.schedule_text("weather:default:today", "今日天氣晴朗。")
+        stats = await run(job, 1)
+        # 失敗的段落不算已有音頻
+        assert not job.has_audio("weather:default:today")
+        assert stats["answers_with_audio"] == 0 and stats["answers_incomplete"] == 1
+        assert stats["pinned_clips"] == 1 and stats["failed"] == 1
+
+        failing.clear()
+        job.schedule_text("weather:default:today", "今日天氣晴朗。")
+        stats = await run(job, 2)
+        assert job.has_audio("weather:default:today")
+        assert stats["answers_with_audio"] == 1 and stats["pinned_clips"] == 2 and stats["synthesized"] == 2
+        assert await cache.get("今日天氣晴朗。", "v2", CLIENT_RATE, CLIENT_PITCH) is not None
+        await job.stop()
+
+    asyncio.run(scenario())
+
+
+def test_weather_service_single_flight_stale_while_revalidate(monkeypatch):
+    from datetime import datetime, timedelta
+    from weather_service import WeatherService
+
+    service = WeatherService()
+    days = [(datetime.now() + timedelta(days=i)).strftime("%Y-%m-%d") for i in range(2)]
+    forecast = {"current": {"temperature_2m": 25.0, "relative_humidity_2m": 70, "weather_code": 1},
+                "daily": {"time": days, "temperature_2m_max": [28.0, 30.0], "temperature_2m_min": [22.0, 23.0],
+                          "weather_code": [1, 61], "precipitation_sum": [0.0, 5.0]}}
+    calls = []
+
+    async def fetch(*args):
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return forecast
+
+    monkeypatch.setattr(service, "_fetch_forecast", fetch)
+
+    async def scenario():
+        # 同時未命中只請求一次，今明兩日共用同一份預報
+        today, tomorrow = await asyncio.gather(service.get_weather("today"), service.get_weather("tomorrow"))
+        assert len(calls) == 1
+        assert today["temperature_max"] == 28.0 and tomorrow["weather_code"] == 61
+        assert await service.get_weather("tomorrow") is tomorrow
+
+        # 過期：即時返回舊數據，背景刷新一次
+        service.forecast_entry()["time"] -= service._cache_ttl + 1
+        assert (await service.get_weather("today"))["temperature"] == 25.0
+        await service.get_weather("tomorrow")
+        await asyncio.gather(*service._refresh_tasks.values())
+        assert len(calls) == 2 and service.get_cache_stats()["valid"]
+
+    asyncio.run(scenario())
+    stats = service.get_cache_stats()
+    assert stats["misses"] == 2 and stats["coalesced"] == 1 and stats["stale_hits"] == 2
+
+
+def test_weather_service_deadline_leaves_retries_in_background(monkeypatch):
+    from weather_service import WeatherService
+
+    service = WeatherService()
+    service._retry_delay = 0.01
+    attempts = []
+
+    async def fetch(*args):
+        attempts.append(1)
+        await asyncio.sleep(0.05)
+        raise RuntimeError("upstream down")
+
+    monkeypatch.setattr(service, "_fetch_forecast", fetch)
+
+    async def scenario():
+        start = asyncio.get_running_loop().time()
+        assert await service.get_weather("today", timeout=0.02) is None
+        assert asyncio.get_running_loop().time() - start < 0.05
+        # 重試在背景完成，之後冷卻期內的請求不再等待
+        await asyncio.gather(*service._refresh_tasks.values())
+        assert len(attempts) == service._max_retries
+        assert await service.get_weather("today", timeout=1) is None
+
+    asyncio.run(scenario())
+    stats = service.get_cache_stats()
+    assert stats["deadline_exceeded"] == 1 and stats["refresh_failures"] == 1 and stats["cooldown_skips"] == 1
+
+
+def test_weather_prefetcher_serves_pre_rendered_responses(monkeypatch):
+    from datetime import datetime
+    from weather_service import WeatherPrefetcher, WeatherService
+
+    service = WeatherService()
+    forecast = {"current": {"temperature_2m": 31.0, "relative_humidity_2m": 80, "weather_code": 0},
+                "daily": {"time": [datetime.now().strftime("%Y-%m-%d")], "temperature_2m_max": [33.0],
+                          "temperature_2m_min": [27.0], "weather_code": [0], "precipitation_sum": [0.0]}}
+
+    async def fetch(*args):
+        return forecast
+
+    monkeypatch.setattr(service, "_fetch_forecast", fetch)
+    updates = []
+    prefetcher = WeatherPrefetcher(service, interval=3600, on_update=lambda site, date, text: updates.append((date, text)))
+
+    async def scenario():
+        assert prefetcher.get_response("today") is None
+        prefetcher.start()
+        while prefetcher.last_refresh is None:
+            await asyncio.sleep(0.01)
+        await prefetcher.stop()
+
+    asyncio.run(scenario())
+    # 預報只有一日：明日沒有回應，今日回應與 format_weather_response 一致並只通知一次
+    assert updates == [("today", service.format_weather_response(service._from_forecast(service.forecast_entry(), "today")))]
+    assert prefetcher.get_response("today") == updates[0][1]
+    assert prefetcher.get_response("tomorrow") is None
+    stats = prefetcher.get_stats()
+    assert stats["served"] == 1 and stats["not_ready"] == 2 and stats["responses_ready"] == ["default:today"]
+
+
+def test_weather_today_and_tomorrow_follow_local_midnight(monkeypatch):
+    from datetime import datetime, timezone
+    from weather_service import WeatherPrefetcher, WeatherService
+
+    service = WeatherService()
+    clock = {"now": datetime(2026, 3, 1, 15, 59, tzinfo=timezone.utc)}  # 香港 23:59
+    monkeypatch.setattr(service, "_now", lambda: clock["now"])
+    forecast = {"utc_offset_seconds": 8 * 3600,
+                "current": {"temperature_2m": 20.0, "relative_humidity_2m": 70, "weather_code": 1},
+                "daily": {"time": ["2026-03-01", "2026-03-02"], "temperature_2m_max": [21.0, 26.0],
+                          "temperature_2m_min": [15.0, 19.0], "weather_code": [1, 61], "precipitation_sum": [0.0, 4.0]}}
+
+    async def fetch(*args):
+        return forecast
+
+    monkeypatch.setattr(service, "_fetch_forecast", fetch)
+    prefetcher = WeatherPrefetcher(service)
+
+    async def scenario():
+        assert (await service.get_weather("today"))["temperature_max"] == 21.0
+        assert (await service.get_weather("tomorrow"))["temperature_max"] == 26.0
+        before = prefetcher.get_response("today")
+
+        # 同一份預報仍新鮮，跨過午夜後今日是原來的明日，明日已不在預報內
+        clock["now"] = datetime(2026, 3, 1, 16, 1, tzinfo=timezone.utc)
+        assert (await service.get_weather("today"))["temperature_max"] == 26.0
+        assert service._from_forecast(service.forecast_entry(), "tomorrow") is None
+        after = prefetcher.get_response("today")
+        assert after != before and "26.0" in after
+        assert prefetcher.get_response("tomorrow") is None
+
+    asyncio.run(scenario())
+
+
+def test_weather_service_coalesces_nearby_locations_in_bounded_cache(monkeypatch):
+    from weather_service import WeatherService
+
+    service = WeatherService()
+    service._max_locations = 2
+    fetched = []
+
+    async def fetch(latitude, longitude, tz):
+        fetched.append((latitude, longitude))
+        await asyncio.sleep(0.01)
+        return {"current": {"temperature_2m": latitude}, "daily": {}}
+
+    monkeypatch.setattr(service, "_fetch_forecast", fetch)
+    site_a = {"latitude": 22.3193, "longitude": 114.1694}
+    site_b = {"latitude": 22.3150, "longitude": 114.1650}  # 約 0.6 公里外，同一網格單元
+    site_c = {"latitude": 22.4500, "longitude": 114.0300}
+
+    async def scenario():
+        a, b = await asyncio.gather(service.get_weather(location=site_a), service.get_weather(location=site_b))
+        assert len(fetched) == 1 and a is b
+        await service.get_weather(location=site_c)
+        # 過期項目在下次寫入時清除，數量不超過上限
+        service.forecast_entry(site_a)["time"] -= service._stale_ttl
+        await service.get_weather(location={"latitude": 22.2000, "longitude": 114.2500})
+        assert service.forecast_entry(site_a) is None and service.forecast_entry(site_c) is not None
+
+    asyncio.run(scenario())
+    stats = service.get_cache_stats()
+    assert stats["locations"] == 2 and stats["evictions"] == 1 and stats["coalesced"] == 1
+
+
+# ===== 延遲統計 =====
+def test_quantile_sketch_accuracy_and_merge():
+    import random
+    from latency_stats import QuantileSketch
+
+    rng = random.Random(0)
+    values = [rng.lognormvariate(5, 1) for _ in range(20000)]
+    left, right = QuantileSketch(), QuantileSketch()
+    for i, value in enumerate(values):
+        (left if i % 2 else right).add(value)
+    left.merge(right)
+
+    ordered = sorted(values)
+    for q, estimate in zip((0.5, 0.95, 0.99), left.quantiles((0.5, 0.95, 0.99))):
+        exact = ordered[int(q * (len(ordered) - 1))]
+        assert abs(estimate - exact) / exact < 0.02
+    assert left.count == len(values) and left.quantile(1.0) == max(values)
+    assert QuantileSketch().summary()["p95"] is None
+
+
+def test_windowed_sketch_expires_old_slots():
+    from latency_stats import WindowedSketch
+
+    sketch = WindowedSketch()
+    now = 1_000_000.0
+    sketch.add(500, now - 1800)  # 30 分鐘前
+    for value in (10, 20, 30):
+        sketch.add(value, now - 5)
+    assert sketch.summary("1m", now)["samples"] == 3
+    assert sketch.summary("5m", now)["p99"] == pytest.approx(30, rel=0.02)
+    assert sketch.summary("1h", now)["samples"] == 4
+    # 一小時後時間片被重用，舊樣本不再計入
+    sketch.add(1, now + 3600)
+    assert sketch.summary("1h", now + 3600)["samples"] == 1
+    assert sketch.summary("all")["samples"] == 5
+
+
+# ===== Prometheus 指標 =====
+def test_prometheus_registry_and_http_middleware():
+    from fastapi import FastAPI
+    from prometheus_metrics import HTTPMetricsMiddleware, MetricsRegistry
+
+    registry = MetricsRegistry(prefix="test_")
+    latency = registry.histogram("http_seconds", "HTTP latency", ("method", "route", "status"), buckets=(0.1, 1))
+    cache_requests = registry.callback("cache_requests_total", "Cache lookups", "counter",
+                                       lambda: {("hit",): 3}, ("result",))
+    assert not hasattr(cache_requests, "labels")  # 回調指標沒有子項
+    app = FastAPI()
+
+    @app.get("/items/{item_id}")
+    async def item(item_id: int):
+        return {"id": item_id}
+
+    app.add_middleware(HTTPMetricsMiddleware, histogram=latency)
+
+    async def call(path):
+        messages = []
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+                 "scheme": "http", "path": path, "raw_path": path.encode(), "query_string": b"",
+                 "root_path": "", "headers": [], "client": ("test", 1), "server": ("test", 80)}
+        await app(scope, receive, send)
+        return messages[0]["status"]
+
+    async def scenario():
+        assert await call("/items/1") == 200
+        assert await call("/items/2") == 200
+        assert await call("/nope") == 404
+
+    asyncio.run(scenario())
+    text = registry.render()
+    # 路由以模板歸類，直方圖為累計桶
+    assert 'test_http_seconds_bucket{method="GET",route="/items/{item_id}",status="200",le="+Inf"} 2' in text
+    assert 'test_http_seconds_count{method="GET",route="unmatched",status="404"} 1' in text
+    assert "# TYPE test_http_seconds histogram" in text
+    assert 'test_cache_requests_total{result="hit"} 3' in text
+
+
+# ===== 請求追蹤 =====
+def test_tracing_spans_follow_streaming_response(tmp_path, capsys):
+    from fastapi import FastAPI
+    from fastapi.responses import StreamingResponse
+    import tracing
+    from scripts import trace_report
+
+    log_path = str(tmp_path / "traces.jsonl")
+    tracer = tracing.Tracer(log_path, sample_rate=1.0)
+    app = FastAPI()
+
+    @app.post("/api/chat")
+    async def chat():
+        with tracing.span("kb_lookup", hit=False):
+            await asyncio.sleep(0)
+
+        async def stream():
+            # 串流生成器在回應開始後才執行，仍屬同一追蹤
+            tracing.mark("llm_first_token")
+            yield b"hello"
+            tracing.record("llm_stream", 5.0, tokens=1)
+
+        return StreamingResponse(stream())
+
+    app.add_middleware(tracing.TracingMiddleware, tracer=tracer)
+
+    async def call():
+        messages = []
+
+        async def receive():
+            await asyncio.sleep(0.01)
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+                 "scheme": "http", "path": "/api/chat", "raw_path": b"/api/chat", "query_string": b"",
+                 "root_path": "", "headers": [(b"x-trace-id", b"abc123")], "client": ("test", 1),
+                 "server": ("test", 80)}
+        await app(scope, receive, send)
+        return messages
+
+    messages = asyncio.run(call())
+    assert (b"x-trace-id", b"abc123") in messages[0]["headers"]
+    assert tracing.current() is None
+    tracer.close()
+
+    traces = trace_report.load_traces(log_path)
+    assert len(traces) == 1 and traces[0]["trace_id"] == "abc123" and traces[0]["status"] == 200
+    names = [span["name"] for span in traces[0]["spans"]]
+    assert names == ["kb_lookup", "response_start", "llm_first_token", "first_body", "llm_stream"]
+    assert traces[0]["spans"][0]["hit"] is False
+
+    breakdown = trace_report.stage_breakdown(traces)
+    assert breakdown["llm_stream"]["count"] == 1 and breakdown["total"]["count"] == 1
+    assert trace_report.main(["--path", log_path, "--trace", "abc123"]) == 0
+    assert "llm_first_token" in capsys.readouterr().out
+
+
+# ===== 客戶端遙測 =====
+def test_client_telemetry_batches_merge_into_shared_sketches():
+    from client_telemetry import ClientTelemetryAggregator, TelemetryFormatError, parse_batch
+    from latency_stats import WindowedSketch
+
+    shared = WindowedSketch()
+    shared.add(100, now=1000.0)  # 伺服器端已記錄的樣本
+    observed = []
+    aggregator = ClientTelemetryAggregator({"first_chunk": shared}, counted=("error",), max_clients=2,
+                                           max_age=240, on_value=lambda kind, value: observed.append(value))
+
+    # NDJSON：無 type 的行為批次資料；客戶端時鐘比伺服器慢 5 秒
+    meta, events = parse_batch(b'{"session_id": "s1", "sent_at": 995000}\n'
+                               b'{"type": "first_chunk", "value": 200, "ts": 994000}\n'
+                               b'{"type": "first_chunk", "value": 300, "ts": 994500}\n'
+                               b'{"type": "error"}\n'
+                               b'{"type": "first_chunk", "value": -1}\n'
+                               b'{"type": "unknown"}\n')
+    assert meta == {"session_id": "s1", "sent_at": 995000}
+    result = aggregator.ingest(events, aggregator.client_key(meta["session_id"], "1.2.3.4"),
+                               sent_at=meta["sent_at"], now=1000.0)
+    assert result == {"accepted": 3, "rejected": 2, "counts": {"first_chunk": 2, "error": 1}}
+    assert observed == [200, 300]
+
+    # 與伺服器端樣本在同一窗口合併
+    window = shared.summary("1m", now=1000.0)
+    assert window["samples"] == 3 and window["p50"] == pytest.approx(200, rel=0.02)
+    assert aggregator.get_client("s1")["first_chunk"]["samples"] == 2
+
+    # 過舊的事件計入窗口最舊的時間點，不會清空已重用的時間片
+    old = [{"type": "first_chunk", "value": 50, "ts": 0}]
+    aggregator.ingest(old, aggregator.client_key("bad id!", "1.2.3.4"), now=1000.0)
+    assert aggregator.get_stats("5m")["late_events"] == 1
+    assert shared.summary("5m", now=1000.0)["samples"] == 4
+
+    # 客戶端按 LRU 保留固定數量
+    aggregator.ingest([], "s3", now=1000.0)
+    assert aggregator.get_client("s1") is None and aggregator.get_client("ip:1.2.3.4") is not None
+    assert aggregator.get_stats()["clients_evicted"] == 1 and aggregator.client_count == 2
+
+    assert parse_batch(b'[{"type": "error"}]') == ({}, [{"type": "error"}])
+    with pytest.raises(TelemetryFormatError):
+        parse_batch(b'{"type": "error"}\nnot json')
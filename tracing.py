@@ -0,0 +1,201 @@
+"""
+請求階段追蹤
+以 contextvars 在 /api/chat、/api/tts/stream 的整個處理流程（包括串流回應的生成器）中傳遞目前的追蹤，
+各階段以 span() / record() / mark() 記錄耗時；請求完成後按抽樣率（慢請求一律保留）寫入輪替的 JSONL 檔。
+寫檔經 QueueHandler 交給背景線程，不阻塞事件循環
+"""
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+TRACE_HEADER = "X-Trace-Id"
+_VALID_TRACE_ID = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+_current: contextvars.ContextVar[Optional["Trace"]] = contextvars.ContextVar("trace", default=None)
+
+
+class Trace:
+    __slots__ = ("trace_id", "name", "started_at", "_start", "spans", "attrs", "status")
+
+    def __init__(self, name: str, trace_id: Optional[str] = None):
+        self.trace_id = trace_id or uuid.uuid4().hex[:16]
+        self.name = name
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.spans: List[Dict] = []
+        self.attrs: Dict = {}
+        self.status: Optional[int] = None
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self._start) * 1000
+
+    def add(self, name: str, start_ms: float, duration_ms: Optional[float], attrs: Dict):
+        """duration_ms 為 None 表示時間點（不帶 duration_ms 欄位）"""
+        span = {"name": name, "start_ms": round(start_ms, 2)}
+        if duration_ms is not None:
+            span["duration_ms"] = round(duration_ms, 2)
+        if attrs:
+            span.update(attrs)
+        self.spans.append(span)
+
+    def to_record(self) -> Dict:
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "ts": round(self.started_at, 3),
+            "duration_ms": round(self.elapsed_ms(), 2),
+            "status": self.status,
+            **({"attrs": self.attrs} if self.attrs else {}),
+            "spans": self.spans,
+        }
+
+
+def current() -> Optional[Trace]:
+    return _current.get()
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """記錄一個階段；沒有進行中的追蹤時不做任何事"""
+    trace = _current.get()
+    if trace is None:
+        yield attrs
+        return
+    start = trace.elapsed_ms()
+    try:
+        yield attrs  # 調用方可在階段內補充屬性
+    finally:
+        trace.add(name, start, trace.elapsed_ms() - start, attrs)
+
+
+def record(name: str, duration_ms: float, **attrs):
+    """記錄一個剛結束、已知耗時的階段（例如由計時器量度的 LLM 串流）"""
+    trace = _current.get()
+    if trace is not None:
+        end = trace.elapsed_ms()
+        trace.add(name, max(0.0, end - duration_ms), duration_ms, attrs)
+
+
+def mark(name: str, **attrs):
+    """記錄一個時間點，例如首 token、首段音頻"""
+    trace = _current.get()
+    if trace is not None:
+        trace.add(name, trace.elapsed_ms(), None, attrs)
+
+
+def annotate(**attrs):
+    """為整個請求加上屬性（例如模型、是否命中緩存）"""
+    trace = _current.get()
+    if trace is not None:
+        trace.attrs.update(attrs)
+
+
+class Tracer:
+    def __init__(self, path: str, sample_rate: float = 0.1, slow_ms: float = 3000,
+                 max_mb: float = 20, backups: int = 5, enabled: bool = True):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.backups = backups
+        self.enabled = enabled
+        self._logger: Optional[logging.Logger] = None
+        self._listener: Optional[logging.handlers.QueueListener] = None
+        self.stats = {"started": 0, "written": 0, "dropped": 0}
+
+    def _writer(self) -> logging.Logger:
+        """首次寫入時才建立檔案及背景寫入線程"""
+        if self._logger is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            handler = logging.handlers.RotatingFileHandler(
+                self.path, maxBytes=self.max_bytes, backupCount=self.backups, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            records = queue.SimpleQueue()
+            self._listener = logging.handlers.QueueListener(records, handler)
+            self._listener.start()
+            writer = logging.getLogger(f"{__name__}.{id(self)}")
+            writer.propagate = False
+            writer.setLevel(logging.INFO)
+            writer.addHandler(logging.handlers.QueueHandler(records))
+            self._logger = writer
+        return self._logger
+
+    def start(self, name: str, trace_id: Optional[str] = None):
+        """開始追蹤並設為目前追蹤，返回 (trace, token)"""
+        if trace_id is not None and not _VALID_TRACE_ID.match(trace_id):
+            trace_id = None
+        trace = Trace(name, trace_id)
+        self.stats["started"] += 1
+        return trace, _current.set(trace)
+
+    def finish(self, trace: Trace, token=None):
+        if token is not None:
+            _current.reset(token)
+        if not self.enabled:
+            return
+        if trace.elapsed_ms() < self.slow_ms and random.random() >= self.sample_rate:
+            self.stats["dropped"] += 1
+            return
+        self._writer().info(json.dumps(trace.to_record(), ensure_ascii=False))
+        self.stats["written"] += 1
+
+    def close(self):
+        if self._listener is not None:
+            self._listener.stop()
+            for handler in self._listener.handlers:
+                handler.close()
+            self._listener = None
+            self._logger = None
+
+    def get_stats(self) -> Dict:
+        return {"enabled": self.enabled, "path": self.path, "sample_rate": self.sample_rate,
+                "slow_ms": self.slow_ms, **self.stats}
+
+
+class TracingMiddleware:
+    """
+    純 ASGI 中介層：為指定路徑開始追蹤（沿用請求標頭中的 X-Trace-Id），回應標頭帶回追蹤 id，
+    並記錄回應開始及首個內容片段的時間；串流結束後才完成追蹤
+    """
+
+    def __init__(self, app, tracer: Tracer, paths=("/api/chat", "/api/tts/stream")):
+        self.app = app
+        self.tracer = tracer
+        self.paths = frozenset(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+        incoming = dict(scope["headers"]).get(TRACE_HEADER.lower().encode())
+        trace, token = self.tracer.start(f'{scope["method"]} {scope["path"]}',
+                                         incoming.decode("latin-1") if incoming else None)
+        first_body = True
+
+        async def send_with_trace(message):
+            nonlocal first_body
+            if message["type"] == "http.response.start":
+                trace.status = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [
+                    (TRACE_HEADER.lower().encode(), trace.trace_id.encode())]
+                trace.add("response_start", trace.elapsed_ms(), None, {})
+            elif message["type"] == "http.response.body" and first_body and message.get("body"):
+                first_body = False
+                trace.add("first_body", trace.elapsed_ms(), None, {})
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_trace)
+        finally:
+            self.tracer.finish(trace, token)
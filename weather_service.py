@@ -1,11 +1,13 @@
 import httpx
-from typing import Dict, Optional
-from datetime import datetime, timedelta
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+from datetime import datetime, timedelta, timezone
 import logging
 import asyncio
-from functools import lru_cache
 import time
 
+from intent_keywords import weather_intent
+
 logger = logging.getLogger(__name__)
 
 class WeatherService:
@@ -20,13 +22,23 @@ class WeatherService:
             "timezone": "Asia/Hong_Kong"
         }
         
-        # 記憶體緩存
-        self._cache = {}
-        self._cache_ttl = 1800  # 30分鐘
+        # 原始預報緩存，按網格單元（約5公里）存放：相近座標的院舍共用同一份預報及同一個上游請求。
+        # 一次請求已包含今日及明日（forecast_days=2），兩個日期都從同一份數據解析
+        # 單元 -> {'data': 原始回應, 'time': 取得時間, 'parsed': {(日期, 日曆日期): 解析結果}}
+        self.grid_step = 0.05  # 度
+        self._max_locations = 64  # LRU 上限；超過舊數據時限的項目在寫入時清除
+        self._forecasts: "OrderedDict[Tuple[int, int], Dict]" = OrderedDict()
+        self._cache_ttl = 1800  # 30分鐘內視為新鮮
+        self._stale_ttl = 6 * 3600  # 過期但在此時限內：即時返回舊數據，同時在背景刷新
+        self._refresh_tasks: Dict[Tuple[int, int], asyncio.Task] = {}  # 每個單元同一時間只有一個上游請求
+        self._stats = {"hits": 0, "stale_hits": 0, "misses": 0, "coalesced": 0, "evictions": 0,
+                       "refreshes": 0, "refresh_failures": 0, "deadline_exceeded": 0, "cooldown_skips": 0}
         
-        # 重試設定
+        # 重試設定：重試只在背景刷新任務中進行，用戶請求最多等待其時限
         self._max_retries = 3
         self._retry_delay = 1  # 初始延遲（秒）
+        self._failure_cooldown = 30  # 全部重試失敗後，此段時間內不再由請求觸發刷新（秒）
+        self._retry_after: Dict[Tuple[int, int], float] = {}
         
         # 天氣狀況對應的中文描述
         self.weather_codes = {
@@ -54,39 +66,148 @@ class WeatherService:
             99: "強烈冰雹雷暴"
         }
     
-    def _get_cache_key(self, date: str) -> str:
-        """生成緩存鍵"""
-        return f"weather_{date}_{self.default_location['latitude']}_{self.default_location['longitude']}"
-    
-    def _is_cache_valid(self, cache_entry: Dict) -> bool:
+    def _is_cache_valid(self, cache_entry: Optional[Dict], ttl: Optional[float] = None) -> bool:
         """檢查緩存是否有效"""
         if not cache_entry:
             return False
         
         cache_time = cache_entry.get('time', 0)
-        return (time.time() - cache_time) < self._cache_ttl
+        return (time.time() - cache_time) < (self._cache_ttl if ttl is None else ttl)
+    
+    def _from_forecast(self, entry: Optional[Dict], date: str) -> Optional[Dict]:
+        """
+        從原始預報解析指定日期；解析結果按實際日曆日期緩存，跨過午夜後 "today" 會重新解析為新的一天。
+        預報已不包含該日期時返回 None
+        """
+        if not entry:
+            return None
+        target = self._target_date(entry['data'], date)
+        key = (date, target)
+        parsed = entry['parsed']
+        if key not in parsed:
+            index = self._day_index(entry['data'], date, target)
+            parsed[key] = None if index is None else self._parse_weather_data(entry['data'], date, index)
+        return parsed[key]
+    
+    @staticmethod
+    def _now() -> datetime:
+        return datetime.now(timezone.utc)
+    
+    def local_date(self, data: Dict, days: int = 0) -> str:
+        """預報所在地（按 utc_offset_seconds，缺少時按本機時區）的日曆日期"""
+        if "utc_offset_seconds" in data:
+            now = self._now() + timedelta(seconds=data["utc_offset_seconds"])
+        else:
+            now = self._now().astimezone()
+        return (now + timedelta(days=days)).strftime("%Y-%m-%d")
+    
+    def _target_date(self, data: Dict, date: str) -> Optional[str]:
+        """"today" / "tomorrow" 對應的日曆日期；預報沒有 daily.time 時為 None"""
+        if not data.get("daily", {}).get("time"):
+            return None
+        return self.local_date(data, 1 if date == "tomorrow" else 0)
+    
+    @staticmethod
+    def _day_index(data: Dict, date: str, target: Optional[str]) -> Optional[int]:
+        """目標日期在 daily 中的位置；跨過午夜後舊預報的第 0 天已是昨日"""
+        days = data.get("daily", {}).get("time")
+        if not days:
+            return 1 if date == "tomorrow" else 0
+        return days.index(target) if target in days else None
+    
+    def _cell(self, location: Optional[Dict]) -> Tuple[int, int]:
+        """座標所屬的網格單元"""
+        location = location or self.default_location
+        return (round(location["latitude"] / self.grid_step), round(location["longitude"] / self.grid_step))
     
-    async def get_weather(self, date: str = "today") -> Optional[Dict]:
-        """獲取天氣資訊（帶緩存和重試）"""
-        cache_key = self._get_cache_key(date)
+    def forecast_entry(self, location: Optional[Dict] = None) -> Optional[Dict]:
+        """該位置目前緩存的原始預報（不論是否過期）"""
+        return self._forecasts.get(self._cell(location))
+    
+    def _store(self, cell: Tuple[int, int], entry: Dict):
+        """寫入緩存：先清除超過舊數據時限的項目，再按 LRU 限制數量"""
+        now = time.time()
+        for key in [key for key, old in self._forecasts.items() if now - old['time'] >= self._stale_ttl]:
+            del self._forecasts[key]
+            self._stats["evictions"] += 1
+        self._forecasts[cell] = entry
+        self._forecasts.move_to_end(cell)
+        while len(self._forecasts) > self._max_locations:
+            self._forecasts.popitem(last=False)
+            self._stats["evictions"] += 1
+        for key in [key for key, until in self._retry_after.items() if until <= now]:
+            del self._retry_after[key]
+    
+    async def get_weather(self, date: str = "today", timeout: Optional[float] = None,
+                          location: Optional[Dict] = None) -> Optional[Dict]:
+        """
+        獲取天氣資訊（location 為 {"latitude", "longitude", "timezone"}，預設香港）：
+        新鮮緩存直接返回；稍為過期的即時返回並在背景刷新（stale-while-revalidate）；
+        沒有可用數據時等待刷新，同一網格單元同時到達的請求共用同一個上游請求。
+        timeout 為最長等待秒數，超時返回過期數據或 None，刷新（及其重試）在背景繼續
+        """
+        location = location or self.default_location
+        cell = self._cell(location)
+        entry = self._forecasts.get(cell)
+        result = self._from_forecast(entry, date)
+        if result is not None:
+            if self._is_cache_valid(entry):
+                self._stats["hits"] += 1
+                self._forecasts.move_to_end(cell)
+                logger.debug(f"Weather cache hit for {date}")
+                return result
+            if self._is_cache_valid(entry, self._stale_ttl):
+                self._stats["stale_hits"] += 1
+                self._start_refresh(location)
+                return result
         
-        # 檢查緩存
-        cached = self._cache.get(cache_key)
-        if cached and self._is_cache_valid(cached):
-            logger.debug(f"Weather cache hit for {date}")
-            return cached['data']
+        self._stats["misses"] += 1
+        if cell in self._refresh_tasks:
+            self._stats["coalesced"] += 1
+        elif time.time() < self._retry_after.get(cell, 0.0):
+            # 上游剛剛全部重試失敗，不讓每個請求再等一次
+            self._stats["cooldown_skips"] += 1
+            return result
+        # shield：個別請求超時或被取消不會中斷共用的刷新
+        try:
+            fresh = await asyncio.wait_for(asyncio.shield(self._start_refresh(location)), timeout)
+        except asyncio.TimeoutError:
+            self._stats["deadline_exceeded"] += 1
+            logger.warning(f"Weather lookup exceeded {timeout}s budget, refresh continues in background")
+            return result
+        if fresh:
+            return self._from_forecast(fresh, date)
         
-        # 從API獲取
+        # 嘗試返回過期緩存
+        if result is not None:
+            logger.info("Returning expired cache as fallback")
+        return result
+    
+    async def refresh(self, location: Optional[Dict] = None) -> bool:
+        """立即刷新（不受失敗冷卻限制），返回是否成功"""
+        return await asyncio.shield(self._start_refresh(location or self.default_location)) is not None
+    
+    def _start_refresh(self, location: Optional[Dict] = None) -> asyncio.Task:
+        """啟動（或沿用該網格單元進行中的）刷新任務"""
+        location = location or self.default_location
+        cell = self._cell(location)
+        task = self._refresh_tasks.get(cell)
+        if task is None:
+            task = asyncio.create_task(self._refresh(cell, location.get("timezone", "auto")))
+            self._refresh_tasks[cell] = task
+            task.add_done_callback(lambda _: self._refresh_tasks.pop(cell, None))
+        return task
+    
+    async def _refresh(self, cell: Tuple[int, int], tz: str = "auto") -> Optional[Dict]:
+        """從API取得該單元的預報（帶重試），成功時替換緩存並返回新的緩存項"""
+        self._stats["refreshes"] += 1
         for retry in range(self._max_retries):
             try:
-                result = await self._fetch_weather_from_api(date)
-                if result:
-                    # 更新緩存
-                    self._cache[cache_key] = {
-                        'data': result,
-                        'time': time.time()
-                    }
-                    return result
+                data = await self._fetch_forecast(cell[0] * self.grid_step, cell[1] * self.grid_step, tz)
+                entry = {'data': data, 'time': time.time(), 'parsed': {}}
+                self._store(cell, entry)
+                self._retry_after.pop(cell, None)
+                return entry
                     
             except Exception as e:
                 logger.warning(f"Weather API attempt {retry + 1} failed: {e}")
@@ -98,28 +219,18 @@ class WeatherService:
                     await asyncio.sleep(delay)
                 else:
                     logger.error(f"All weather API attempts failed")
-                    
-                    # 嘗試返回過期緩存
-                    if cached:
-                        logger.info("Returning expired cache as fallback")
-                        return cached['data']
         
+        self._stats["refresh_failures"] += 1
+        self._retry_after[cell] = time.time() + self._failure_cooldown
         return None
     
-    async def _fetch_weather_from_api(self, date: str) -> Optional[Dict]:
-        """從API獲取天氣數據"""
-        # 計算日期
-        now = datetime.now()
-        if date == "tomorrow":
-            target_date = now + timedelta(days=1)
-        else:
-            target_date = now
-        
+    async def _fetch_forecast(self, latitude: float, longitude: float, tz: str = "auto") -> Dict:
+        """從API獲取今明兩日的原始預報（座標為網格單元中心）"""
         # 建構請求參數
         params = {
-            "latitude": self.default_location["latitude"],
-            "longitude": self.default_location["longitude"],
-            "timezone": self.default_location["timezone"],
+            "latitude": round(latitude, 4),
+            "longitude": round(longitude, 4),
+            "timezone": tz,
             "current": "temperature_2m,relative_humidity_2m,weather_code",
             "daily": "temperature_2m_max,temperature_2m_min,weather_code,precipitation_sum",
             "forecast_days": 2
@@ -130,14 +241,15 @@ class WeatherService:
             response = await client.get(self.base_url, params=params)
             
             if response.status_code == 200:
-                data = response.json()
-                return self._parse_weather_data(data, date)
+                return response.json()
             else:
                 logger.error(f"Weather API error: {response.status_code} - {response.text}")
                 raise Exception(f"API returned status {response.status_code}")
     
-    def _parse_weather_data(self, data: Dict, date: str) -> Dict:
-        """解析天氣數據"""
+    def _parse_weather_data(self, data: Dict, date: str, index: Optional[int] = None) -> Dict:
+        """解析天氣數據；index 為該日期在 daily 中的位置"""
+        if index is None:
+            index = 1 if date == "tomorrow" else 0
         try:
             if date == "today":
                 # 今天的天氣使用當前數據
@@ -150,29 +262,29 @@ class WeatherService:
                 return {
                     "date": "今日",
                     "temperature": current.get("temperature_2m", 0),
-                    "temperature_max": daily["temperature_2m_max"][0] if daily.get("temperature_2m_max") else None,
-                    "temperature_min": daily["temperature_2m_min"][0] if daily.get("temperature_2m_min") else None,
+                    "temperature_max": daily["temperature_2m_max"][index] if len(daily.get("temperature_2m_max", [])) > index else None,
+                    "temperature_min": daily["temperature_2m_min"][index] if len(daily.get("temperature_2m_min", [])) > index else None,
                     "humidity": current.get("relative_humidity_2m", 0),
                     "weather_code": weather_code,
                     "weather_description": weather_desc,
-                    "precipitation": daily["precipitation_sum"][0] if daily.get("precipitation_sum") else 0
+                    "precipitation": daily["precipitation_sum"][index] if len(daily.get("precipitation_sum", [])) > index else 0
                 }
             else:
                 # 明天的天氣使用預報數據
                 daily = data.get("daily", {})
                 
-                weather_code = daily["weather_code"][1] if len(daily.get("weather_code", [])) > 1 else 0
+                weather_code = daily["weather_code"][index] if len(daily.get("weather_code", [])) > index else 0
                 weather_desc = self.weather_codes.get(weather_code, "未知")
                 
                 return {
                     "date": "明日",
                     "temperature": None,
-                    "temperature_max": daily["temperature_2m_max"][1] if len(daily.get("temperature_2m_max", [])) > 1 else None,
-                    "temperature_min": daily["temperature_2m_min"][1] if len(daily.get("temperature_2m_min", [])) > 1 else None,
+                    "temperature_max": daily["temperature_2m_max"][index] if len(daily.get("temperature_2m_max", [])) > index else None,
+                    "temperature_min": daily["temperature_2m_min"][index] if len(daily.get("temperature_2m_min", [])) > index else None,
                     "humidity": None,
                     "weather_code": weather_code,
                     "weather_description": weather_desc,
-                    "precipitation": daily["precipitation_sum"][1] if len(daily.get("precipitation_sum", [])) > 1 else 0
+                    "precipitation": daily["precipitation_sum"][index] if len(daily.get("precipitation_sum", [])) > index else 0
                 }
                 
         except Exception as e:
@@ -239,41 +351,125 @@ class WeatherService:
         
         return response
     
-    @lru_cache(maxsize=32)
     def extract_weather_intent(self, question: str) -> Optional[Dict]:
-        """從問題中提取天氣查詢意圖（帶緩存）"""
-        question_lower = question.lower()
-        
-        # 檢測是否是天氣相關問題
-        weather_keywords = ["天氣", "溫度", "幾度", "熱唔熱", "凍唔凍", "落雨", "下雨", "晴天", "陰天"]
-        is_weather_query = any(keyword in question for keyword in weather_keywords)
-        
-        if not is_weather_query:
-            return None
-        
-        # 檢測時間
-        if any(word in question for word in ["明天", "聽日", "明日"]):
-            return {"type": "weather", "date": "tomorrow"}
-        elif any(word in question for word in ["今天", "今日", "而家", "現在"]):
-            return {"type": "weather", "date": "today"}
-        else:
-            # 預設查詢今天
-            return {"type": "weather", "date": "today"}
+        """從問題中提取天氣查詢意圖（預編譯關鍵詞自動機，單次掃描）"""
+        return weather_intent(question)
     
     def get_cache_stats(self) -> Dict:
         """獲取緩存統計資訊"""
-        valid_entries = sum(1 for entry in self._cache.values() if self._is_cache_valid(entry))
-        
+        entry = self.forecast_entry()
         return {
-            'total_entries': len(self._cache),
-            'valid_entries': valid_entries,
-            'expired_entries': len(self._cache) - valid_entries,
+            'cached': entry is not None,
+            'age_seconds': round(time.time() - entry['time'], 1) if entry else None,
+            'valid': self._is_cache_valid(entry),
+            'locations': len(self._forecasts),
+            'valid_locations': sum(1 for e in self._forecasts.values() if self._is_cache_valid(e)),
+            'max_locations': self._max_locations,
+            'grid_step_degrees': self.grid_step,
+            'refreshing': len(self._refresh_tasks),
             'cache_ttl_minutes': self._cache_ttl / 60,
-            'intent_cache_info': self.extract_weather_intent.cache_info()._asdict()
+            'stale_ttl_minutes': self._stale_ttl / 60,
+            **self._stats
         }
     
     def clear_cache(self):
         """清除所有緩存"""
-        self._cache.clear()
-        self.extract_weather_intent.cache_clear()
+        self._forecasts.clear()
+        self._retry_after.clear()
         logger.info("Weather cache cleared")
+
+
+class WeatherPrefetcher:
+    """
+    定時刷新各院舍位置的預報（間隔短於緩存有效期，請求不需等待上游），並即時格式化今明兩日的回應；
+    回應文字改變時調用 on_update(地點, 日期, 文字)，用於預先合成語音
+    """
+    
+    DATES = ("today", "tomorrow")
+    
+    def __init__(self, service: WeatherService, interval: float = 900, retry_interval: float = 60,
+                 on_update: Optional[Callable[[str, str, Optional[str]], None]] = None,
+                 locations: Optional[Dict[str, Optional[Dict]]] = None):
+        self.service = service
+        self.interval = interval
+        self.retry_interval = retry_interval
+        self.on_update = on_update
+        self.locations = locations or {"default": None}  # 地點名稱 -> 座標（None 為預設位置）
+        self._task: Optional[asyncio.Task] = None
+        # 每個地點已格式化的預報（與 service.forecast_entry() 比較是否仍是同一份）、格式化時當地的日期及其回應
+        self._rendered_entries: Dict[str, Dict] = {}
+        self._rendered_days: Dict[str, str] = {}
+        self._responses: Dict[Tuple[str, str], Optional[str]] = {}
+        self._stats = {"scheduled_refreshes": 0, "scheduled_failures": 0, "renders": 0,
+                       "served": 0, "not_ready": 0}
+        self.last_refresh: Optional[float] = None
+    
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    async def _run(self):
+        while True:
+            results = await asyncio.gather(*(self.service.refresh(location) for location in self.locations.values()))
+            for site, ok in zip(self.locations, results):
+                if ok:
+                    self._stats["scheduled_refreshes"] += 1
+                    self._render(site, self.service.forecast_entry(self.locations[site]))
+                else:
+                    self._stats["scheduled_failures"] += 1
+            if any(results):
+                self.last_refresh = time.time()
+            await asyncio.sleep(self.interval if all(results) else self.retry_interval)
+    
+    def _render(self, site: str, entry: Dict):
+        """格式化該地點預報的今明兩日回應"""
+        self._rendered_entries[site] = entry
+        self._rendered_days[site] = self.service.local_date(entry['data'])
+        self._stats["renders"] += 1
+        for date in self.DATES:
+            data = self.service._from_forecast(entry, date)
+            text = self.service.format_weather_response(data) if data else None
+            if text != self._responses.get((site, date)):
+                self._responses[(site, date)] = text
+                if self.on_update:
+                    self.on_update(site, date, text)
+    
+    def get_response(self, date: str, site: str = "default") -> Optional[str]:
+        """預報仍新鮮時返回預先格式化的回應；否則（或地點未預取）返回 None，由調用方走 get_weather()"""
+        if site not in self.locations:
+            return None
+        entry = self.service.forecast_entry(self.locations[site])
+        if not self.service._is_cache_valid(entry):
+            self._stats["not_ready"] += 1
+            return None
+        if (entry is not self._rendered_entries.get(site)
+                or self.service.local_date(entry['data']) != self._rendered_days.get(site)):
+            # 預報由請求觸發的刷新更新了，或當地已跨過午夜（今日 / 明日指向另一天）
+            self._render(site, entry)
+        text = self._responses.get((site, date))
+        if text is None:
+            self._stats["not_ready"] += 1
+            return None
+        self._stats["served"] += 1
+        return text
+    
+    def get_stats(self) -> Dict:
+        lookups = self._stats["served"] + self._stats["not_ready"]
+        return {
+            "running": self._task is not None and not self._task.done(),
+            "interval_minutes": self.interval / 60,
+            "last_refresh": self.last_refresh,
+            "locations": list(self.locations),
+            "responses_ready": [f"{site}:{date}" for (site, date), text in self._responses.items() if text],
+            "served_rate": round(self._stats["served"] / lookups, 4) if lookups else 0.0,
+            **self._stats
+        }